@@ -0,0 +1,127 @@
+"""
+Batch analysis of many positions on all cores.
+Positions (FEN strings) are handed to a pool of long-lived worker processes, each with its own
+Searcher (and transposition table) that is kept for every position it analyses.
+Results stream back in input order or as they finish, with a cap on how many positions are in flight.
+
+Command line (one FEN per line in, one JSON object per line out):
+    $ python ChessBatch.py positions.fen --depth 3 --processes 8 > results.jsonl
+    $ cat positions.fen | python ChessBatch.py --unordered
+"""
+
+import argparse
+import json
+import multiprocessing
+import sys
+import threading
+import time
+
+import ChessEngine
+import ChessSearch
+
+# per process state of a worker, set up once by init_worker
+worker_searcher = None
+worker_settings = {}
+
+
+def init_worker(depth, time_limit, tt_size_mb, backend):
+    global worker_searcher, worker_settings
+    worker_searcher = ChessSearch.Searcher(tt_size_mb)
+    worker_settings = {"depth": depth, "time_limit": time_limit, "backend": backend}
+
+
+def analyse_position(task):
+    """
+    Runs in a worker: legal move count, game status and a fixed depth search of one position
+    :param task: (index, fen)
+    :return: dict of results for the position
+    """
+    index, fen = task
+    result = {"index": index, "fen": fen}
+    try:
+        gs = ChessEngine.GameState.from_fen(fen, worker_settings["backend"])
+    except (ValueError, KeyError, IndexError) as error:
+        result["error"] = str(error)
+        return result
+    moves = gs.get_valid_moves()
+    result["legal_moves"] = len(moves)
+    if gs.checkmate:
+        result["status"] = "checkmate"
+    elif gs.stalemate:
+        result["status"] = "stalemate"
+    else:
+        result["status"] = "ongoing"
+        search = worker_searcher.search(gs, worker_settings["depth"], worker_settings["time_limit"])
+        result["best_move"] = search.best_move.get_chess_notation()
+        result["score"] = search.score
+        result["depth"] = search.depth
+        result["pv"] = [move.get_chess_notation() for move in search.pv]
+        result["nodes"] = search.nodes
+    return result
+
+
+def analyse_positions(positions, processes=None, depth=3, time_limit=None, ordered=True, max_pending=None,
+                      chunksize=4, tt_size_mb=16, backend="list"):
+    """
+    Analyses a stream of FEN strings on a process pool, yielding a result dict per position.
+    positions can be any iterable (e.g. an open file); it is read lazily, and at most max_pending
+    positions are read ahead of the results handed back, so memory stays bounded for any stream size
+
+    :param ordered: yield results in input order, otherwise as soon as each is done (each has an "index")
+    """
+    processes = processes or multiprocessing.cpu_count()
+    if max_pending is None:
+        max_pending = processes * chunksize * 4
+    max_pending = max(max_pending, chunksize)  # the pool reads a whole chunk before sending it off
+    in_flight = threading.BoundedSemaphore(max_pending)
+
+    def tasks():
+        # runs on the pool's task feeding thread, which blocks here once max_pending positions are out
+        for index, fen in enumerate(positions):
+            fen = fen.strip()
+            if fen:
+                in_flight.acquire()
+                yield index, fen
+
+    with multiprocessing.Pool(processes, init_worker, (depth, time_limit, tt_size_mb, backend)) as pool:
+        if ordered:
+            results = pool.imap(analyse_position, tasks(), chunksize)
+        else:
+            results = pool.imap_unordered(analyse_position, tasks(), chunksize)
+        for result in results:
+            in_flight.release()
+            yield result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse many positions on a process pool")
+    parser.add_argument("file", nargs="?", help="file with one FEN per line (default: stdin)")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--depth", type=int, default=3, help="search depth per position")
+    parser.add_argument("--time-limit", type=float, default=None, help="seconds of search per position")
+    parser.add_argument("--unordered", action="store_true", help="output results as they finish")
+    parser.add_argument("--chunksize", type=int, default=4, help="positions sent to a worker at a time")
+    parser.add_argument("--max-pending", type=int, default=None,
+                        help="most positions read ahead of the output (default: 4 chunks per process)")
+    parser.add_argument("--hash", type=int, default=16, help="transposition table size per worker in MB")
+    parser.add_argument("--backend", choices=ChessEngine.BACKENDS, default="list")
+    args = parser.parse_args()
+
+    source = open(args.file) if args.file else sys.stdin
+    start = time.perf_counter()
+    count = 0
+    try:
+        for result in analyse_positions(source, args.processes, args.depth, args.time_limit, not args.unordered,
+                                        args.max_pending, args.chunksize, tt_size_mb=args.hash, backend=args.backend):
+            print(json.dumps(result))
+            count += 1
+    finally:
+        if args.file:
+            source.close()
+    seconds = time.perf_counter() - start
+    print("{} positions in {:.2f}s ({:.1f} positions/s)".format(count, seconds, count / seconds if seconds else 0),
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,609 @@
+"""
+Bitboard backend for GameState.
+Every piece type of each color is kept as a 64-bit integer with one bit per square,
+square index = row * 8 + column (a8 is 0, h1 is 63), the same orientation as gs.board.
+Selected with ChessEngine.GameState(backend="bitboard").
+"""
+
+import ChessEngine
+
+SQUARES = [(square // 8, square % 8) for square in range(64)]
+ALL_SQUARES = (1 << 64) - 1
+PIECES = ("wP", "wN", "wB", "wR", "wQ", "wK", "bP", "bN", "bB", "bR", "bQ", "bK")
+COLOR_PIECES = {"w": PIECES[:6], "b": PIECES[6:]}  # pawn, knight, bishop, rook, queen, king of a color
+
+# (row step, column step) of each sliding direction
+ROOK_DIRECTIONS = ((-1, 0), (0, -1), (1, 0), (0, 1))
+BISHOP_DIRECTIONS = ((-1, -1), (-1, 1), (1, -1), (1, 1))
+
+
+def on_board(row, column):
+    return 0 <= row < 8 and 0 <= column < 8
+
+
+def step_attacks(offsets):
+    """
+    Attack table for a piece that jumps by the given (row, column) offsets
+    :return: list of 64 bitboards
+    """
+    table = []
+    for row, column in SQUARES:
+        attacks = 0
+        for d_row, d_column in offsets:
+            if on_board(row + d_row, column + d_column):
+                attacks |= 1 << ((row + d_row) * 8 + column + d_column)
+        table.append(attacks)
+    return table
+
+
+def ray_table(d_row, d_column):
+    """
+    All squares from each square in one direction, up to the edge of the board
+    :return: list of 64 bitboards
+    """
+    table = []
+    for row, column in SQUARES:
+        ray = 0
+        end_row, end_column = row + d_row, column + d_column
+        while on_board(end_row, end_column):
+            ray |= 1 << (end_row * 8 + end_column)
+            end_row, end_column = end_row + d_row, end_column + d_column
+        table.append(ray)
+    return table
+
+
+KNIGHT_ATTACKS = step_attacks(((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)))
+KING_ATTACKS = step_attacks(((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)))
+# squares a pawn of that color attacks; also where a pawn of the other color has to stand to attack a square
+PAWN_ATTACKS = {"w": step_attacks(((-1, -1), (-1, 1))), "b": step_attacks(((1, -1), (1, 1)))}
+# direction -> (rays, True if the square index grows along the ray)
+ROOK_RAYS = [(ray_table(d_row, d_column), d_row * 8 + d_column > 0) for d_row, d_column in ROOK_DIRECTIONS]
+BISHOP_RAYS = [(ray_table(d_row, d_column), d_row * 8 + d_column > 0) for d_row, d_column in BISHOP_DIRECTIONS]
+
+
+# squares a rook / bishop on each square reaches on an empty board
+ROOK_LINES = [up | left | down | right for up, left, down, right in zip(*[rays for rays, _ in ROOK_RAYS])]
+BISHOP_LINES = [up_left | up_right | down_left | down_right
+                for up_left, up_right, down_left, down_right in zip(*[rays for rays, _ in BISHOP_RAYS])]
+
+
+def between_table():
+    """
+    BETWEEN[a][b] holds the squares strictly between a and b when they share a line, otherwise 0
+    """
+    table = [[0] * 64 for _ in range(64)]
+    for start, (row, column) in enumerate(SQUARES):
+        for d_row, d_column in ROOK_DIRECTIONS + BISHOP_DIRECTIONS:
+            squares = 0
+            end_row, end_column = row + d_row, column + d_column
+            while on_board(end_row, end_column):
+                table[start][end_row * 8 + end_column] = squares
+                squares |= 1 << (end_row * 8 + end_column)
+                end_row, end_column = end_row + d_row, end_column + d_column
+    return table
+
+
+BETWEEN = between_table()
+
+
+FILE_A = sum(1 << (row * 8) for row in range(8))
+FILE_H = FILE_A << 7
+RANK_3 = 0xFF << 40  # row 5, where white pawns land after one step from their start
+RANK_6 = 0xFF << 16  # row 2, same for black
+LAST_RANKS = 0xFF | 0xFF << 56  # rows 0 and 7, where pawns promote
+
+NORTH, WEST, SOUTH, EAST = [rays for rays, _ in ROOK_RAYS]
+NORTH_WEST, NORTH_EAST, SOUTH_WEST, SOUTH_EAST = [rays for rays, _ in BISHOP_RAYS]
+
+# Moves never change once made, so the generator hands out the same Move objects to every game:
+# piece -> {end squares << 6 | start square: tuple of its moves to those (empty) squares}
+# (pawn pushes: end squares << 6 | distance back to the start square & 63)
+QUIET_MOVES = {piece: {} for piece in PIECES}
+QUIET_CACHE_SIZE = 1 << 16  # entries of a piece kept before its cache starts over
+# piece -> captured piece -> {end square << 6 | start square: tuple of the moves (4 for a promotion)}
+CAPTURE_MOVES = {piece: {victim: {} for victim in PIECES} for piece in PIECES}
+
+
+def ray_attacks(square, occupied, directions):
+    """
+    Squares a slider on square attacks along the directions, stopping at (and including) the first piece in each.
+    Towards row 0 the nearest blocker is the highest set bit, towards row 7 the lowest
+    """
+    attacks = 0
+    for rays, increasing in directions:
+        ray = rays[square]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[(blockers & -blockers).bit_length() - 1 if increasing else blockers.bit_length() - 1]
+        attacks |= ray
+    return attacks
+
+
+def blocker_masks(directions):
+    """
+    Squares whose pieces can stop a slider on each square: its rays without the last square on the edge
+    :return: list of 64 bitboards
+    """
+    masks = []
+    for square in range(64):
+        mask = 0
+        for rays, increasing in directions:
+            ray = rays[square]
+            if ray:
+                ray ^= (ray & -ray) if not increasing else 1 << (ray.bit_length() - 1)  # the edge square
+            mask |= ray
+        masks.append(mask)
+    return masks
+
+
+# slider attacks by square and the pieces on its blocker mask, filled in as positions come up
+# (at most 102400 rook and 5248 bishop entries)
+ROOK_MASKS = blocker_masks(ROOK_RAYS)
+BISHOP_MASKS = blocker_masks(BISHOP_RAYS)
+ROOK_TABLE = [{} for _ in range(64)]
+BISHOP_TABLE = [{} for _ in range(64)]
+
+
+def rook_attacks(square, occupied):
+    """
+    Squares a rook on square attacks, stopping at (and including) the first piece in each direction
+    """
+    blockers = occupied & ROOK_MASKS[square]
+    attacks = ROOK_TABLE[square].get(blockers)
+    if attacks is None:
+        attacks = ROOK_TABLE[square][blockers] = ray_attacks(square, blockers, ROOK_RAYS)
+    return attacks
+
+
+def bishop_attacks(square, occupied):
+    """
+    Squares a bishop on square attacks, stopping at (and including) the first piece in each direction
+    """
+    blockers = occupied & BISHOP_MASKS[square]
+    attacks = BISHOP_TABLE[square].get(blockers)
+    if attacks is None:
+        attacks = BISHOP_TABLE[square][blockers] = ray_attacks(square, blockers, BISHOP_RAYS)
+    return attacks
+
+
+def queen_attacks(square, occupied):
+    return rook_attacks(square, occupied) | bishop_attacks(square, occupied)
+
+
+def squares_of(bitboard):
+    """
+    Yields the index of every set bit, lowest first
+    """
+    while bitboard:
+        lowest = bitboard & -bitboard
+        yield lowest.bit_length() - 1
+        bitboard ^= lowest
+
+
+class BitboardGameState(ChessEngine.GameState):
+    """
+    GameState that keeps a bitboard for each of the 12 pieces next to gs.board.
+    gs.board stays the source of truth for the UI and Move objects; the bitboards are
+    updated on the few squares each move touches and used for move generation and attack tests
+    """
+    def __init__(self, backend="bitboard"):
+        ChessEngine.GameState.__init__(self, "bitboard")
+        self.load_bitboards()
+
+    def sync_position(self):
+        ChessEngine.GameState.sync_position(self)
+        self.load_bitboards()
+
+    def clone(self):
+        clone = ChessEngine.GameState.clone(self)
+        clone.bitboards = dict(self.bitboards)
+        clone.occupancy = dict(self.occupancy)
+        return clone
+
+    def load_bitboards(self):
+        """
+        Rebuild every bitboard from gs.board (after setting up a position by hand)
+        """
+        self.bitboards = dict.fromkeys(PIECES, 0)
+        for square in range(64):
+            piece = self.board[square // 8][square % 8]
+            if piece != "--":
+                self.bitboards[piece] |= 1 << square
+        self.occupancy = {"w": 0, "b": 0}
+        for piece in PIECES:
+            self.occupancy[piece[0]] |= self.bitboards[piece]
+
+    def make_move(self, move):
+        ChessEngine.GameState.make_move(self, move)
+        self.move_bits(move)
+
+    def undo_move(self):
+        if len(self.move_log) != 0:
+            self.move_bits(self.move_log[-1])
+            ChessEngine.GameState.undo_move(self)
+
+    def move_bits(self, move):
+        """
+        Flips the bits a move changes, called while gs.board shows the position after the move.
+        Flipping is its own inverse, so the same call makes and undoes the move
+        """
+        bitboards = self.bitboards
+        occupancy = self.occupancy
+        code = move.code
+        end_bit = 1 << (code >> 6 & 63)
+        if not code >> 12:  # no promotion, en passant or castle: one piece moves, maybe onto another
+            bits = 1 << (code & 63) | end_bit
+            bitboards[move.piece_moved] ^= bits
+            occupancy[move.piece_moved[0]] ^= bits
+            if move.piece_captured != "--":
+                bitboards[move.piece_captured] ^= end_bit
+                occupancy[move.piece_captured[0]] ^= end_bit
+            return
+        color = move.piece_moved[0]
+        end_row, end_column = code >> 9 & 7, code >> 6 & 7
+        start_bit = 1 << (code & 63)
+        bitboards[move.piece_moved] ^= start_bit
+        bitboards[self.board[end_row][end_column]] ^= end_bit  # differs from piece_moved on promotion
+        occupancy[color] ^= start_bit | end_bit
+        if move.piece_captured != "--":
+            if code & ChessEngine.ENPASSANT_FLAG:
+                captured_bit = 1 << ((code & 56) | end_column)  # start row, end column
+            else:
+                captured_bit = end_bit
+            bitboards[move.piece_captured] ^= captured_bit
+            occupancy[move.piece_captured[0]] ^= captured_bit
+        if code & ChessEngine.CASTLE_FLAG:
+            if end_column - (code & 7) == 2:  # king side, h -> f
+                rook = self.board[end_row][end_column - 1]
+                rook_bits = (end_bit << 1) | (end_bit >> 1)
+            else:  # queen side, a -> d
+                rook = self.board[end_row][end_column + 1]
+                rook_bits = (end_bit >> 2) | (end_bit << 1)
+            if rook != "--":
+                bitboards[rook] ^= rook_bits
+                occupancy[rook[0]] ^= rook_bits
+
+    def attackers_mask(self, square, color, occupied):
+        """
+        Bitboard of the pieces of color that attack square, with the sliders seeing through everything not in occupied
+        """
+        bitboards = self.bitboards
+        pawn, knight, bishop, rook, queen, king = COLOR_PIECES[color]
+        queens = bitboards[queen]
+        return (KNIGHT_ATTACKS[square] & bitboards[knight]) | \
+            (KING_ATTACKS[square] & bitboards[king]) | \
+            (PAWN_ATTACKS["b" if color == "w" else "w"][square] & bitboards[pawn]) | \
+            (rook_attacks(square, occupied) & (bitboards[rook] | queens)) | \
+            (bishop_attacks(square, occupied) & (bitboards[bishop] | queens))
+
+    def find_attackers(self, row, column, color, first_only):
+        occupied = self.occupancy["w"] | self.occupancy["b"]
+        attackers = self.attackers_mask(row * 8 + column, color, occupied)
+        if first_only and attackers:
+            attackers &= -attackers
+        return [SQUARES[square] for square in squares_of(attackers)]
+
+    def square_under_attack(self, row, column):
+        enemy_color = "b" if self.white_to_move else "w"
+        occupied = self.occupancy["w"] | self.occupancy["b"]
+        return self.attackers_mask(row * 8 + column, enemy_color, occupied) != 0
+
+    def king_move_is_safe(self, move):
+        """
+        Same test as GameState.king_move_is_safe, with the king taken out of the occupancy instead of the board
+        """
+        code = move.code
+        enemy_color = "b" if self.white_to_move else "w"
+        without_king = (self.occupancy["w"] | self.occupancy["b"]) ^ (1 << (code & 63))
+        return self.attackers_mask(code >> 6 & 63, enemy_color, without_king) == 0
+
+    def enpassant_move_is_safe(self, move, king_row, king_column):
+        ally_color, enemy_color = ("w", "b") if self.white_to_move else ("b", "w")
+        occupied = self.occupancy["w"] | self.occupancy["b"]
+        return self.enpassant_is_safe(move.code & 63, move.code >> 6 & 63, king_row * 8 + king_column,
+                                      ally_color, enemy_color, occupied)
+
+    def pin_masks(self, king_square, ally_color, enemy_color, occupied):
+        """
+        Finds the allied pieces pinned to the king
+        :return: dict of pinned square -> squares it may still move to (the line up to and including the pinner)
+        """
+        pins = {}
+        bitboards = self.bitboards
+        own = self.occupancy[ally_color]
+        queens = bitboards[enemy_color + "Q"]
+        for directions, lines, sliders in ((ROOK_RAYS, ROOK_LINES, bitboards[enemy_color + "R"] | queens),
+                                           (BISHOP_RAYS, BISHOP_LINES, bitboards[enemy_color + "B"] | queens)):
+            if not lines[king_square] & sliders:
+                continue  # no slider lined up with the king
+            for rays, increasing in directions:
+                if not rays[king_square] & sliders:
+                    continue  # nothing on this line could pin
+                blockers = rays[king_square] & occupied
+                first = (blockers & -blockers) if increasing else 1 << (blockers.bit_length() - 1)
+                if not first & own:
+                    continue
+                blockers ^= first
+                if not blockers:
+                    continue
+                second = (blockers & -blockers) if increasing else 1 << (blockers.bit_length() - 1)
+                if second & sliders:
+                    pinner = second.bit_length() - 1
+                    pins[first.bit_length() - 1] = BETWEEN[king_square][pinner] | second
+        return pins
+
+    def generate_valid_moves(self):
+        """
+        Gets all valid moves for the current player from the bitboards.
+        Same rules as GameState.generate_valid_moves: checkers and pins are found once, every piece
+        is limited to the squares that keep the king safe
+
+        :return: list of valid moves only
+        """
+        if self.white_to_move:
+            ally_color, enemy_color = "w", "b"
+            king_row, king_column = self.white_king_location
+        else:
+            ally_color, enemy_color = "b", "w"
+            king_row, king_column = self.black_king_location
+        bitboards = self.bitboards
+        board = self.board
+        pawn, knight, bishop, rook, queen, king = COLOR_PIECES[ally_color]
+        own = self.occupancy[ally_color]
+        enemies = self.occupancy[enemy_color]
+        occupied = own | enemies
+        empty = ALL_SQUARES ^ occupied
+        king_square = king_row * 8 + king_column
+        checkers = self.attackers_mask(king_square, enemy_color, occupied)
+        in_check = checkers != 0
+        pins = self.pin_masks(king_square, ally_color, enemy_color, occupied)
+        if not in_check:
+            targets = ALL_SQUARES ^ own
+        elif checkers & (checkers - 1):
+            targets = 0  # double check, only the king can move
+        else:
+            targets = checkers | BETWEEN[king_square][checkers.bit_length() - 1]
+        moves = []
+
+        if targets:
+            Move = ChessEngine.Move
+            # pawns, the unpinned ones are pushed all at once by shifting the whole bitboard
+            pawns = bitboards[pawn]
+            pinned_pawns = 0
+            for square in pins:
+                pinned_pawns |= pawns & (1 << square)
+            free_pawns = pawns ^ pinned_pawns
+            if ally_color == "w":
+                one_step = (free_pawns >> 8) & empty
+                two_steps = ((one_step & RANK_3) >> 8) & empty
+                left = ((free_pawns & ~FILE_A) >> 9) & enemies
+                right = ((free_pawns & ~FILE_H) >> 7) & enemies
+                forward = -8
+            else:
+                one_step = (free_pawns << 8) & empty
+                two_steps = ((one_step & RANK_6) << 8) & empty
+                left = ((free_pawns & ~FILE_A) << 7) & enemies
+                right = ((free_pawns & ~FILE_H) << 9) & enemies
+                forward = 8
+            if one_step & targets:
+                moves.extend(self.pawn_pushes(pawn, one_step & targets, -forward))
+            if two_steps & targets:
+                moves.extend(self.pawn_pushes(pawn, two_steps & targets, -2 * forward))
+            captures_by_victim = CAPTURE_MOVES[pawn]
+            for ends, back in ((left & targets, -forward + 1), (right & targets, -forward - 1)):
+                while ends:
+                    lowest = ends & -ends
+                    end = lowest.bit_length() - 1
+                    ends ^= lowest
+                    captures = captures_by_victim[board[end >> 3][end & 7]]
+                    key = end << 6 | (end + back)
+                    cached = captures.get(key)
+                    if cached is None:
+                        cached = captures[key] = self.new_moves(end + back, end)
+                    moves.extend(cached)
+            start_row = 6 if ally_color == "w" else 1
+            while pinned_pawns:
+                lowest = pinned_pawns & -pinned_pawns
+                square = lowest.bit_length() - 1
+                pinned_pawns ^= lowest
+                allowed = targets & pins[square]
+                one_step = square + forward
+                if (empty >> one_step) & 1:
+                    if (allowed >> one_step) & 1:
+                        self.add_pawn_moves(SQUARES[square], SQUARES[one_step], moves)
+                    two_steps = one_step + forward
+                    if square // 8 == start_row and (empty >> two_steps) & 1 and (allowed >> two_steps) & 1:
+                        moves.append(Move(SQUARES[square], SQUARES[two_steps], board))
+                for end in squares_of(PAWN_ATTACKS[ally_color][square] & enemies & allowed):
+                    self.add_pawn_moves(SQUARES[square], SQUARES[end], moves)
+            if self.enpassant_possible != ():
+                end = self.enpassant_possible[0] * 8 + self.enpassant_possible[1]
+                # pawns that could capture onto the en passant square stand where an enemy pawn there would attack
+                for square in squares_of(PAWN_ATTACKS[enemy_color][end] & pawns):
+                    if self.enpassant_is_safe(square, end, king_square, ally_color, enemy_color, occupied):
+                        moves.append(Move(SQUARES[square], SQUARES[end], board, is_enpassant_move=True))
+            # knights (a pinned knight can never move)
+            knights = bitboards[knight]
+            while knights:
+                lowest = knights & -knights
+                square = lowest.bit_length() - 1
+                knights ^= lowest
+                if square not in pins:
+                    self.add_piece_moves(knight, square, KNIGHT_ATTACKS[square] & targets, empty, moves)
+            # sliders
+            for piece, attacks in ((bishop, bishop_attacks), (rook, rook_attacks), (queen, queen_attacks)):
+                pieces = bitboards[piece]
+                while pieces:
+                    lowest = pieces & -pieces
+                    square = lowest.bit_length() - 1
+                    pieces ^= lowest
+                    ends = attacks(square, occupied) & targets
+                    if square in pins:
+                        ends &= pins[square]
+                    self.add_piece_moves(piece, square, ends, empty, moves)
+
+        # king, against the enemy attacks with the king off the board so it can't hide behind itself
+        # (out of check no slider looks through the king square, so castling can use them too)
+        king_ends = KING_ATTACKS[king_square] & ~own
+        can_castle = not in_check and self.castle_paths_empty(king_square, occupied)
+        if king_ends and not can_castle and not king_ends & (king_ends - 1):  # one square, test just that
+            if not self.attackers_mask(king_ends.bit_length() - 1, enemy_color, occupied ^ (1 << king_square)):
+                self.add_piece_moves(king, king_square, king_ends, empty, moves)
+        elif king_ends or can_castle:
+            attacked = self.attacked_squares(enemy_color, occupied ^ (1 << king_square))
+            self.add_piece_moves(king, king_square, king_ends & ~attacked, empty, moves)
+            if can_castle:
+                self.add_castle_moves(king_square, occupied, attacked, moves)
+
+        if len(moves) == 0:  # either checkmate or stalemate
+            if in_check:
+                self.checkmate = True
+            else:
+                self.stalemate = True
+        else:
+            self.checkmate = False
+            self.stalemate = False
+
+        return moves
+
+    def add_piece_moves(self, piece, start, ends, empty, moves):
+        """
+        Adds the moves of piece from start to each square of ends (empty or holding an enemy piece),
+        taking them from QUIET_MOVES and CAPTURE_MOVES and making only the ones not seen before
+        """
+        if not ends:
+            return
+        quiet = ends & empty
+        if quiet:
+            cache = QUIET_MOVES[piece]
+            key = quiet << 6 | start
+            cached = cache.get(key)
+            if cached is None:
+                if len(cache) >= QUIET_CACHE_SIZE:
+                    cache.clear()
+                cached = cache[key] = tuple(ChessEngine.Move(SQUARES[start], SQUARES[end], self.board)
+                                            for end in squares_of(quiet))
+            moves.extend(cached)
+        captures = ends ^ quiet
+        if captures:
+            board = self.board
+            captures_by_victim = CAPTURE_MOVES[piece]
+            while captures:
+                lowest = captures & -captures
+                end = lowest.bit_length() - 1
+                captures ^= lowest
+                cache = captures_by_victim[board[end >> 3][end & 7]]
+                key = end << 6 | start
+                cached = cache.get(key)
+                if cached is None:
+                    cached = cache[key] = (ChessEngine.Move(SQUARES[start], SQUARES[end], board),)
+                moves.extend(cached)
+
+    def pawn_pushes(self, pawn, ends, back):
+        """
+        Pushes of pawns to the (empty) squares of ends, each from back squares behind it, from QUIET_MOVES
+        :return: tuple of moves, one per promotion piece for a pawn reaching the last row
+        """
+        cache = QUIET_MOVES[pawn]
+        key = ends << 6 | (back & 63)
+        cached = cache.get(key)
+        if cached is None:
+            if len(cache) >= QUIET_CACHE_SIZE:
+                cache.clear()
+            moves = []
+            for end in squares_of(ends):
+                moves.extend(self.new_moves(end + back, end))
+            cached = cache[key] = tuple(moves)
+        return cached
+
+    def new_moves(self, start, end):
+        """
+        Makes the move from start to end on the current board
+        :return: tuple of the move, or of one move per promotion piece for a pawn reaching the last row
+        """
+        board = self.board
+        if (1 << end) & LAST_RANKS and board[start >> 3][start & 7][1] == "P":
+            return tuple(ChessEngine.Move(SQUARES[start], SQUARES[end], board, promotion_piece=piece)
+                         for piece in ChessEngine.PROMOTION_PIECES)
+        return ChessEngine.Move(SQUARES[start], SQUARES[end], board),
+
+    def attacked_squares(self, color, occupied):
+        """
+        Every square the pieces of color attack, with the sliders seeing through everything not in occupied
+        """
+        bitboards = self.bitboards
+        pawns = bitboards[color + "P"]
+        if color == "w":
+            attacked = ((pawns & ~FILE_A) >> 9) | ((pawns & ~FILE_H) >> 7)
+        else:
+            attacked = ((pawns & ~FILE_A) << 7) | ((pawns & ~FILE_H) << 9)
+        if bitboards[color + "K"]:
+            attacked |= KING_ATTACKS[bitboards[color + "K"].bit_length() - 1]
+        knights = bitboards[color + "N"]
+        while knights:
+            lowest = knights & -knights
+            attacked |= KNIGHT_ATTACKS[lowest.bit_length() - 1]
+            knights ^= lowest
+        queens = bitboards[color + "Q"]
+        for sliders, attacks in ((bitboards[color + "B"] | queens, bishop_attacks),
+                                 (bitboards[color + "R"] | queens, rook_attacks)):
+            while sliders:
+                lowest = sliders & -sliders
+                attacked |= attacks(lowest.bit_length() - 1, occupied)
+                sliders ^= lowest
+        return attacked
+
+    def get_castle_moves(self, row, column, moves):
+        """
+        Same as GameState.get_castle_moves, with the empty and attacked squares looked up on the bitboards
+        """
+        occupied = self.occupancy["w"] | self.occupancy["b"]
+        attacked = self.attacked_squares("b" if self.white_to_move else "w", occupied)
+        if not attacked & (1 << (row * 8 + column)):  # can't castle while in check
+            self.add_castle_moves(row * 8 + column, occupied, attacked, moves)
+
+    def castle_sides(self):
+        """
+        :return: king side, queen side castle rights of the side to move
+        """
+        rights = self.current_castling_rights
+        if self.white_to_move:
+            return rights.wKs, rights.wQs
+        return rights.bKs, rights.bQs
+
+    def castle_paths_empty(self, king_square, occupied):
+        """
+        Determine if a castle the rights allow has nothing between the king and the rook
+        """
+        king_side, queen_side = self.castle_sides()
+        return (king_side and not occupied & (3 << (king_square + 1))) or \
+            (queen_side and not occupied & (7 << (king_square - 3)))
+
+    def add_castle_moves(self, king_square, occupied, attacked, moves):
+        """
+        Adds the castle moves the castle rights allow, with empty squares up to the rook and
+        the king not passing over or landing on an attacked square
+        """
+        king_side, queen_side = self.castle_sides()
+        king = SQUARES[king_square]
+        if king_side and not (occupied | attacked) & (3 << (king_square + 1)):
+            moves.append(ChessEngine.Move(king, SQUARES[king_square + 2], self.board, is_castle_move=True))
+        if queen_side and not occupied & (7 << (king_square - 3)) and not attacked & (3 << (king_square - 2)):
+            moves.append(ChessEngine.Move(king, SQUARES[king_square - 2], self.board, is_castle_move=True))
+
+    def enpassant_is_safe(self, start, end, king_square, ally_color, enemy_color, occupied):
+        """
+        Determine if the en passant capture start -> end leaves the king safe.
+        Both pawns leave the rank at once, so the king is tested against the occupancy after the capture
+        """
+        captured = 1 << (start - start % 8 + end % 8)
+        after = occupied ^ (1 << start) ^ (1 << end) ^ captured
+        bitboards = self.bitboards
+        queens = bitboards[enemy_color + "Q"]
+        if rook_attacks(king_square, after) & (bitboards[enemy_color + "R"] | queens):
+            return False
+        if bishop_attacks(king_square, after) & (bitboards[enemy_color + "B"] | queens):
+            return False
+        if KNIGHT_ATTACKS[king_square] & bitboards[enemy_color + "N"]:
+            return False
+        return not PAWN_ATTACKS[ally_color][king_square] & (bitboards[enemy_color + "P"] ^ captured)
@@ -0,0 +1,207 @@
+"""
+Opening book: moves played from a position in a collection of games, looked up by the position's zobrist key.
+The book file is a sorted array of fixed size records, read through mmap and binary searched,
+so every process that opens it shares the one copy in the page cache and opening it costs nothing.
+
+Command line:
+    $ python ChessBook.py build games.pgn more_games.pgn -o book.bin --max-plies 20
+    $ python ChessBook.py probe book.bin --fen "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1"
+"""
+
+import argparse
+import mmap
+import os
+import random
+import struct
+import sys
+
+import ChessEngine
+import ChessPGN
+
+BOOK_MAGIC = b"CHSBOOK1"  # file header, followed by the records
+# zobrist key of the position, move_ID of the move, weight; sorted by key, then by weight (highest first)
+BOOK_RECORD = struct.Struct("<QHH")
+MAX_WEIGHT = 65535
+
+
+class OpeningBook:
+    """
+    Read only view of a book file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        if size < len(BOOK_MAGIC) or (size - len(BOOK_MAGIC)) % BOOK_RECORD.size:
+            self.file.close()
+            raise ValueError("Not a book file: " + path)
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(BOOK_MAGIC)] != BOOK_MAGIC:
+            self.close()
+            raise ValueError("Not a book file: " + path)
+        self.size = (size - len(BOOK_MAGIC)) // BOOK_RECORD.size
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        self.file.close()
+
+    def record(self, index):
+        return BOOK_RECORD.unpack_from(self.data, len(BOOK_MAGIC) + index * BOOK_RECORD.size)
+
+    def entries(self, key):
+        """
+        Binary search for the records of a position
+        :return: list of (move_ID, weight), highest weight first
+        """
+        low, high = 0, self.size
+        while low < high:  # first record with a key >= key
+            middle = (low + high) // 2
+            if self.record(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        entries = []
+        for index in range(low, self.size):
+            record_key, move_id, weight = self.record(index)
+            if record_key != key:
+                break
+            entries.append((move_id, weight))
+        return entries
+
+    def moves(self, gs):
+        """
+        Book moves of the current position of gs, as its valid Move objects
+        :return: list of (move, weight), highest weight first
+        """
+        entries = self.entries(gs.zobrist_key)
+        if not entries:
+            return []
+        checkmate, stalemate = gs.checkmate, gs.stalemate
+        valid_moves = {move.move_ID: move for move in gs.get_valid_moves()}
+        gs.checkmate, gs.stalemate = checkmate, stalemate
+        # a key collision or a book from another generator could name a move that isn't valid here
+        return [(valid_moves[move_id], weight) for move_id, weight in entries if move_id in valid_moves]
+
+    def choose_move(self, gs, rng=None, best=False):
+        """
+        Picks a book move for gs at random, in proportion to the weights (or the heaviest one if best is set)
+        :return: a valid Move, or None when the position isn't in the book
+        """
+        moves = self.moves(gs)
+        if not moves:
+            return None
+        if best:
+            return moves[0][0]
+        rng = rng or random
+        pick = rng.randrange(sum(weight for _, weight in moves))
+        for move, weight in moves:
+            if pick < weight:
+                return move
+            pick -= weight
+        return moves[0][0]
+
+
+def open_book(path):
+    """
+    :return: OpeningBook, or None if there is no book at path
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    return OpeningBook(path)
+
+
+def count_moves(games, max_plies=20, counts=None, backend="list"):
+    """
+    Adds up how often each move was played from each position in the first max_plies of the games.
+    A move scores 1 for being played and 1 more if the side that played it won
+    :param games: iterable of ChessPGN.PGNGame
+    :return: dict of (zobrist key, move_ID) -> weight, and the number of games that couldn't be replayed
+    """
+    counts = {} if counts is None else counts
+    skipped = 0
+    for game in games:
+        try:
+            gs = ChessEngine.GameState.from_fen(game.starting_fen(), backend)
+            for san in game.moves[:max_plies]:
+                move = ChessPGN.san_to_move(gs, san)
+                won = game.result == ("1-0" if gs.white_to_move else "0-1")
+                entry = (gs.zobrist_key, move.move_ID)
+                counts[entry] = counts.get(entry, 0) + (2 if won else 1)
+                gs.make_move(move)
+        except (ValueError, KeyError, IndexError):
+            skipped += 1  # moves before the bad one are still counted
+    return counts, skipped
+
+
+def write_book(path, counts, min_weight=1):
+    """
+    Writes the sorted book file (through a temporary file, so readers never see half a book)
+    :return: number of records written
+    """
+    records = sorted(((key, -min(weight, MAX_WEIGHT), move_id) for (key, move_id), weight in counts.items()
+                      if weight >= min_weight))
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as book_file:
+        book_file.write(BOOK_MAGIC)
+        for key, negative_weight, move_id in records:
+            book_file.write(BOOK_RECORD.pack(key, move_id, -negative_weight))
+    os.replace(temporary_path, path)
+    return len(records)
+
+
+def build_book(pgn_paths, path, max_plies=20, min_weight=1):
+    """
+    Compiles PGN files into a book file
+    :return: (records written, games that couldn't be replayed)
+    """
+    counts = {}
+    skipped = 0
+    for pgn_path in pgn_paths:
+        with open(pgn_path) as pgn_file:
+            skipped += count_moves(ChessPGN.read_games(pgn_file), max_plies, counts)[1]
+    return write_book(path, counts, min_weight), skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or look up an opening book")
+    commands = parser.add_subparsers(dest="command")
+    build = commands.add_parser("build", help="compile PGN files into a book")
+    build.add_argument("pgn", nargs="+", help="PGN files")
+    build.add_argument("-o", "--output", default="book.bin", help="book file to write")
+    build.add_argument("--max-plies", type=int, default=20, help="plies of each game that go into the book")
+    build.add_argument("--min-weight", type=int, default=1, help="leave out moves with a lower weight")
+    probe = commands.add_parser("probe", help="print the book moves of a position")
+    probe.add_argument("book", help="book file")
+    probe.add_argument("--fen", default=ChessPGN.START_FEN)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        records, skipped = build_book(args.pgn, args.output, args.max_plies, args.min_weight)
+        print("{} records written to {} ({} games skipped)".format(records, args.output, skipped))
+    elif args.command == "probe":
+        gs = ChessEngine.GameState.from_fen(args.fen)
+        with OpeningBook(args.book) as book:
+            moves = book.moves(gs)
+            for move, weight in moves:
+                print(ChessPGN.move_to_san(gs, move) + " " + str(weight))
+            if not moves:
+                print("not in book")
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,374 @@
+"""
+Game database indexed by position: every game that passed through a position, and the moves played from it.
+Games are replayed once when they are added and every position they reach is stored under its zobrist key
+in SQLite, so a lookup is an index range scan instead of replaying the archive:
+- positions: (key, game, ply, move played from it, NULL after the last move), clustered by key (see position_key)
+- moves: per (key, move) the number of times it was played and the results, kept up to date on ingest
+- games: the tags and result of every game, with a digest of its moves and tags so it is only added once
+
+Adding games replays them on a process pool (SQLite has one writer, the rows are written in bulk by this
+process, one transaction per batch); games that are already in the database are skipped.
+
+    with ChessDatabase.GameDatabase("games.db") as database:
+        database.add_pgn(["games.pgn"], processes=4)
+        for move, stats in database.move_stats(gs): ...
+
+Command line:
+    $ python ChessDatabase.py ingest games.pgn more_games.pgn -d games.db --processes 4
+    $ python ChessDatabase.py query -d games.db --moves e2e4 e7e5 --limit 10
+"""
+
+import argparse
+import functools
+import hashlib
+import itertools
+import multiprocessing
+import sqlite3
+import sys
+import time
+
+import ChessEngine
+import ChessHash
+import ChessPGN
+import ChessTablebase
+import ChessUCI
+
+BATCH_SIZE = 2000  # games replayed and written per transaction
+GAME_TAGS = ("Event", "Site", "Date", "Round", "White", "Black")  # tags with a column of their own
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    digest TEXT NOT NULL UNIQUE,
+    event TEXT, site TEXT, date TEXT, round TEXT, white TEXT, black TEXT,
+    result TEXT NOT NULL,
+    plies INTEGER NOT NULL,
+    fen TEXT NOT NULL,
+    moves TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS positions (
+    key INTEGER NOT NULL,
+    game INTEGER NOT NULL,
+    ply INTEGER NOT NULL,
+    move INTEGER,
+    PRIMARY KEY (key, game, ply)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS moves (
+    key INTEGER NOT NULL,
+    move INTEGER NOT NULL,
+    games INTEGER NOT NULL,
+    white_wins INTEGER NOT NULL,
+    draws INTEGER NOT NULL,
+    black_wins INTEGER NOT NULL,
+    PRIMARY KEY (key, move)
+) WITHOUT ROWID;
+"""
+RESULT_COLUMNS = {"1-0": 0, "1/2-1/2": 1, "0-1": 2}  # index of the result among white_wins, draws, black_wins
+
+
+def signed_key(key):
+    """
+    Zobrist key as the signed 64-bit integer SQLite stores
+    """
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+def position_key(gs):
+    """
+    Key the positions of gs are stored under: its zobrist key without the en passant square when
+    no pawn can capture there, so transpositions through a double step (1. Nf3 Nc6 2. e4 e5 and
+    1. e4 e5 2. Nf3 Nc6) are the same position
+    """
+    key = gs.zobrist_key
+    if gs.enpassant_possible != () and not ChessTablebase.enpassant_capture_possible(gs):
+        key ^= ChessHash.enpassant_key(gs.enpassant_possible)
+    return signed_key(key)
+
+
+def game_digest(game):
+    """
+    Identifies a PGNGame by its tags, moves and result, so the same game read again isn't added twice
+    """
+    text = "\n".join(name + "=" + value for name, value in sorted(game.headers.items()))
+    text += "\n" + " ".join(game.moves) + " " + game.result
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def index_game(game, backend="list"):
+    """
+    Replays a PGNGame: the position key before every move and the move played from it
+    (runs in the worker processes)
+    :return: list of (signed key, ply, move_ID or None after the last move), None if the game can't be replayed
+    """
+    try:
+        gs = ChessEngine.GameState.from_fen(game.starting_fen(), backend)
+        rows = []
+        for ply, san in enumerate(game.moves):
+            move = ChessPGN.san_to_move(gs, san)
+            rows.append((position_key(gs), ply, move.move_ID))
+            gs.make_move(move)
+        rows.append((position_key(gs), len(game.moves), None))
+        return rows
+    except (ValueError, KeyError, IndexError):
+        return None
+
+
+class MoveStats:
+    """
+    How often a move was played from a position and how those games ended
+    """
+    def __init__(self, games, white_wins, draws, black_wins):
+        self.games = games
+        self.white_wins = white_wins
+        self.draws = draws
+        self.black_wins = black_wins
+
+    def score(self, white):
+        """
+        Points per game for white (or black), a draw counting half
+        """
+        if not self.games:
+            return 0.0
+        wins = self.white_wins if white else self.black_wins
+        return (wins + self.draws / 2) / self.games
+
+
+class GameDatabase:
+    """
+    SQLite database of games indexed by position (created if the file doesn't exist)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")  # readers aren't blocked while games are added
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA cache_size=-65536")  # 64 MB
+        self.connection.executescript(SCHEMA)
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM games").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def has_game(self, digest):
+        return self.connection.execute("SELECT 1 FROM games WHERE digest = ?", (digest,)).fetchone() is not None
+
+    def add_games(self, games, processes=1, backend="list", batch_size=BATCH_SIZE, chunksize=64, progress=None):
+        """
+        Replays and indexes games that aren't in the database yet. The games are read lazily, a batch at a time;
+        with processes > 1 the next batch is replayed on a pool while this one is written
+
+        :param games: iterable of ChessPGN.PGNGame
+        :param processes: replaying processes, 0 for all cores
+        :param progress: called with (added, already there, failed) after every batch
+        :return: (games added, games already in the database, games that couldn't be replayed)
+        """
+        counts = [0, 0, 0]
+        games = iter(games)
+        unwritten = set()  # digests of the batches not written yet, which has_game can't see
+
+        def next_batch():
+            # list of (digest, game) to add from the next batch_size games, None when there are no more
+            read = list(itertools.islice(games, batch_size))
+            if not read:
+                return None
+            batch = []
+            for game in read:
+                digest = game_digest(game)
+                if digest in unwritten or self.has_game(digest):
+                    counts[1] += 1
+                else:
+                    unwritten.add(digest)
+                    batch.append((digest, game))
+            return batch
+
+        def write(batch, rows):
+            self.write_batch(batch, rows, counts)
+            unwritten.difference_update(digest for digest, _ in batch)
+            if progress is not None:
+                progress(*counts)
+
+        processes = processes or multiprocessing.cpu_count()
+        index = functools.partial(index_game, backend=backend)
+        if processes == 1:
+            batch = next_batch()
+            while batch is not None:
+                write(batch, [index(game) for _, game in batch])
+                batch = next_batch()
+            return tuple(counts)
+        with multiprocessing.Pool(processes) as pool:
+            batch = next_batch()
+            pending = pool.map_async(index, [game for _, game in batch], chunksize) if batch is not None else None
+            while batch is not None:
+                next_games = next_batch()
+                next_pending = None
+                if next_games is not None:
+                    next_pending = pool.map_async(index, [game for _, game in next_games], chunksize)
+                write(batch, pending.get())
+                batch, pending = next_games, next_pending
+        return tuple(counts)
+
+    def add_pgn(self, pgn_paths, processes=1, backend="list", progress=None):
+        """
+        add_games with the games of PGN files
+        """
+        return self.add_games(read_pgn_files(pgn_paths), processes, backend, progress=progress)
+
+    def write_batch(self, batch, indexed, counts):
+        """
+        Inserts a batch of replayed games in one transaction: the games, their positions (sorted by key,
+        so the inserts go to neighbouring pages) and the move totals added onto the ones stored
+        :param indexed: index_game() of each game of the batch
+        :param counts: [added, already there, failed], updated
+        """
+        positions = []
+        totals = {}  # (key, move_ID) -> [games, white wins, draws, black wins]
+        with self.connection:
+            for (digest, game), rows in zip(batch, indexed):
+                if rows is None:
+                    counts[2] += 1
+                    continue
+                tags = [game.headers.get(tag) for tag in GAME_TAGS]
+                game_id = self.connection.execute(
+                    "INSERT INTO games (digest, event, site, date, round, white, black, result, plies, fen, moves) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [digest] + tags + [game.result, len(game.moves), game.starting_fen(), " ".join(game.moves)]
+                ).lastrowid
+                result_column = RESULT_COLUMNS.get(game.result)
+                for key, ply, move_id in rows:
+                    positions.append((key, game_id, ply, move_id))
+                    if move_id is None:
+                        continue
+                    total = totals.get((key, move_id))
+                    if total is None:
+                        total = totals[(key, move_id)] = [0, 0, 0, 0]
+                    total[0] += 1
+                    if result_column is not None:
+                        total[result_column + 1] += 1
+                counts[0] += 1
+            positions.sort(key=lambda row: (row[0], row[1], row[2]))
+            self.connection.executemany("INSERT INTO positions (key, game, ply, move) VALUES (?, ?, ?, ?)",
+                                        positions)
+            self.connection.executemany(
+                "INSERT INTO moves (key, move, games, white_wins, draws, black_wins) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (key, move) DO UPDATE SET games = games + excluded.games, "
+                "white_wins = white_wins + excluded.white_wins, draws = draws + excluded.draws, "
+                "black_wins = black_wins + excluded.black_wins",
+                sorted(key + tuple(total) for key, total in totals.items()))
+
+    def games_with_position(self, gs, limit=None, offset=0):
+        """
+        Ids of the games that reached the current position of gs, in the order they were added
+        """
+        rows = self.connection.execute(
+            "SELECT DISTINCT game FROM positions WHERE key = ? ORDER BY game LIMIT ? OFFSET ?",
+            (position_key(gs), -1 if limit is None else limit, offset))
+        return [row[0] for row in rows]
+
+    def count_games_with_position(self, gs):
+        return self.connection.execute("SELECT COUNT(DISTINCT game) FROM positions WHERE key = ?",
+                                       (position_key(gs),)).fetchone()[0]
+
+    def move_stats(self, gs):
+        """
+        Moves played from the current position of gs, as its valid Move objects
+        :return: list of (move, MoveStats), most played first
+        """
+        rows = self.connection.execute(
+            "SELECT move, games, white_wins, draws, black_wins FROM moves WHERE key = ? ORDER BY games DESC",
+            (position_key(gs),)).fetchall()
+        if not rows:
+            return []
+        checkmate, stalemate = gs.checkmate, gs.stalemate
+        valid_moves = {move.move_ID: move for move in gs.get_valid_moves()}
+        gs.checkmate, gs.stalemate = checkmate, stalemate
+        # a key collision could name a move that isn't valid here
+        return [(valid_moves[row[0]], MoveStats(*row[1:])) for row in rows if row[0] in valid_moves]
+
+    def game(self, game_id):
+        """
+        :return: dict of the tags (lower case), result, plies, starting fen and moves (SAN) of a game,
+                 None if there is no such game
+        """
+        cursor = self.connection.execute(
+            "SELECT id, event, site, date, round, white, black, result, plies, fen, moves FROM games WHERE id = ?",
+            (game_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        game = dict(zip([column[0] for column in cursor.description], row))
+        game["moves"] = game["moves"].split() if game["moves"] else []
+        return game
+
+
+def read_pgn_files(pgn_paths):
+    """
+    Generator over the games of several PGN files, one after the other
+    """
+    for pgn_path in pgn_paths:
+        with open(pgn_path) as pgn_file:
+            yield from ChessPGN.read_games(pgn_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index games by position, or look up a position")
+    commands = parser.add_subparsers(dest="command")
+    ingest = commands.add_parser("ingest", help="add the games of PGN files (games already there are skipped)")
+    ingest.add_argument("pgn", nargs="+", help="PGN files")
+    ingest.add_argument("-d", "--database", default="games.db", help="database file")
+    ingest.add_argument("--processes", type=int, default=1, help="replaying processes (0 for all cores)")
+    ingest.add_argument("--backend", choices=ChessEngine.BACKENDS, default="list")
+    query = commands.add_parser("query", help="print the moves played from a position and the games reaching it")
+    query.add_argument("-d", "--database", default="games.db", help="database file")
+    query.add_argument("--fen", default=ChessPGN.START_FEN)
+    query.add_argument("--moves", nargs="*", default=[], help="moves played from the fen, e.g. e2e4 e7e5")
+    query.add_argument("--limit", type=int, default=10, help="games to list")
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        start = time.perf_counter()
+
+        def progress(added, existing, failed):
+            print("{} added, {} already indexed, {} failed ({:.1f}s)".format(
+                added, existing, failed, time.perf_counter() - start), file=sys.stderr)
+        with GameDatabase(args.database) as database:
+            added, existing, failed = database.add_pgn(args.pgn, args.processes, args.backend, progress)
+        seconds = time.perf_counter() - start
+        print("{} games added, {} already indexed, {} couldn't be replayed in {:.1f}s ({:.0f} games/s)".format(
+            added, existing, failed, seconds, added / seconds if seconds else 0))
+    elif args.command == "query":
+        try:
+            gs = ChessEngine.GameState.from_fen(args.fen)
+            for text in args.moves:
+                gs.make_move(ChessUCI.uci_to_move(gs, text))
+        except ValueError as error:
+            parser.error(str(error))
+        with GameDatabase(args.database) as database:
+            start = time.perf_counter()
+            count = database.count_games_with_position(gs)
+            moves = database.move_stats(gs)
+            game_ids = database.games_with_position(gs, args.limit)
+            milliseconds = (time.perf_counter() - start) * 1000
+            print("{} games reached the position ({:.1f} ms)".format(count, milliseconds))
+            for move, stats in moves:
+                print("{} {} games, {:.0%} for {}".format(ChessPGN.move_to_san(gs, move), stats.games,
+                                                         stats.score(gs.white_to_move),
+                                                         "white" if gs.white_to_move else "black"))
+            for game_id in game_ids:
+                game = database.game(game_id)
+                print("#{} {} - {} {} ({} plies)".format(game_id, game["white"], game["black"], game["result"],
+                                                        game["plies"]))
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
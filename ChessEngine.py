@@ -1,10 +1,81 @@
+import struct
+from collections import OrderedDict
+
+import ChessHash
+
+BACKENDS = ("list", "bitboard")  # board representations GameState can be constructed with
+PROMOTION_PIECES = ("Q", "R", "B", "N")
+# flags of Move.code
+PROMOTION_CODES = {piece: (index + 1) << 12 for index, piece in enumerate(PROMOTION_PIECES)}
+PROMOTION_MASK = 7 << 12
+ENPASSANT_FLAG = 1 << 15
+CASTLE_FLAG = 1 << 16
+MOVE_ID_MASK = (1 << 15) - 1
+VICTIM_ORDER = ("Q", "R", "B", "N", "P")  # staged captures come most valuable victim first
+ATTACKER_ORDER = {"P": 0, "N": 1, "B": 2, "R": 3, "Q": 4, "K": 5}  # then least valuable attacker first
+LAZY_PIECE_ORDER = ("K", "N", "P", "B", "R", "Q")  # pieces iter_valid_moves tries, most often able to move first
+PIECE_NAMES = ("wP", "wN", "wB", "wR", "wQ", "wK", "bP", "bN", "bB", "bR", "bQ", "bK")
+# GameState.snapshot(): version, board (a 4-bit piece code per square, two squares per byte),
+# flags (side to move, castle rights, checkmate, stalemate), en passant square (255 for none),
+# halfmove clock, fullmove number; then a 32-bit Move.code per move if the history is included
+SNAPSHOT_VERSION = 1
+SNAPSHOT_RECORD = struct.Struct("<B32sBBHH")
+SNAPSHOT_PIECES = ("--",) + PIECE_NAMES  # piece code -> piece
+SNAPSHOT_CODES = {piece: code for code, piece in enumerate(SNAPSHOT_PIECES)}
+
+
+def jump_squares(square, offsets):
+    """
+    Squares (row * 8 + column) reached from square by each (row, column) offset that stays on the board
+    """
+    row, column = square >> 3, square & 7
+    return frozenset((row + d_row) * 8 + column + d_column for d_row, d_column in offsets
+                     if 0 <= row + d_row < 8 and 0 <= column + d_column < 8)
+
+
+def squares_between(start, end, diagonal):
+    """
+    Squares strictly between start and end if they share a diagonal (diagonal=True) or a rank or file
+    :return: tuple of squares, None if start and end aren't lined up that way
+    """
+    d_row, d_column = (end >> 3) - (start >> 3), (end & 7) - (start & 7)
+    if start == end or (abs(d_row) != abs(d_column) if diagonal else d_row != 0 and d_column != 0):
+        return None
+    step = ((d_row > 0) - (d_row < 0)) * 8 + (d_column > 0) - (d_column < 0)
+    return tuple(start + step * i for i in range(1, max(abs(d_row), abs(d_column))))
+
+
+KNIGHT_JUMPS = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1))
+KING_STEPS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+KNIGHT_SQUARES = [jump_squares(square, KNIGHT_JUMPS) for square in range(64)]
+KING_SQUARES = [jump_squares(square, KING_STEPS) for square in range(64)]
+# squares a pawn of each color attacks a square from (a white pawn from the row below)
+PAWN_ATTACK_SQUARES = {"w": [jump_squares(square, ((1, -1), (1, 1))) for square in range(64)],
+                       "b": [jump_squares(square, ((-1, -1), (-1, 1))) for square in range(64)]}
+# [square][other square] -> squares in between along a rank or file / a diagonal, None if not lined up
+ORTHOGONAL_LINES = [[squares_between(start, end, False) for end in range(64)] for start in range(64)]
+DIAGONAL_LINES = [[squares_between(start, end, True) for end in range(64)] for start in range(64)]
+
+
 class GameState:
     """
     This class is responsible for storing all information about the current state of a chess game.
     Responsible for determining valid moves at the current state.
     Also keeps a move log.
+
+    GameState() keeps the board as an 8x8 list of strings and generates moves from it.
+    GameState(backend="bitboard") also keeps 64-bit boards per piece and generates moves from those
+    (see ChessBitboard.py); both give the same moves through the same API
     """
-    def __init__(self):
+    def __new__(cls, backend="list"):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend: " + str(backend))
+        if cls is GameState and backend == "bitboard":
+            import ChessBitboard  # imported here, ChessBitboard builds on this module
+            cls = ChessBitboard.BitboardGameState
+        return object.__new__(cls)
+
+    def __init__(self, backend="list"):
 
         # board is an 8x8 2d list, with each element containing 2 characters
         # first character is the color of the piece (black or white)
@@ -31,43 +102,401 @@ class GameState:
         self.current_castling_rights = CastleRights(True, True, True, True)
         self.castle_rights_log = [CastleRights(self.current_castling_rights.wKs, self.current_castling_rights.bKs, 
                                                self.current_castling_rights.wQs, self.current_castling_rights.bQs)]
+        self.enpassant_possible_log = [self.enpassant_possible]
+        self.piece_squares = self.find_piece_squares()  # piece -> set of squares (row * 8 + column) it stands on
+        self.zobrist_key = self.compute_zobrist_key()  # 64-bit key of the position, kept up to date by make_move
+        self.zobrist_key_log = []
+        self.move_cache = None  # MoveCache of valid moves by position, off by default
+        self.start_halfmove_clock = 0  # move counters of the starting position (for FEN)
+        self.start_fullmove_number = 1
+        self.backend = backend
+        self.start_record = self.position_record(0, 1)  # snapshot of the starting position, for snapshot()
+        # draw rules, kept up to date by make_move/undo_move
+        self.halfmove_clock_log = [0]  # plies since the last pawn move or capture, after each move
+        self.repetition_counts = {self.zobrist_key: 1}  # position key -> times seen since the last pawn move or capture
+        self.repetition_counts_log = []  # the counts from before each pawn move or capture
+        self.draw_by_repetition = False
+        self.draw_by_fifty_moves = False
+        self.draw_by_insufficient_material = False
+
+    @classmethod
+    def from_fen(cls, fen, backend="list"):
+        """
+        Sets up a game from a FEN string,
+        e.g. "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1"
+        The move counters at the end are optional
+        :raises ValueError: if it isn't a FEN string, or the side to move isn't "w" or "b",
+                            or a side doesn't have exactly one king
+        """
+        fields = fen.split()
+        if len(fields) < 4:
+            raise ValueError("Invalid FEN: " + fen)
+        if fields[1] not in ("w", "b"):
+            raise ValueError("Invalid side to move in FEN: " + fields[1])
+        board = []
+        for rank in fields[0].split("/"):
+            row = []
+            for char in rank:
+                if char.isdigit():
+                    row += ["--"] * int(char)
+                elif char.upper() in "KQRBNP":
+                    row.append(("w" if char.isupper() else "b") + char.upper())
+                else:
+                    raise ValueError("Invalid piece in FEN: " + char)
+            board.append(row)
+        if len(board) != 8 or any(len(row) != 8 for row in board):
+            raise ValueError("FEN board is not 8x8: " + fields[0])
+        for king in ("wK", "bK"):
+            if sum(row.count(king) for row in board) != 1:
+                raise ValueError("FEN board needs one king of each color: " + fields[0])
+        gs = cls(backend)
+        gs.board = board
+        gs.white_to_move = fields[1] == "w"
+        castling = fields[2]
+        gs.current_castling_rights = CastleRights("K" in castling, "k" in castling, "Q" in castling, "q" in castling)
+        if fields[3] == "-":
+            gs.enpassant_possible = ()
+        else:
+            gs.enpassant_possible = (Move.ranks_to_rows[fields[3][1]], Move.files_to_columns[fields[3][0]])
+        if len(fields) >= 6:
+            gs.start_halfmove_clock = int(fields[4])
+            gs.start_fullmove_number = int(fields[5])
+        gs.sync_position()
+        return gs
+
+    def to_fen(self):
+        """
+        Describes the current position as a FEN string
+        """
+        ranks = []
+        for row in self.board:
+            rank = ""
+            empty = 0
+            for piece in row:
+                if piece == "--":
+                    empty += 1
+                    continue
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                rank += piece[1] if piece[0] == "w" else piece[1].lower()
+            if empty:
+                rank += str(empty)
+            ranks.append(rank)
+        rights = self.current_castling_rights
+        castling = ("K" if rights.wKs else "") + ("Q" if rights.wQs else "") + \
+                   ("k" if rights.bKs else "") + ("q" if rights.bQs else "")
+        if self.enpassant_possible == ():
+            enpassant = "-"
+        else:
+            enpassant = Move.columns_to_files[self.enpassant_possible[1]] + Move.row_to_ranks[self.enpassant_possible[0]]
+        return " ".join(["/".join(ranks), "w" if self.white_to_move else "b", castling or "-", enpassant,
+                         str(self.halfmove_clock()), str(self.fullmove_number())])
+
+    def halfmove_clock(self):
+        """
+        Plies since the last pawn move or capture
+        """
+        return self.halfmove_clock_log[-1]
+
+    def repetitions(self):
+        """
+        Times the current position occurred since the last pawn move or capture, this time included
+        """
+        return self.repetition_counts.get(self.zobrist_key, 0)
+
+    def is_draw(self):
+        """
+        Whether the game is drawn by threefold repetition, the fifty-move rule or insufficient material
+        (stalemate is gs.stalemate, set by get_valid_moves)
+        """
+        return self.draw_by_repetition or self.draw_by_fifty_moves or self.draw_by_insufficient_material
+
+    def has_insufficient_material(self):
+        """
+        Whether neither side can ever checkmate: kings with at most one knight or bishop between them,
+        or with only bishops that all stand on squares of one color
+        """
+        piece_squares = self.piece_squares
+        for piece in ("wP", "bP", "wR", "bR", "wQ", "bQ"):
+            if piece_squares[piece]:
+                return False
+        knights = len(piece_squares["wN"]) + len(piece_squares["bN"])
+        bishops = piece_squares["wB"] | piece_squares["bB"]
+        if knights + len(bishops) <= 1:
+            return True
+        return knights == 0 and len({((square >> 3) + (square & 7)) % 2 for square in bishops}) == 1
+
+    def fullmove_number(self):
+        """
+        Move number as in FEN, goes up after every black move
+        """
+        plies = len(self.move_log)
+        started_white = self.white_to_move == (plies % 2 == 0)
+        return self.start_fullmove_number + (plies if started_white else plies + 1) // 2
+
+    @classmethod
+    def from_snapshot(cls, snapshot, backend="list"):
+        """
+        New game from the bytes of GameState.snapshot()
+        """
+        gs = cls(backend)
+        gs.restore(snapshot)
+        return gs
+
+    def snapshot(self, with_history=False):
+        """
+        Compact binary copy of the game (see SNAPSHOT_RECORD): 39 bytes for the position.
+        with_history adds 4 bytes per move, the record is then of the starting position and
+        restore() plays the moves again, so the move log and undo come back too
+        :return: bytes
+        """
+        if not with_history or not self.move_log:
+            return self.position_record(self.halfmove_clock(), self.fullmove_number())
+        version, board, flags, enpassant, _, _ = SNAPSHOT_RECORD.unpack(self.start_record)
+        flags = flags & 31 | self.checkmate << 5 | self.stalemate << 6  # the game's current status
+        codes = [move.code for move in self.move_log]
+        return SNAPSHOT_RECORD.pack(version, board, flags, enpassant, self.start_halfmove_clock,
+                                    self.start_fullmove_number) + struct.pack("<" + str(len(codes)) + "I", *codes)
+
+    def position_record(self, halfmove_clock, fullmove_number):
+        codes = [SNAPSHOT_CODES[piece] for row in self.board for piece in row]
+        board = bytes([codes[square] | codes[square + 1] << 4 for square in range(0, 64, 2)])
+        flags = self.white_to_move | ChessHash.castle_rights_index(self.current_castling_rights) << 1 | \
+            self.checkmate << 5 | self.stalemate << 6
+        if self.enpassant_possible == ():
+            enpassant = 255
+        else:
+            enpassant = self.enpassant_possible[0] * 8 + self.enpassant_possible[1]
+        return SNAPSHOT_RECORD.pack(SNAPSHOT_VERSION, board, flags, enpassant, halfmove_clock, fullmove_number)
+
+    def restore(self, snapshot):
+        """
+        Sets the game back to a snapshot() (starts a new move log, unless the snapshot has the history)
+        :raises ValueError: if the bytes aren't a snapshot
+        """
+        if len(snapshot) < SNAPSHOT_RECORD.size or (len(snapshot) - SNAPSHOT_RECORD.size) % 4:
+            raise ValueError("Invalid snapshot length: " + str(len(snapshot)))
+        version, board, flags, enpassant, halfmove_clock, fullmove_number = SNAPSHOT_RECORD.unpack_from(snapshot)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError("Unknown snapshot version: " + str(version))
+        pieces = []
+        for byte in board:
+            pieces.append(SNAPSHOT_PIECES[byte & 15])
+            pieces.append(SNAPSHOT_PIECES[byte >> 4])
+        self.board = [pieces[row * 8:row * 8 + 8] for row in range(8)]
+        self.white_to_move = bool(flags & 1)
+        self.current_castling_rights = CastleRights(bool(flags & 2), bool(flags & 4), bool(flags & 8),
+                                                    bool(flags & 16))
+        self.enpassant_possible = () if enpassant == 255 else (enpassant >> 3, enpassant & 7)
+        self.start_halfmove_clock = halfmove_clock
+        self.start_fullmove_number = fullmove_number
+        self.sync_position()
+        moves = (len(snapshot) - SNAPSHOT_RECORD.size) // 4
+        for code in struct.unpack_from("<" + str(moves) + "I", snapshot, SNAPSHOT_RECORD.size):
+            self.make_move(Move.from_code(code, self.board))
+        self.checkmate = bool(flags & 32)
+        self.stalemate = bool(flags & 64)
+
+    def clone(self):
+        """
+        Independent copy of the game, much cheaper than copy.deepcopy: only the board and the lists are copied,
+        the moves and log entries in them never change and are shared. The copy has no move_cache
+        """
+        clone = object.__new__(type(self))
+        clone.__dict__.update(self.__dict__)
+        clone.board = [row[:] for row in self.board]
+        clone.move_functions = {piece: getattr(clone, function.__name__)
+                                for piece, function in self.move_functions.items()}
+        clone.move_log = self.move_log[:]
+        rights = self.current_castling_rights
+        clone.current_castling_rights = CastleRights(rights.wKs, rights.bKs, rights.wQs, rights.bQs)
+        clone.castle_rights_log = self.castle_rights_log[:]
+        clone.enpassant_possible_log = self.enpassant_possible_log[:]
+        clone.piece_squares = {piece: set(squares) for piece, squares in self.piece_squares.items()}
+        clone.zobrist_key_log = self.zobrist_key_log[:]
+        clone.halfmove_clock_log = self.halfmove_clock_log[:]
+        clone.repetition_counts = dict(self.repetition_counts)
+        clone.repetition_counts_log = [dict(counts) for counts in self.repetition_counts_log]
+        clone.move_cache = None
+        return clone
+
+    def __deepcopy__(self, memo):
+        clone = self.clone()
+        if self.move_cache is not None:
+            clone.move_cache = MoveCache(self.move_cache.max_size)
+        return clone
+
+    def __reduce__(self):
+        # pickles as the snapshot with history, a few bytes per move
+        return GameState.from_snapshot, (self.snapshot(True), self.backend)
+
+    def sync_position(self):
+        """
+        Recomputes everything that follows from board, white_to_move, current_castling_rights and
+        enpassant_possible after they were set directly (e.g. from a FEN string). Starts a new move log
+        """
+        for row in range(8):
+            for column in range(8):
+                if self.board[row][column] == "wK":
+                    self.white_king_location = (row, column)
+                elif self.board[row][column] == "bK":
+                    self.black_king_location = (row, column)
+        self.move_log = []
+        self.checkmate = False
+        self.stalemate = False
+        self.castle_rights_log = [CastleRights(self.current_castling_rights.wKs, self.current_castling_rights.bKs,
+                                               self.current_castling_rights.wQs, self.current_castling_rights.bQs)]
+        self.enpassant_possible_log = [self.enpassant_possible]
+        self.piece_squares = self.find_piece_squares()
+        self.zobrist_key = self.compute_zobrist_key()
+        self.zobrist_key_log = []
+        self.start_record = self.position_record(0, 1)
+        self.halfmove_clock_log = [self.start_halfmove_clock]
+        self.repetition_counts = {self.zobrist_key: 1}
+        self.repetition_counts_log = []
+        self.draw_by_repetition = False
+        self.draw_by_fifty_moves = self.start_halfmove_clock >= 100
+        self.draw_by_insufficient_material = self.has_insufficient_material()
+
+    def find_piece_squares(self):
+        """
+        Squares of every piece on the board, found by scanning it (make_move/undo_move keep them up to date)
+        :return: dict of piece -> set of squares (row * 8 + column)
+        """
+        piece_squares = {piece: set() for piece in PIECE_NAMES}
+        for row in range(8):
+            for column in range(8):
+                if self.board[row][column] != "--":
+                    piece_squares[self.board[row][column]].add(row * 8 + column)
+        return piece_squares
 
     def make_move(self, move):
         """
-        Takes a move and executes it (does not work for castling, pawn promotion, and en-passant)
+        Takes a move and executes it (including castling, pawn promotion, and en-passant)
         """
-        self.board[move.start_row][move.start_column] = "--"
-        self.board[move.end_row][move.end_column] = move.piece_moved
+        code = move.code
+        start, end = code & 63, code >> 6 & 63
+        start_row, start_column, end_row, end_column = start >> 3, start & 7, end >> 3, end & 7
+        piece_moved = move.piece_moved
+        board = self.board
+        self.zobrist_key_log.append(self.zobrist_key)
+        old_rights_index = ChessHash.castle_rights_index(self.current_castling_rights)
+        old_enpassant_key = ChessHash.enpassant_key(self.enpassant_possible)
+        board[start_row][start_column] = "--"
+        board[end_row][end_column] = piece_moved
         self.move_log.append(move) 
         self.white_to_move = not self.white_to_move  # switching turns
         # update king's location if moved
-        if move.piece_moved == "wK":
-            self.white_king_location = (move.end_row, move.end_column)
-        elif move.piece_moved == "bK":
-            self.black_king_location = (move.end_row, move.end_column)
-        # pawn promotion
-        if move.is_pawn_promotion:
-            self.board[move.end_row][move.end_column] = move.piece_moved[0] + 'Q'
-        # en passant 
-        if move.is_enpassant_move:
-            self.board[move.start_row][move.end_column] = "--"  # capturing the pawn
+        if piece_moved == "wK":
+            self.white_king_location = (end_row, end_column)
+        elif piece_moved == "bK":
+            self.black_king_location = (end_row, end_column)
+        flags = code >> 12  # 0 for anything but promotions, en passant and castling
+        if flags:
+            # pawn promotion
+            if code & PROMOTION_MASK:
+                board[end_row][end_column] = piece_moved[0] + PROMOTION_PIECES[(flags & 7) - 1]
+            # en passant 
+            elif code & ENPASSANT_FLAG:
+                board[start_row][end_column] = "--"  # capturing the pawn
+            # castling
+            elif end_column - start_column == 2:  # king side caslte
+                board[end_row][end_column-1] = board[end_row][end_column+1]
+                board[end_row][end_column+1] = "--"
+            else:  # queen side castle
+                board[end_row][end_column+1] = board[end_row][end_column-2]
+                board[end_row][end_column-2] = "--"
+        # update piece squares
+        piece_squares = self.piece_squares
+        piece_squares[piece_moved].remove(start)
+        piece_squares[board[end_row][end_column]].add(end)
+        if move.piece_captured != "--":
+            piece_squares[move.piece_captured].remove(start_row * 8 + end_column if code & ENPASSANT_FLAG else end)
+        if flags and code & CASTLE_FLAG:
+            self.move_castle_rook_square(end, end_column - start_column == 2, False)
         # update enpassant_possible 
-        if move.piece_moved[1] == "P" and abs(move.start_row - move.end_row) == 2:
-            self.enpassant_possible = ((move.start_row + move.end_row)//2, move.end_column)
+        if piece_moved[1] == "P" and abs(start_row - end_row) == 2:
+            self.enpassant_possible = ((start_row + end_row)//2, end_column)
         else:
             self.enpassant_possible = ()
-        # castling
-        if move.is_castle_move:
-            if move.end_column - move.start_column == 2:  # king side caslte
-                self.board[move.end_row][move.end_column-1] = self.board[move.end_row][move.end_column+1]
-                self.board[move.end_row][move.end_column+1] = "--"
-            else:  # queen side castle
-                self.board[move.end_row][move.end_column+1] = self.board[move.end_row][move.end_column-2]
-                self.board[move.end_row][move.end_column-2] = "--"
-        # update castling rights
-        self.update_castle_rights(move)
-        self.castle_rights_log.append(CastleRights(self.current_castling_rights.wKs, self.current_castling_rights.bKs, 
-                                                   self.current_castling_rights.wQs, self.current_castling_rights.bQs))
+        # update castling rights (log entries are never changed, so the last one is shared while the rights stay)
+        if old_rights_index:
+            self.update_castle_rights(move)
+            rights_index = ChessHash.castle_rights_index(self.current_castling_rights)
+        else:
+            rights_index = 0
+        if rights_index == old_rights_index:
+            self.castle_rights_log.append(self.castle_rights_log[-1])
+        else:
+            self.castle_rights_log.append(CastleRights(self.current_castling_rights.wKs,
+                                                       self.current_castling_rights.bKs,
+                                                       self.current_castling_rights.wQs,
+                                                       self.current_castling_rights.bQs))
+        self.enpassant_possible_log.append(self.enpassant_possible)
+        # update the position key with everything that changed
+        piece_keys = ChessHash.PIECE_KEYS
+        key = self.zobrist_key ^ ChessHash.BLACK_TO_MOVE_KEY
+        key ^= piece_keys[piece_moved][start]
+        key ^= piece_keys[board[end_row][end_column]][end]
+        if move.piece_captured != "--":
+            if flags and code & ENPASSANT_FLAG:
+                key ^= piece_keys[move.piece_captured][start_row * 8 + end_column]
+            else:
+                key ^= piece_keys[move.piece_captured][end]
+        if flags and code & CASTLE_FLAG:
+            if end_column - start_column == 2:  # king side, rook from h to f
+                rook_from, rook_to = end_column + 1, end_column - 1
+            else:  # queen side, rook from a to d
+                rook_from, rook_to = end_column - 2, end_column + 1
+            rook = board[end_row][rook_to]
+            if rook != "--":
+                key ^= piece_keys[rook][end_row * 8 + rook_from] ^ piece_keys[rook][end_row * 8 + rook_to]
+        if rights_index != old_rights_index:
+            key ^= ChessHash.CASTLE_KEYS[old_rights_index] ^ ChessHash.CASTLE_KEYS[rights_index]
+        key ^= old_enpassant_key ^ ChessHash.enpassant_key(self.enpassant_possible)
+        self.zobrist_key = key
+        # draw rules: a pawn move or capture starts a new count, nothing before it can come back
+        if piece_moved[1] == "P" or move.piece_captured != "--":
+            self.halfmove_clock_log.append(0)
+            self.repetition_counts_log.append(self.repetition_counts)
+            self.repetition_counts = {key: 1}
+            self.draw_by_repetition = False
+            self.draw_by_fifty_moves = False
+            if move.piece_captured != "--" or code & PROMOTION_MASK:
+                self.draw_by_insufficient_material = self.has_insufficient_material()
+        else:
+            halfmove_clock = self.halfmove_clock_log[-1] + 1
+            self.halfmove_clock_log.append(halfmove_clock)
+            counts = self.repetition_counts
+            counts[key] = counts.get(key, 0) + 1
+            self.draw_by_repetition = counts[key] >= 3
+            self.draw_by_fifty_moves = halfmove_clock >= 100
+
+    def move_castle_rook_square(self, king_end, king_side, undo):
+        """
+        Moves the castling rook in the piece squares (board holds the position after the castle)
+        """
+        if king_side:  # rook from h to f
+            rook_from, rook_to = king_end + 1, king_end - 1
+        else:  # rook from a to d
+            rook_from, rook_to = king_end - 2, king_end + 1
+        rook = self.board[rook_to >> 3][rook_to & 7]
+        if rook != "--":  # no rook if the castle rights were set up without one
+            squares = self.piece_squares[rook]
+            if undo:
+                squares.remove(rook_to)
+                squares.add(rook_from)
+            else:
+                squares.remove(rook_from)
+                squares.add(rook_to)
+
+    def compute_zobrist_key(self):
+        """
+        Computes the position key from scratch (make_move/undo_move keep it up to date)
+        """
+        return ChessHash.zobrist_key(self.board, self.white_to_move, self.current_castling_rights,
+                                     self.enpassant_possible)
 
     def undo_move(self):
         """
@@ -75,95 +504,276 @@ class GameState:
         """
         if len(self.move_log) != 0:  # make sure that there is a move to undo
             move = self.move_log.pop()
-            self.board[move.start_row][move.start_column] = move.piece_moved
-            self.board[move.end_row][move.end_column] = move.piece_captured
+            code = move.code
+            start, end = code & 63, code >> 6 & 63
+            start_row, start_column, end_row, end_column = start >> 3, start & 7, end >> 3, end & 7
+            board = self.board
+            flags = code >> 12
+            # update piece squares
+            piece_squares = self.piece_squares
+            piece_squares[board[end_row][end_column]].remove(end)
+            piece_squares[move.piece_moved].add(start)
+            if move.piece_captured != "--":
+                piece_squares[move.piece_captured].add(start_row * 8 + end_column if code & ENPASSANT_FLAG else end)
+            if flags and code & CASTLE_FLAG:
+                self.move_castle_rook_square(end, end_column - start_column == 2, True)
+            board[start_row][start_column] = move.piece_moved
+            board[end_row][end_column] = move.piece_captured
             self.white_to_move = not self.white_to_move  # switching turns
             # update king's location if moved
             if move.piece_moved == "wK":
-                self.white_king_location = (move.start_row, move.start_column)
+                self.white_king_location = (start_row, start_column)
             elif move.piece_moved == "bK":
-                self.black_king_location = (move.start_row, move.start_column)
+                self.black_king_location = (start_row, start_column)
             # undo en passant move
-            if move.is_enpassant_move:
-                self.board[move.end_row][move.end_column] = "--"  # leave landing square blank
-                self.board[move.start_row][move.end_column] = move.piece_captured
-                self.enpassant_possible = (move.end_row, move.end_column)
-            # undo a 2 square pawn advance
-            if move.piece_moved[1] == "P" and abs(move.start_row - move.end_row) == 2:
-                self.enpassant_possible = ()
+            if flags and code & ENPASSANT_FLAG:
+                board[end_row][end_column] = "--"  # leave landing square blank
+                board[start_row][end_column] = move.piece_captured
+            # undo enpassant_possible
+            self.enpassant_possible_log.pop()
+            self.enpassant_possible = self.enpassant_possible_log[-1]
             # undo castling rights
-            self.castle_rights_log.pop()
+            old_rights = self.castle_rights_log.pop()
             new_rights = self.castle_rights_log[-1]
-            self.current_castling_rights = CastleRights(new_rights.wKs, new_rights.bKs, new_rights.wQs, new_rights.bQs)
+            if new_rights is not old_rights:  # the same entry means the move didn't change them
+                self.current_castling_rights = CastleRights(new_rights.wKs, new_rights.bKs, new_rights.wQs,
+                                                            new_rights.bQs)
             # undo castle move
-            if move.is_castle_move:
-                if move.end_column - move.start_column == 2:  # king side
-                    self.board[move.end_row][move.end_column+1] = self.board[move.end_row][move.end_column-1]
-                    self.board[move.end_row][move.end_column-1] = "--"
+            if flags and code & CASTLE_FLAG:
+                if end_column - start_column == 2:  # king side
+                    board[end_row][end_column+1] = board[end_row][end_column-1]
+                    board[end_row][end_column-1] = "--"
                 else:  # queen side
-                    self.board[move.end_row][move.end_column-2] = self.board[move.end_row][move.end_column+1]
-                    self.board[move.end_row][move.end_column+1] = "--"
+                    board[end_row][end_column-2] = board[end_row][end_column+1]
+                    board[end_row][end_column+1] = "--"
+            # draw rules
+            counts = self.repetition_counts
+            if self.halfmove_clock_log.pop() == 0:
+                self.repetition_counts = counts = self.repetition_counts_log.pop()
+                if move.piece_captured != "--" or code & PROMOTION_MASK:
+                    self.draw_by_insufficient_material = self.has_insufficient_material()
+            elif counts[self.zobrist_key] == 1:
+                del counts[self.zobrist_key]
+            else:
+                counts[self.zobrist_key] -= 1
+            self.zobrist_key = self.zobrist_key_log.pop()
+            self.draw_by_repetition = counts.get(self.zobrist_key, 0) >= 3
+            self.draw_by_fifty_moves = self.halfmove_clock_log[-1] >= 100
 
     def update_castle_rights(self, move):
         """
         Update the castle rights given the move
         """
+        rights = self.current_castling_rights
         if move.piece_moved == "wK":
-            self.current_castling_rights.wKs = False
-            self.current_castling_rights.wQs = False
+            rights.wKs = False
+            rights.wQs = False
         elif move.piece_moved == "bK":
-            self.current_castling_rights.bKs = False
-            self.current_castling_rights.bQs = False
+            rights.bKs = False
+            rights.bQs = False
         elif move.piece_moved == "wR":
-            if move.start_row == 7:
-                if move.start_column == 0:  # left rook
-                    self.current_castling_rights.wQs = False
-                elif move.start_column == 7:  # right rook
-                    self.current_castling_rights.wKs = False
+            start = move.code & 63
+            if start == 56:  # left rook
+                rights.wQs = False
+            elif start == 63:  # right rook
+                rights.wKs = False
         elif move.piece_moved == "bR":
-            if move.start_row == 0:
-                if move.start_column == 0:  # left rook
-                    self.current_castling_rights.bQs = False
-                elif move.start_column == 7:  # right rook
-                    self.current_castling_rights.bKs = False
+            start = move.code & 63
+            if start == 0:  # left rook
+                rights.bQs = False
+            elif start == 7:  # right rook
+                rights.bKs = False
+        # a rook captured on its starting square takes the castle rights with it
+        if move.piece_captured == "wR":
+            end = move.code >> 6 & 63
+            if end == 56:
+                rights.wQs = False
+            elif end == 63:
+                rights.wKs = False
+        elif move.piece_captured == "bR":
+            end = move.code >> 6 & 63
+            if end == 0:
+                rights.bQs = False
+            elif end == 7:
+                rights.bKs = False
     
     def get_valid_moves(self):
         """
-        Gets all valid moves from current player, makes move for each possible move,
-        generates all possible moves again (for opponent), checks if king can be attacked
-        If king is safe -> valid move
+        Gets all valid moves for the current player, from move_cache if it has the position
+        (GameState.move_cache = MoveCache() turns the cache on).
+        Sets checkmate/stalemate either way
+        :return: list of valid moves only
+        """
+        cache = self.move_cache
+        if cache is None:
+            return self.generate_valid_moves()
+        key = self.position_key()
+        entry = cache.get(key)
+        if entry is not None:
+            moves, self.checkmate, self.stalemate = entry
+            return list(moves)
+        moves = self.generate_valid_moves()
+        cache.put(key, (tuple(moves), self.checkmate, self.stalemate))
+        return moves
+
+    def position_key(self):
+        """
+        Everything the valid moves depend on: board, side to move, castle rights and en passant square.
+        Unlike zobrist_key it can't collide
+        """
+        return ("".join(["".join(row) for row in self.board]), self.white_to_move,
+                ChessHash.castle_rights_index(self.current_castling_rights), self.enpassant_possible)
+
+    def generate_valid_moves(self):
+        """
+        Gets all valid moves for the current player: every possible move that legal_move_test keeps
 
         :return: list of valid moves only
         """
-        temp_enpassant_possible = self.enpassant_possible
-        temp_castle_rights = CastleRights(self.current_castling_rights.wKs, self.current_castling_rights.bKs,
-                                          self.current_castling_rights.wQs, self.current_castling_rights.bQs)
-        moves = self.get_all_possible_moves()
-        if self.white_to_move:
-            self.get_castle_moves(self.white_king_location[0], self.white_king_location[1], moves)
-        else:
-            self.get_castle_moves(self.black_king_location[0], self.black_king_location[1], moves)
-        for i in range(len(moves)-1, -1, -1):  # when removing from list, going backwards
-            self.make_move(moves[i])
-            self.white_to_move = not self.white_to_move
-            if self.in_check():
-                moves.remove(moves[i])  # king is not safe, not valid move
-            self.white_to_move = not self.white_to_move
-            self.undo_move() 
+        in_check, is_legal = self.legal_move_test()
+        moves = [move for move in self.get_all_possible_moves() if is_legal(move)]
+        if not in_check:
+            king_row, king_column = self.white_king_location if self.white_to_move else self.black_king_location
+            self.get_castle_moves(king_row, king_column, moves)
+
         if len(moves) == 0:  # either checkmate or stalemate
-            if self.in_check():
+            if in_check:
                 self.checkmate = True
             else:
                 self.stalemate = True
         else:
             self.checkmate = False
             self.stalemate = False
-        
-        self.enpassant_possible = temp_enpassant_possible
-        self.current_castling_rights = temp_castle_rights
 
         return moves
 
+    def legal_move_test(self):
+        """
+        Checks and pins against the king are found once for the position, then a possible
+        move (not castling) is legal only if it leaves the king safe:
+        - king moves must not step onto an attacked square
+        - pinned pieces may only move along the pin
+        - in check, a move must capture the checking piece or block its line (double check -> king moves only)
+        - en passant is tried on the board, since removing two pawns at once can uncover the king
+
+        :return: in_check, function(move) -> True if the possible move is legal
+        """
+        if self.white_to_move:
+            king_row, king_column = self.white_king_location
+        else:
+            king_row, king_column = self.black_king_location
+        in_check, pins, checks = self.check_for_pins_and_checks(king_row, king_column)
+        block_squares = None  # squares a non-king move has to land on to get out of check
+        if len(checks) == 1:
+            check_row, check_column, d_row, d_column = checks[0]
+            if self.board[check_row][check_column][1] == "N":  # knight checks can't be blocked
+                block_squares = {(check_row, check_column)}
+            else:
+                block_squares = set()
+                for i in range(1, 8):
+                    square = (king_row + d_row * i, king_column + d_column * i)
+                    block_squares.add(square)
+                    if square == (check_row, check_column):  # reached the checking piece
+                        break
+        elif len(checks) > 1:
+            block_squares = set()  # double check, only the king can move
+
+        def is_legal(move):
+            code = move.code
+            if move.piece_moved[1] == "K":
+                return self.king_move_is_safe(move)
+            if code & ENPASSANT_FLAG:
+                return self.enpassant_move_is_safe(move, king_row, king_column)
+            start_row, start_column, end_row, end_column = code >> 3 & 7, code & 7, code >> 9 & 7, code >> 6 & 7
+            if block_squares is not None and (end_row, end_column) not in block_squares:
+                return False  # doesn't deal with the check
+            pin = pins.get((start_row, start_column))
+            if pin is not None:
+                if move.piece_moved[1] == "N":
+                    return False  # pinned knights can never move
+                d_row, d_column = end_row - start_row, end_column - start_column
+                if d_row * pin[1] != d_column * pin[0]:
+                    return False  # moving off the pin line
+            return True
+        return in_check, is_legal
+
+    def check_for_pins_and_checks(self, row, column):
+        """
+        Looks at every enemy piece that could reach the king square (row, column).
+        An enemy slider lined up with the king pins the one allied piece between them,
+        or checks the king if nothing is in between; knights, pawns and the king check by jumping
+
+        :return: in_check, dict of pinned squares -> pin direction, list of checks (row, column, d_row, d_column)
+        """
+        pins = {}
+        checks = []
+        if self.white_to_move:
+            enemy_color, ally_color = "b", "w"
+        else:
+            enemy_color, ally_color = "w", "b"
+        board = self.board
+        piece_squares = self.piece_squares
+        king = row * 8 + column
+        queens = piece_squares[enemy_color + "Q"]
+        for sliders, lines in ((piece_squares[enemy_color + "R"], ORTHOGONAL_LINES[king]),
+                               (piece_squares[enemy_color + "B"], DIAGONAL_LINES[king])):
+            for square in (sliders | queens) if queens else sliders:
+                between = lines[square]
+                if between is None:
+                    continue  # not lined up with the king
+                possible_pin = ()
+                for middle in between:
+                    middle_piece = board[middle >> 3][middle & 7]
+                    if middle_piece == "--":
+                        continue
+                    if middle_piece[0] == enemy_color or possible_pin != ():
+                        break  # blocked by an enemy piece or a second allied piece
+                    possible_pin = (middle >> 3, middle & 7)
+                else:
+                    d_row, d_column = (square >> 3) - row, (square & 7) - column
+                    direction = ((d_row > 0) - (d_row < 0), (d_column > 0) - (d_column < 0))
+                    if possible_pin == ():
+                        checks.append((square >> 3, square & 7, direction[0], direction[1]))
+                    else:
+                        pins[possible_pin] = direction
+        for piece, reach in ((enemy_color + "N", KNIGHT_SQUARES[king]),
+                             (enemy_color + "P", PAWN_ATTACK_SQUARES[enemy_color][king]),
+                             (enemy_color + "K", KING_SQUARES[king])):
+            for square in piece_squares[piece] & reach:
+                checks.append((square >> 3, square & 7, (square >> 3) - row, (square & 7) - column))
+        return len(checks) > 0, pins, checks
+
+    def king_move_is_safe(self, move):
+        """
+        Determine if the king can go to the end square of the move.
+        The king is lifted off the board first, so it can't shield itself from a slider along the same line
+        """
+        code = move.code
+        start_row, start_column = code >> 3 & 7, code & 7
+        self.board[start_row][start_column] = "--"
+        attacked = self.square_under_attack(code >> 9 & 7, code >> 6 & 7)
+        self.board[start_row][start_column] = move.piece_moved
+        return not attacked
+
+    def enpassant_move_is_safe(self, move, king_row, king_column):
+        """
+        Determine if an en passant capture leaves the king safe.
+        Both pawns leave their squares at once (e.g. king and enemy rook on the same rank),
+        so the capture is played out on the board and the king square is checked
+        """
+        captured_pawns = self.piece_squares[move.piece_captured]
+        captured_square = move.start_row * 8 + move.end_column
+        self.board[move.start_row][move.start_column] = "--"
+        self.board[move.start_row][move.end_column] = "--"
+        self.board[move.end_row][move.end_column] = move.piece_moved
+        captured_pawns.remove(captured_square)
+        attacked = self.square_under_attack(king_row, king_column)
+        captured_pawns.add(captured_square)
+        self.board[move.start_row][move.start_column] = move.piece_moved
+        self.board[move.start_row][move.end_column] = move.piece_captured
+        self.board[move.end_row][move.end_column] = "--"
+        return not attacked
+
     def in_check(self):
         """
         Determine if current player is in check
@@ -177,13 +787,50 @@ class GameState:
         """
         Determine if enemy can attack the square row, column
         """
-        self.white_to_move = not self.white_to_move  # switch to opponents turn
-        opponents_moves = self.get_all_possible_moves()
-        self.white_to_move = not self.white_to_move  # switch turns back
-        for move in opponents_moves:
-            if move.end_row == row and move.end_column == column:
-                return True
-        return False
+        enemy_color = "b" if self.white_to_move else "w"
+        return len(self.find_attackers(row, column, enemy_color, True)) > 0
+
+    def attackers_of(self, square, color):
+        """
+        Gets every piece of the given color ("w" or "b") that attacks square (row, column)
+        :return: list of (row, column) of the attacking pieces
+        """
+        return self.find_attackers(square[0], square[1], color, False)
+
+    def find_attackers(self, row, column, color, first_only):
+        """
+        Looks at every piece of color that could reach the square (row, column):
+        knights, pawns and the king by their jumps, sliders lined up with the square with nothing in between.
+        The square itself may hold anything, only the pieces around it matter
+
+        :param first_only: stop as soon as one attacker is found
+        :return: list of (row, column) of the attacking pieces
+        """
+        attackers = []
+        board = self.board
+        piece_squares = self.piece_squares
+        target = row * 8 + column
+        for piece, reach in ((color + "N", KNIGHT_SQUARES[target]), (color + "P", PAWN_ATTACK_SQUARES[color][target]),
+                             (color + "K", KING_SQUARES[target])):
+            for square in piece_squares[piece] & reach:
+                attackers.append((square >> 3, square & 7))
+                if first_only:
+                    return attackers
+        queens = piece_squares[color + "Q"]
+        for sliders, lines in ((piece_squares[color + "R"], ORTHOGONAL_LINES[target]),
+                               (piece_squares[color + "B"], DIAGONAL_LINES[target])):
+            for square in (sliders | queens) if queens else sliders:
+                between = lines[square]
+                if between is None:
+                    continue  # not lined up with the square
+                for middle in between:
+                    if board[middle >> 3][middle & 7] != "--":
+                        break  # blocked
+                else:
+                    attackers.append((square >> 3, square & 7))
+                    if first_only:
+                        return attackers
+        return attackers
 
     def get_all_possible_moves(self):
         """
@@ -191,14 +838,145 @@ class GameState:
         :return: list of all moves
         """
         moves = []
-        for row in range(len(self.board)):
-            for column in range(len(self.board[row])):
-                turn = self.board[row][column][0]
-                if (turn == 'w' and self.white_to_move) or (turn == 'b' and not self.white_to_move):
-                    piece = self.board[row][column][1]
-                    self.move_functions[piece](row, column, moves)  # calls the appropriate move functions
+        color = "w" if self.white_to_move else "b"
+        for piece, move_function in self.move_functions.items():
+            for square in self.piece_squares[color + piece]:  # only the squares the pieces stand on
+                move_function(square >> 3, square & 7, moves)  # calls the appropriate move functions
         return moves
 
+    def iter_valid_moves(self):
+        """
+        Valid moves one piece at a time, king first, without building the whole list.
+        Doesn't touch checkmate/stalemate
+        """
+        in_check, is_legal = self.legal_move_test()
+        color = "w" if self.white_to_move else "b"
+        for piece in LAZY_PIECE_ORDER:
+            move_function = self.move_functions[piece]
+            for square in list(self.piece_squares[color + piece]):
+                piece_moves = []
+                move_function(square >> 3, square & 7, piece_moves)
+                for move in piece_moves:
+                    if is_legal(move):
+                        yield move
+        if not in_check:
+            king_row, king_column = self.white_king_location if self.white_to_move else self.black_king_location
+            castle_moves = []
+            self.get_castle_moves(king_row, king_column, castle_moves)
+            yield from castle_moves
+
+    def has_legal_move(self):
+        """
+        Determine if the current player can move at all, stopping at the first valid move found.
+        With in_check() this tells checkmate and stalemate apart; checkmate/stalemate are left as they are
+        """
+        for _ in self.iter_valid_moves():
+            return True
+        return False
+
+    def staged_moves(self, hash_move_id=0, quiet_moves=True, quiet_key=None):
+        """
+        Valid moves in stages, each generated only when the one before it is used up,
+        so a caller that stops early (a cutoff) never pays for the rest:
+        1. the hash move (move_ID from the transposition table), if it is valid here
+        2. captures, most valuable victim first and least valuable attacker first (capture promotions included)
+        3. promotions that don't capture
+        4. quiet moves and castling, sorted by quiet_key (highest first) if given
+
+        Doesn't touch checkmate/stalemate, a position without moves yields nothing
+        :param quiet_moves: False stops after the promotions (for a capture search)
+        """
+        in_check, is_legal = self.legal_move_test()
+        board = self.board
+        if self.white_to_move:
+            ally_color, enemy_color, last_row = "w", "b", 0
+        else:
+            ally_color, enemy_color, last_row = "b", "w", 7
+
+        if hash_move_id:
+            hash_move = self.find_possible_move(hash_move_id, in_check)
+            if hash_move is not None and is_legal(hash_move):
+                yield hash_move
+            else:
+                hash_move_id = 0
+
+        for victim in VICTIM_ORDER:
+            for square in sorted(self.piece_squares[enemy_color + victim]):
+                row, column = square >> 3, square & 7
+                attackers = self.find_attackers(row, column, ally_color, False)
+                attackers.sort(key=lambda attacker: ATTACKER_ORDER[board[attacker[0]][attacker[1]][1]])
+                for attacker in attackers:
+                    if board[attacker[0]][attacker[1]][1] == "P" and row == last_row:
+                        captures = [Move(attacker, (row, column), board, promotion_piece=piece)
+                                    for piece in PROMOTION_PIECES]
+                    else:
+                        captures = [Move(attacker, (row, column), board)]
+                    for move in captures:
+                        if move.move_ID != hash_move_id and is_legal(move):
+                            yield move
+            if victim == "P" and self.enpassant_possible != ():
+                row, column = self.enpassant_possible
+                reach = PAWN_ATTACK_SQUARES[ally_color][row * 8 + column]
+                for square in sorted(self.piece_squares[ally_color + "P"] & reach):
+                    move = Move((square >> 3, square & 7), (row, column), board, is_enpassant_move=True)
+                    if move.move_ID != hash_move_id and is_legal(move):
+                        yield move
+
+        forward = -1 if self.white_to_move else 1
+        for square in sorted(self.piece_squares[ally_color + "P"]):
+            row, column = square >> 3, square & 7
+            if row + forward == last_row and board[last_row][column] == "--":
+                for piece in PROMOTION_PIECES:
+                    move = Move((row, column), (last_row, column), board, promotion_piece=piece)
+                    if move.move_ID != hash_move_id and is_legal(move):
+                        yield move
+
+        if not quiet_moves:
+            return
+        quiets = []
+        for move in self.get_all_possible_moves():
+            if move.piece_captured == "--" and not move.is_pawn_promotion and move.move_ID != hash_move_id:
+                if quiet_key is None:
+                    if is_legal(move):
+                        yield move
+                elif is_legal(move):
+                    quiets.append(move)
+        if not in_check:
+            king_row, king_column = self.white_king_location if self.white_to_move else self.black_king_location
+            castle_moves = []
+            self.get_castle_moves(king_row, king_column, castle_moves)
+            quiets.extend(move for move in castle_moves if move.move_ID != hash_move_id)
+        if quiet_key is not None:
+            quiets.sort(key=quiet_key, reverse=True)
+        yield from quiets
+
+    def captures_only(self):
+        """
+        Valid captures, most valuable victim first and least valuable attacker first, generated lazily.
+        Quiet moves are never generated
+        """
+        for move in self.staged_moves(quiet_moves=False):
+            if move.piece_captured != "--":
+                yield move
+
+    def find_possible_move(self, move_id, in_check):
+        """
+        Possible move (not checked for legality) with the given move_ID, generated from its start square only
+        :return: the move, None if the piece there can't make it
+        """
+        start = move_id & 63
+        piece = self.board[start >> 3][start & 7]
+        if piece[0] != ("w" if self.white_to_move else "b"):
+            return None
+        moves = []
+        self.move_functions[piece[1]](start >> 3, start & 7, moves)
+        if piece[1] == "K" and not in_check:
+            self.get_castle_moves(start >> 3, start & 7, moves)
+        for move in moves:
+            if move.move_ID == move_id:
+                return move
+        return None
+
     def get_pawn_moves(self, row, column, moves):
         """
         Get all the pawn moves for the pawn located in row, column, and add these moves to the list
@@ -206,35 +984,45 @@ class GameState:
         """
         if self.white_to_move:  # white pawn moves
             if self.board[row-1][column] == "--":  # 1 square pawn advance
-                moves.append(Move((row, column), (row-1, column), self.board))
+                self.add_pawn_moves((row, column), (row-1, column), moves)
                 if row == 6 and self.board[row-2][column] == "--":  # 2 square pawn advance
                     moves.append(Move((row, column), (row-2, column), self.board))
             if column-1 >= 0:  # captures to the left
                 if self.board[row-1][column-1][0] == "b":  # enemy piece to capture
-                    moves.append(Move((row, column), (row-1, column-1), self.board))
+                    self.add_pawn_moves((row, column), (row-1, column-1), moves)
                 elif (row-1, column-1) == self.enpassant_possible:  # en passant handling
                     moves.append(Move((row, column), (row-1, column-1), self.board, is_enpassant_move=True))
             if column+1 <= 7:  # captures to the right
                 if self.board[row-1][column+1][0] == "b":  # enemy piece to capture
-                    moves.append(Move((row, column), (row-1, column+1), self.board))
+                    self.add_pawn_moves((row, column), (row-1, column+1), moves)
                 elif (row-1, column+1) == self.enpassant_possible:  # en passant handling
                     moves.append(Move((row, column), (row-1, column+1), self.board, is_enpassant_move=True))
         else:  # black pawn
             if self.board[row+1][column] == "--":  # 1 square pawn advance
-                moves.append(Move((row, column), (row+1, column), self.board))
+                self.add_pawn_moves((row, column), (row+1, column), moves)
                 if row == 1 and self.board[row+2][column] == "--":  # 2 square pawn advance
                     moves.append(Move((row, column), (row+2, column), self.board))
             if column-1 >= 0:  # captures to the left
                 if self.board[row+1][column-1][0] == "w":  # enemy piece to capture
-                    moves.append(Move((row, column), (row+1, column-1), self.board))
+                    self.add_pawn_moves((row, column), (row+1, column-1), moves)
                 elif (row+1, column-1) == self.enpassant_possible:  # en passant handling
                     moves.append(Move((row, column), (row+1, column-1), self.board, is_enpassant_move=True))
             if column+1 <= 7:  # captures to the right
                 if self.board[row+1][column+1][0] == "w":  # enemy piece to capture
-                    moves.append(Move((row, column), (row+1, column+1), self.board))
+                    self.add_pawn_moves((row, column), (row+1, column+1), moves)
                 elif (row+1, column+1) == self.enpassant_possible:  # en passant handling
                     moves.append(Move((row, column), (row+1, column+1), self.board, is_enpassant_move=True))
 
+    def add_pawn_moves(self, start_square, end_square, moves):
+        """
+        Adds the pawn move, or one move per promotion piece when the pawn reaches the last row
+        """
+        if end_square[0] == 0 or end_square[0] == 7:
+            for piece in PROMOTION_PIECES:
+                moves.append(Move(start_square, end_square, self.board, promotion_piece=piece))
+        else:
+            moves.append(Move(start_square, end_square, self.board))
+
     def get_rook_moves(self, row, column, moves):
         """
         Get all the rook moves for the rook located in row, column, and add these moves to the list
@@ -346,7 +1134,8 @@ class GameState:
         Checks if square are empty in between king and rook (queen side)
         Adds the castle move to list of moves
         """
-        if self.board[row][column-1] == "--" and self.board[row][column-2] == "--" and self.board[row][column-3]:
+        if self.board[row][column-1] == "--" and self.board[row][column-2] == "--" and \
+                self.board[row][column-3] == "--":
             if not self.square_under_attack(row, column-1) and not self.square_under_attack(row, column-2):
                 moves.append(Move((row, column), (row, column-2), self.board, is_castle_move=True))
 
@@ -363,11 +1152,66 @@ class CastleRights():
         self.bQs = bQ_side
 
 
+class MoveCache:
+    """
+    Bounded least recently used cache of position key -> (valid moves, checkmate, stalemate),
+    for GameState.move_cache. The same cache can be shared by several GameStates.
+    Copies (deepcopy, pickle) start out empty, so a game handed to another thread or process doesn't drag it along
+    """
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __deepcopy__(self, memo):
+        return MoveCache(self.max_size)
+
+    def __reduce__(self):
+        return MoveCache, (self.max_size,)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)  # least recently used
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """
+        :return: dict with hits, misses, hit rate, current size and max_size
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self.entries), "max_size": self.max_size}
+
+
 class Move:
     """
     This class represents the moves made on a chess board.
     It gets the information needed for a move to be made.
+    A move is packed into one int, code, next to the two pieces it involves:
+    bits 0-5 start square, 6-11 end square (row * 8 + column), 12-14 promotion piece
+    (index in PROMOTION_PIECES + 1, 0 if not a promotion), bit 15 en passant, bit 16 castle.
+    The row/column and flag attributes are worked out from code when they're read
     """
+    __slots__ = ("code", "piece_moved", "piece_captured")
+
     # mapping keys from the board as if the player would see it, not a computer
     ranks_to_rows = {"1": 7, "2": 6, "3": 5, "4": 4, 
                      "5": 3, "6": 2, "7": 1, "8": 0}
@@ -376,32 +1220,115 @@ class Move:
                         "e": 4, "f": 5, "g": 6, "h": 7}
     columns_to_files = {v: k for k, v in files_to_columns.items()}
 
-    def __init__(self, start_square, end_square, board, is_enpassant_move=False, is_castle_move=False):
-        self.start_row = start_square[0]
-        self.start_column = start_square[1]
-        self.end_row = end_square[0]
-        self.end_column = end_square[1]
-        self.piece_moved = board[self.start_row][self.start_column]
-        self.piece_captured = board[self.end_row][self.end_column]
-        self.is_pawn_promotion = (self.piece_moved == "wP" and self.end_row == 0) or \
-                                 (self.piece_moved == "bP" and self.end_row == 7)
-        self.is_enpassant_move = is_enpassant_move
-        if self.is_enpassant_move:
-            self.piece_captured = "wP" if self.piece_moved == "bP" else "bP"
-        self.is_castle_move = is_castle_move
-        self.move_ID = self.start_row * 1000 + self.start_column * 100 + self.end_row * 10 + self.end_column
+    def __init__(self, start_square, end_square, board, is_enpassant_move=False, is_castle_move=False,
+                 promotion_piece="Q"):
+        start_row, start_column = start_square
+        end_row, end_column = end_square
+        self.piece_moved = piece_moved = board[start_row][start_column]
+        code = start_row << 3 | start_column | end_row << 9 | end_column << 6
+        if is_enpassant_move:
+            self.piece_captured = "wP" if piece_moved == "bP" else "bP"
+            code |= ENPASSANT_FLAG
+        else:
+            self.piece_captured = board[end_row][end_column]
+            if is_castle_move:
+                code |= CASTLE_FLAG
+            elif (end_row == 0 and piece_moved == "wP") or (end_row == 7 and piece_moved == "bP"):
+                code |= PROMOTION_CODES[promotion_piece]  # promotions to different pieces are different moves
+        self.code = code
+
+    @classmethod
+    def from_code(cls, code, board):
+        """
+        Move from its packed code, on the board it is about to be played on
+        """
+        move = cls.__new__(cls)
+        move.code = code
+        start, end = code & 63, code >> 6 & 63
+        move.piece_moved = board[start >> 3][start & 7]
+        if code & ENPASSANT_FLAG:
+            move.piece_captured = "wP" if move.piece_moved == "bP" else "bP"
+        else:
+            move.piece_captured = board[end >> 3][end & 7]
+        return move
 
     def __eq__(self, other):
         """
         Overriding the equal method
         """
         if isinstance(other, Move):
-            return self.move_ID == other.move_ID
+            return (self.code ^ other.code) & MOVE_ID_MASK == 0
         return False
 
+    def __hash__(self):
+        return self.code & MOVE_ID_MASK
+
+    def __getstate__(self):
+        return self.code, self.piece_moved, self.piece_captured
+
+    def __setstate__(self, state):
+        self.code, self.piece_moved, self.piece_captured = state
+
+    def __repr__(self):
+        return "Move(" + self.get_chess_notation() + ")"
+
+    @property
+    def move_ID(self):
+        """
+        Start square, end square and promotion piece, which is all that tells moves in a position apart
+        """
+        return self.code & MOVE_ID_MASK
+
+    @property
+    def start_square(self):
+        return self.code & 63
+
+    @property
+    def end_square(self):
+        return self.code >> 6 & 63
+
+    @property
+    def start_row(self):
+        return self.code >> 3 & 7
+
+    @property
+    def start_column(self):
+        return self.code & 7
+
+    @property
+    def end_row(self):
+        return self.code >> 9 & 7
+
+    @property
+    def end_column(self):
+        return self.code >> 6 & 7
+
+    @property
+    def is_pawn_promotion(self):
+        return self.code & PROMOTION_MASK != 0
+
+    @property
+    def promotion_piece(self):
+        """
+        Piece the pawn turns into ("Q" if the move isn't a promotion)
+        """
+        index = self.code >> 12 & 7
+        return PROMOTION_PIECES[index - 1] if index else "Q"
+
+    @property
+    def is_enpassant_move(self):
+        return self.code & ENPASSANT_FLAG != 0
+
+    @property
+    def is_castle_move(self):
+        return self.code & CASTLE_FLAG != 0
+
     def get_chess_notation(self):
-        return self.get_rank_file(self.start_row, self.start_column) + \
+        notation = self.get_rank_file(self.start_row, self.start_column) + \
             self.get_rank_file(self.end_row, self.end_column)
+        if self.is_pawn_promotion:
+            notation += self.promotion_piece.lower()
+        return notation
     
     def get_rank_file(self, row, column):
         return self.columns_to_files[column] + self.row_to_ranks[row]
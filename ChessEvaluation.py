@@ -0,0 +1,313 @@
+"""
+Static evaluation with NumPy, scoring many positions in one vectorized pass.
+A position is encoded as 64 piece codes (0 for an empty square, 1 + its index in ChessEngine.PIECE_NAMES
+otherwise); a batch of them is expanded into boolean piece planes of shape (positions, 12, 64) and scored with:
+- material and piece-square tables (the same numbers as ChessSearch.evaluate)
+- mobility: squares each knight, bishop, rook and queen attacks that don't hold a piece of its own color
+- pawn structure: doubled, isolated and passed pawns
+
+    scores = ChessEvaluation.score_moves(gs)  # every child of gs, from the side to move's point of view
+
+Command line (compares the batched pass with scoring the same positions one at a time in plain Python):
+    $ python ChessEvaluation.py --positions 4096
+"""
+
+import argparse
+import random
+import sys
+import time
+
+import numpy as np
+
+import ChessEngine
+import ChessSearch
+
+PIECE_CODES = {piece: index + 1 for index, piece in enumerate(ChessEngine.PIECE_NAMES)}
+PIECE_CODES["--"] = 0
+PLANE_CODES = np.arange(1, 13, dtype=np.int8)  # code of the piece of each plane
+
+# material plus piece-square score of a piece on a square, positive for white: (12, 64) -> 768
+MATERIAL_WEIGHTS = np.array([ChessSearch.SQUARE_SCORES[piece] for piece in ChessEngine.PIECE_NAMES],
+                            dtype=np.float32).reshape(768)
+MOBILITY_WEIGHTS = {"N": 4, "B": 5, "R": 2, "Q": 1}  # centipawns per square a piece attacks
+DOUBLED_PAWN = -10  # per pawn on a file after the first
+ISOLATED_PAWN = -15  # per pawn with no pawns of its color on the files next to it
+# passed pawn bonus by row, for pawns moving towards row 0 (white's, black's are flipped)
+PASSED_PAWN = np.array([0, 100, 60, 35, 20, 10, 5, 0], dtype=np.float32)
+
+
+def ray_squares(d_row, d_column):
+    """
+    (64, 7) squares a slider passes from each square in one direction, padded with 64 (off the board)
+    """
+    rays = np.full((64, 7), 64, dtype=np.intp)
+    for square in range(64):
+        row, column = square >> 3, square & 7
+        for step in range(7):
+            row, column = row + d_row, column + d_column
+            if not (0 <= row < 8 and 0 <= column < 8):
+                break
+            rays[square, step] = row * 8 + column
+    return rays
+
+
+# bitboard steps of the sliders (square = row * 8 + column, bit 1 << square): (shift, squares that can be
+# landed on without wrapping around the board), orthogonal then diagonal
+ALL_SQUARES = np.uint64(0xffffffffffffffff)
+NOT_FIRST_COLUMN = np.uint64(0xfefefefefefefefe)
+NOT_LAST_COLUMN = np.uint64(0x7f7f7f7f7f7f7f7f)
+ORTHOGONAL_STEPS = ((-8, ALL_SQUARES), (8, ALL_SQUARES), (-1, NOT_LAST_COLUMN), (1, NOT_FIRST_COLUMN))
+DIAGONAL_STEPS = ((-9, NOT_LAST_COLUMN), (-7, NOT_FIRST_COLUMN), (7, NOT_LAST_COLUMN), (9, NOT_FIRST_COLUMN))
+# (steps, planes of the pieces moving that way, their mobility weights, positive for white)
+SLIDERS = ((ORTHOGONAL_STEPS, [3, 4, 9, 10], np.array([MOBILITY_WEIGHTS["R"], MOBILITY_WEIGHTS["Q"],
+                                                        -MOBILITY_WEIGHTS["R"], -MOBILITY_WEIGHTS["Q"]],
+                                                       dtype=np.float32)),
+           (DIAGONAL_STEPS, [2, 4, 8, 10], np.array([MOBILITY_WEIGHTS["B"], MOBILITY_WEIGHTS["Q"],
+                                                      -MOBILITY_WEIGHTS["B"], -MOBILITY_WEIGHTS["Q"]],
+                                                     dtype=np.float32)))
+SLIDER_SIDES = [0, 0, 1, 1]  # side of each of the planes above
+BIT_COUNTS = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+# [from square][to square] = 1 if a knight jumps between them
+KNIGHT_MATRIX = np.zeros((64, 64), dtype=np.float32)
+for _square in range(64):
+    KNIGHT_MATRIX[_square, list(ChessEngine.KNIGHT_SQUARES[_square])] = 1
+# squares a slider passes from each square, orthogonal directions then diagonal ones, for the plain Python evaluation
+RAY_LISTS = [[[int(square) for square in ray if square != 64] for ray in rays] for rays in
+             zip(*(ray_squares(d_row, d_column) for d_row, d_column in
+                   ((-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1))))]
+
+
+def encode(gs):
+    """
+    Piece codes of the board of gs, square by square (row * 8 + column)
+    :return: list of 64 ints
+    """
+    return [PIECE_CODES[piece] for row in gs.board for piece in row]
+
+
+def piece_planes(codes):
+    """
+    :param codes: (positions, 64) array of piece codes
+    :return: (positions, 12, 64) boolean array, plane i marks the squares of ChessEngine.PIECE_NAMES[i]
+    """
+    return codes[:, None, :] == PLANE_CODES[None, :, None]
+
+
+def bit_count(boards):
+    """
+    :param boards: uint64 array of bitboards
+    :return: array of the same shape, the number of squares on each bitboard
+    """
+    return BIT_COUNTS[boards.view(np.uint8)].reshape(boards.shape + (8,)).sum(axis=-1)
+
+
+def step_boards(boards, shift, landing):
+    """
+    Moves every square of the bitboards one step
+    :param shift: square difference of the step
+    :param landing: bitboard of the squares the step may land on
+    """
+    if shift > 0:
+        return (boards << np.uint64(shift)) & landing
+    return (boards >> np.uint64(-shift)) & landing
+
+
+def slider_mobility(boards, sides):
+    """
+    Mobility of every bishop, rook and queen in the batch: each direction is flood filled through the empty
+    squares for all the positions at once. Rays of pieces of one kind and color never overlap in one direction,
+    so counting the squares a fill reaches counts each piece's squares
+    :param boards: (positions, 12) uint64 bitboards of the pieces of ChessEngine.PIECE_NAMES
+    :param sides: (positions, 2) uint64 bitboards of the white pieces and of the black pieces
+    :return: (positions,) weighted mobility, positive for white
+    """
+    empty = ~(sides[:, 0] | sides[:, 1])
+    own = np.ascontiguousarray(sides[:, SLIDER_SIDES].T)
+    score = np.zeros(boards.shape[0], dtype=np.float32)
+    for steps, planes, weights in SLIDERS:
+        pieces = np.ascontiguousarray(boards[:, planes].T)  # (4, positions)
+        for shift, landing in steps:
+            flood = reach = pieces
+            for _ in range(6):  # a ray is at most 7 squares, the last one may hold a piece
+                reach = step_boards(reach, shift, landing) & empty
+                flood = flood | reach
+            score += weights @ bit_count(step_boards(flood, shift, landing) & ~own)
+    return score
+
+
+def pawn_structure(own, enemy):
+    """
+    Pawn structure score of one side, for pawns moving towards row 0 (black's are flipped first)
+    :param own: (positions, 8, 8) boolean pawns of the side, rows by columns
+    :param enemy: (positions, 8, 8) boolean pawns of the other side
+    :return: (positions,) scores
+    """
+    file_counts = own.sum(axis=1)  # (positions, 8)
+    doubled = np.maximum(file_counts - 1, 0).sum(axis=1)
+    neighbours = np.zeros_like(file_counts)
+    neighbours[:, 1:] += file_counts[:, :-1]
+    neighbours[:, :-1] += file_counts[:, 1:]
+    isolated = (file_counts * (neighbours == 0)).sum(axis=1)
+    # an enemy pawn on this file or a file next to it, on this row or any row in front (lower rows)
+    guarded = enemy.copy()
+    guarded[:, :, 1:] |= enemy[:, :, :-1]
+    guarded[:, :, :-1] |= enemy[:, :, 1:]
+    guarded = np.logical_or.accumulate(guarded, axis=1)
+    blocked = np.zeros_like(guarded)
+    blocked[:, 1:, :] = guarded[:, :-1, :]
+    passed = own & ~blocked
+    passed_score = (passed.sum(axis=2) * PASSED_PAWN[None, :]).sum(axis=1)
+    return DOUBLED_PAWN * doubled + ISOLATED_PAWN * isolated + passed_score
+
+
+def evaluate_codes(codes):
+    """
+    Scores a batch of positions in one pass
+    :param codes: (positions, 64) array of piece codes (see encode)
+    :return: (positions,) float array of centipawns, positive for white
+    """
+    codes = np.asarray(codes, dtype=np.int8).reshape(-1, 64)
+    count = codes.shape[0]
+    planes = piece_planes(codes)
+    score = planes.reshape(count, 768).astype(np.float32) @ MATERIAL_WEIGHTS
+
+    white = planes[:, :6].any(axis=1)
+    black = planes[:, 6:].any(axis=1)
+    boards = np.packbits(planes, axis=2, bitorder="little").view("<u8")[:, :, 0]
+    sides = np.packbits(np.stack([white, black], axis=1), axis=2, bitorder="little").view("<u8")[:, :, 0]
+    score += slider_mobility(boards, sides)
+    for color, own, sign in ((0, white, 1), (6, black, -1)):
+        knight_reach = planes[:, color + 1].astype(np.float32) @ KNIGHT_MATRIX  # knights reaching each square
+        score += sign * MOBILITY_WEIGHTS["N"] * (knight_reach * ~own).sum(axis=1)
+
+    white_pawns = planes[:, 0].reshape(count, 8, 8)
+    black_pawns = planes[:, 6].reshape(count, 8, 8)
+    score += pawn_structure(white_pawns, black_pawns)
+    score -= pawn_structure(black_pawns[:, ::-1, :], white_pawns[:, ::-1, :])
+    return score
+
+
+def evaluate_one(codes):
+    """
+    Scores one position square by square in plain Python, the same terms as evaluate_codes
+    :param codes: 64 piece codes (see encode)
+    :return: centipawns, positive for white
+    """
+    pieces = [ChessEngine.PIECE_NAMES[code - 1] if code else None for code in codes]
+    score = 0
+    pawn_files = {"w": [0] * 8, "b": [0] * 8}
+    for square, piece in enumerate(pieces):
+        if piece is None:
+            continue
+        color, kind = piece[0], piece[1]
+        sign = 1 if color == "w" else -1
+        score += ChessSearch.SQUARE_SCORES[piece][square]
+        reached = 0
+        if kind == "N":
+            reached = sum(1 for end in ChessEngine.KNIGHT_SQUARES[square]
+                          if pieces[end] is None or pieces[end][0] != color)
+        elif kind in "BRQ":
+            for direction, ray in enumerate(RAY_LISTS[square]):
+                if (kind == "B" and direction < 4) or (kind == "R" and direction >= 4):
+                    continue
+                for end in ray:
+                    if pieces[end] is not None:
+                        reached += pieces[end][0] != color
+                        break
+                    reached += 1
+        elif kind == "P":
+            pawn_files[color][square & 7] += 1
+        if reached:
+            score += sign * MOBILITY_WEIGHTS[kind] * reached
+    for color, enemy, sign in (("w", "bP", 1), ("b", "wP", -1)):
+        files = pawn_files[color]
+        side_score = 0
+        for column in range(8):
+            side_score += DOUBLED_PAWN * max(files[column] - 1, 0)
+            if not any(files[near] for near in (column - 1, column + 1) if 0 <= near < 8):
+                side_score += ISOLATED_PAWN * files[column]
+        for square, piece in enumerate(pieces):
+            if piece != color + "P":
+                continue
+            row, column = square >> 3, square & 7
+            ahead = range(row) if color == "w" else range(row + 1, 8)
+            if not any(pieces[near_row * 8 + near] == enemy for near_row in ahead
+                       for near in (column - 1, column, column + 1) if 0 <= near < 8):
+                side_score += float(PASSED_PAWN[row if color == "w" else 7 - row])
+        score += sign * side_score
+    return score
+
+
+def evaluate(gs):
+    """
+    Score of the position on gs
+    :return: centipawns from the side to move's point of view
+    """
+    score = float(evaluate_codes(np.array([encode(gs)], dtype=np.int8))[0])
+    return score if gs.white_to_move else -score
+
+
+def evaluate_many(states):
+    """
+    Scores of several GameStates in one pass
+    :return: (positions,) array of centipawns, each from its side to move's point of view
+    """
+    codes = np.array([encode(gs) for gs in states], dtype=np.int8).reshape(-1, 64)
+    signs = np.array([1 if gs.white_to_move else -1 for gs in states], dtype=np.float32)
+    return evaluate_codes(codes) * signs
+
+
+def score_moves(gs, moves=None):
+    """
+    Scores the position after each move in one pass
+    :param moves: moves to score, gs.get_valid_moves() if not given
+    :return: (moves, scores): scores is an array of centipawns from the point of view of the side to move in gs
+    """
+    if moves is None:
+        checkmate, stalemate = gs.checkmate, gs.stalemate
+        moves = gs.get_valid_moves()
+        gs.checkmate, gs.stalemate = checkmate, stalemate
+    codes = []
+    for move in moves:
+        gs.make_move(move)
+        codes.append(encode(gs))
+        gs.undo_move()
+    scores = evaluate_codes(np.array(codes, dtype=np.int8).reshape(-1, 64))
+    return moves, scores if gs.white_to_move else -scores
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time batched against plain Python evaluation")
+    parser.add_argument("--positions", type=int, default=4096)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    codes = []
+    while len(codes) < args.positions:  # children of the positions of random games
+        gs = ChessEngine.GameState()
+        for _ in range(rng.randrange(60)):
+            moves = gs.get_valid_moves()
+            if not moves:
+                break
+            gs.make_move(rng.choice(moves))
+        for move in gs.get_valid_moves():
+            gs.make_move(move)
+            codes.append(encode(gs))
+            gs.undo_move()
+    codes = np.array(codes[:args.positions], dtype=np.int8)
+
+    start = time.perf_counter()
+    batched = evaluate_codes(codes)
+    batched_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    single = np.array([evaluate_one(position) for position in codes.tolist()])
+    single_seconds = time.perf_counter() - start
+    assert np.allclose(batched, single)
+    print("{} positions: batched {:.0f} positions/s, plain Python one at a time {:.0f} positions/s ({:.1f}x)".format(
+        len(codes), len(codes) / batched_seconds, len(codes) / single_seconds, single_seconds / batched_seconds))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
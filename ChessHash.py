@@ -0,0 +1,130 @@
+"""
+Zobrist keys for identifying positions and a fixed size transposition table.
+The keys come from a seeded generator, so the same position has the same key in every process.
+"""
+
+import random
+from array import array
+
+ZOBRIST_SEED = 20200712
+_generator = random.Random(ZOBRIST_SEED)
+
+PIECE_KEYS = {}  # piece -> list of 64 keys, square index = row * 8 + column
+for _piece in ("wP", "wN", "wB", "wR", "wQ", "wK", "bP", "bN", "bB", "bR", "bQ", "bK"):
+    PIECE_KEYS[_piece] = [_generator.getrandbits(64) for _ in range(64)]
+BLACK_TO_MOVE_KEY = _generator.getrandbits(64)
+ENPASSANT_KEYS = [_generator.getrandbits(64) for _ in range(8)]  # one per column of the en passant square
+_castle_keys = [_generator.getrandbits(64) for _ in range(4)]  # wKs, bKs, wQs, bQs
+# key for every combination of castling rights, indexed by castle_rights_index
+CASTLE_KEYS = []
+for _index in range(16):
+    _key = 0
+    for _bit in range(4):
+        if _index >> _bit & 1:
+            _key ^= _castle_keys[_bit]
+    CASTLE_KEYS.append(_key)
+
+
+def castle_rights_index(rights):
+    """
+    Packs a CastleRights object into 4 bits (wKs, bKs, wQs, bQs)
+    """
+    return rights.wKs | rights.bKs << 1 | rights.wQs << 2 | rights.bQs << 3
+
+
+def enpassant_key(enpassant_possible):
+    if enpassant_possible == ():
+        return 0
+    return ENPASSANT_KEYS[enpassant_possible[1]]
+
+
+def zobrist_key(board, white_to_move, castle_rights, enpassant_possible):
+    """
+    Computes the key of a position from scratch
+    GameState keeps its key up to date move by move, this is for setting up positions and checking
+    """
+    key = 0
+    for row in range(8):
+        for column in range(8):
+            piece = board[row][column]
+            if piece != "--":
+                key ^= PIECE_KEYS[piece][row * 8 + column]
+    if not white_to_move:
+        key ^= BLACK_TO_MOVE_KEY
+    return key ^ CASTLE_KEYS[castle_rights_index(castle_rights)] ^ enpassant_key(enpassant_possible)
+
+
+# bound types of a stored score
+EXACT = 0
+LOWER_BOUND = 1  # failed high, the real score is at least this
+UPPER_BOUND = 2  # failed low, the real score is at most this
+
+# bytes per entry: key 8, score 4, best move 4, depth 2, bound 1, age 1
+ENTRY_SIZE = 20
+
+
+class TranspositionTable:
+    """
+    Fixed size hash table of search results keyed by Zobrist key.
+    Every field lives in its own typed array, so the memory used is set up front by size_mb
+    and nothing is allocated while searching.
+    A slot is replaced when it is empty, holds the same position, was written in an older search,
+    or was searched less deep than the new result
+    """
+    def __init__(self, size_mb=16):
+        entries = 1
+        while entries * 2 * ENTRY_SIZE <= size_mb * 1024 * 1024:
+            entries *= 2
+        self.size_mb = size_mb
+        self.size = entries
+        self.mask = entries - 1
+        self.keys = array("Q", bytes(8 * entries))
+        self.scores = array("i", bytes(4 * entries))
+        self.moves = array("i", bytes(4 * entries))  # move_ID of the best move, 0 for none
+        self.depths = array("h", bytes(2 * entries))
+        self.bounds = array("b", bytes(entries))
+        self.ages = array("B", bytes(entries))
+        self.age = 1  # 0 marks an empty slot
+        self.hits = 0
+        self.misses = 0
+
+    def new_search(self):
+        """
+        Marks everything stored so far as old, so it gets replaced first
+        """
+        self.age = self.age % 255 + 1
+
+    def clear(self):
+        self.__init__(self.size_mb)
+
+    def store(self, key, depth, bound, score, best_move_id=0):
+        index = key & self.mask
+        if self.ages[index] == 0 or self.keys[index] == key or self.ages[index] != self.age or \
+                depth >= self.depths[index]:
+            if best_move_id == 0 and self.keys[index] == key:
+                best_move_id = self.moves[index]  # keep the old best move rather than none
+            self.keys[index] = key
+            self.depths[index] = depth
+            self.bounds[index] = bound
+            self.scores[index] = score
+            self.moves[index] = best_move_id
+            self.ages[index] = self.age
+
+    def probe(self, key):
+        """
+        :return: (depth, bound, score, best_move_id) stored for the key, or None
+        """
+        index = key & self.mask
+        if self.ages[index] != 0 and self.keys[index] == key:
+            self.hits += 1
+            return self.depths[index], self.bounds[index], self.scores[index], self.moves[index]
+        self.misses += 1
+        return None
+
+    def hashfull(self):
+        """
+        Permille of the first 1000 slots that hold an entry from the current search (as reported over UCI)
+        """
+        sample = min(1000, self.size)
+        used = sum(1 for index in range(sample) if self.ages[index] == self.age)
+        return used * 1000 // sample
@@ -3,14 +3,33 @@ Main driver file.
 Responsible for handling user input and displaying the current GameState object
 """
 
+import queue
+import threading
+import time
+
 import pygame as p
+import ChessBook
 import ChessEngine
+import ChessProfile
+import ChessSearch
+import ChessTablebase
 
 WIDTH = HEIGHT = 512
 DIMENSION = 8
 SQ_SIZE = HEIGHT // DIMENSION
-MAX_FPS = 15  # for animation later on
+MAX_FPS = 60  # frame rate while a move is animating, otherwise the loop sleeps until something happens
+SECONDS_PER_SQUARE = 0.1  # animation speed
 IMAGES = {}
+PLAYER_ONE = True  # True if a human plays white, False if the computer does
+PLAYER_TWO = False  # same for black
+AI_THINK_TIME = 3  # seconds the computer gets per move
+OPENING_BOOK = "book.bin"  # the computer plays moves from this book while it has any (see ChessBook.py)
+TABLEBASES = "tablebases"  # endgames with tables in this directory are played perfectly (see ChessTablebase.py)
+MOVE_CACHE_SIZE = 1024  # positions whose valid moves are remembered (undo and reset reuse them)
+AI_MOVE_EVENT = p.USEREVENT + 1  # posted by the worker thread to wake up the main loop
+PROFILE_EVENT = p.USEREVENT + 2  # refreshes the profiler overlay
+PROFILE_REFRESH_MS = 500
+PROFILE_FILE = "profile.json"  # where the profiler's numbers go when P turns it off (see ChessProfile.py)
 
 
 def draw_board(screen):
@@ -26,87 +45,179 @@ def draw_board(screen):
             p.draw.rect(screen, color, p.Rect(column*SQ_SIZE, row*SQ_SIZE, SQ_SIZE, SQ_SIZE))
 
 
-def animate_move(move, screen, board, clock):
-    """
-    Animating a move
+class MoveAnimation:
     """
-    global colors
-    delta_row = move.end_row - move.start_row
-    delta_column = move.end_column - move.start_column
-    frames_per_square = 7
-    frame_count = (abs(delta_row) + abs(delta_column)) * frames_per_square
-    for frame in range(frame_count+1):
-        row, column = (move.start_row + delta_row*frame/frame_count,
-                       move.start_column + delta_column*frame/frame_count)
-        draw_board(screen)
-        draw_pieces(screen, board)
-        # erase the piece moved from its ending square
-        color = colors[(move.end_row + move.end_column) % 2]
-        end_sqaure = p.Rect(move.end_column*SQ_SIZE, move.end_row*SQ_SIZE, SQ_SIZE, SQ_SIZE)
-        p.draw.rect(screen, color, end_sqaure)
-        # draw captured piece onto rectangle
-        if move.piece_captured != "--":
-            screen.blit(IMAGES[move.piece_captured], end_sqaure)
-        # draw moving piece
-        screen.blit(IMAGES[move.piece_moved], p.Rect(column*SQ_SIZE, row*SQ_SIZE, SQ_SIZE, SQ_SIZE))
-        p.display.flip()
-        clock.tick(60)
-
-
-def draw_pieces(screen, board):
-    """
-    Draws the pieces on the board using the current gs.board
-    Separate from draw_board for Highlighting purposes
+    A piece sliding from the start to the end square of a move, over a time that grows with the distance.
+    The main loop draws a frame of it each time around, so input keeps being handled meanwhile
     """
-    for row in range(DIMENSION):
-        for column in range(DIMENSION):
-            piece = board[row][column]
-            if piece != "--":  # check to make sure it's not an empty square
-                screen.blit(IMAGES[piece], p.Rect(column*SQ_SIZE, row*SQ_SIZE, SQ_SIZE, SQ_SIZE))
+    def __init__(self, move):
+        self.move = move
+        distance = abs(move.end_row - move.start_row) + abs(move.end_column - move.start_column)
+        self.duration = distance * SECONDS_PER_SQUARE
+        self.start_time = time.perf_counter()
 
+    def progress(self):
+        """
+        :return: how far along the animation is, from 0 to 1
+        """
+        if self.duration <= 0:
+            return 1
+        return min(1, (time.perf_counter() - self.start_time) / self.duration)
 
-def draw_game_state(screen, gs, valid_moves, square_selected):
-    """
-    Responsible for all graphics in the current game state
-    """
-    draw_board(screen)  # draws the squares
-    highlight_squares(screen, gs, valid_moves, square_selected)
-    draw_pieces(screen, gs.board)  # draws pieces on top of squares
+    def piece_rect(self):
+        """
+        Where the moving piece is drawn in this frame
+        """
+        move = self.move
+        progress = self.progress()
+        row = move.start_row + (move.end_row - move.start_row) * progress
+        column = move.start_column + (move.end_column - move.start_column) * progress
+        return p.Rect(round(column*SQ_SIZE), round(row*SQ_SIZE), SQ_SIZE, SQ_SIZE)
 
 
-def draw_text(screen, text):
+class BoardRenderer:
     """
-    Draws text on the screen
+    Draws the game on the screen, redrawing only the squares that changed since the last frame
+    and handing just those to display.update. The board, the highlight overlays, fonts and text are rendered once
     """
-    font = p.font.SysFont("Helvitca", 32, True, False)
-    text_object = font.render(text, 0, p.Color("Red"))
-    text_location = p.Rect(0, 0, WIDTH, HEIGHT).move(WIDTH/2 - text_object.get_width()/2,
-                                                     HEIGHT/2 - text_object.get_height()/2)
-    screen.blit(text_object, text_location)
-    font = p.font.SysFont("Helvitca", 24, True, False)
-    text_object = font.render("Press R to restart", 0, p.Color("Red"))
-    text_location = p.Rect(0, 0, WIDTH, HEIGHT).move(WIDTH / 2 - text_object.get_width() / 2,
-                                                     HEIGHT / 2 - text_object.get_height() / 2)
-    screen.blit(text_object, text_location.move(0, 50))
+    def __init__(self, screen):
+        self.screen = screen
+        self.background = p.Surface((WIDTH, HEIGHT))
+        draw_board(self.background)
+        self.selected_overlay = p.Surface((SQ_SIZE, SQ_SIZE))
+        self.selected_overlay.set_alpha(100)  # transparency value
+        self.selected_overlay.fill(p.Color("black"))
+        self.move_overlay = p.Surface((SQ_SIZE, SQ_SIZE))
+        self.move_overlay.set_alpha(100)
+        self.move_overlay.fill(p.Color("red"))
+        self.fonts = {}  # size -> font
+        self.texts = {}  # (text, size) -> rendered text
+        self.drawn = None  # what each square showed last frame, (piece, highlight); None to redraw everything
+        self.drawn_banner = None
+        self.drawn_piece_rect = None  # where the animated piece was drawn last frame
+        self.drawn_overlay = None
+        self.overlay_rect = None  # where the overlay was drawn last
 
+    def invalidate(self):
+        """
+        Makes the next draw redraw the whole board (after something else drew on the screen)
+        """
+        self.drawn = None
 
-def highlight_squares(screen, gs, valid_moves, square_selected):
-    """
-    Highlight square selected and moves for piece selected
-    """
-    if square_selected != ():
-        row, column = square_selected
-        if gs.board[row][column][0] == ("w" if gs.white_to_move else "b"):  # square_selected is a piece that can move
-            # highlight selected square
-            surface = p.Surface((SQ_SIZE, SQ_SIZE))
-            surface.set_alpha(100)  # transparency value
-            surface.fill(p.Color("black"))
-            screen.blit(surface, (column*SQ_SIZE, row*SQ_SIZE))
-            # highlight moves from that square
-            surface.fill(p.Color("red"))
-            for move in valid_moves:
-                if move.start_row == row and move.start_column == column:
-                    screen.blit(surface, (move.end_column*SQ_SIZE, move.end_row*SQ_SIZE))
+    def text(self, text, size):
+        if (text, size) not in self.texts:
+            if size not in self.fonts:
+                self.fonts[size] = p.font.SysFont("Helvitca", size, True, False)
+            self.texts[(text, size)] = self.fonts[size].render(text, 0, p.Color("Red"))
+        return self.texts[(text, size)]
+
+    def square_contents(self, gs, valid_moves, square_selected):
+        """
+        What every square should show: (piece, highlight) with highlight 0 for none,
+        1 for the selected piece and 2 for a square it can move to
+        """
+        highlights = [0] * (DIMENSION * DIMENSION)
+        if square_selected != ():
+            row, column = square_selected
+            if gs.board[row][column][0] == ("w" if gs.white_to_move else "b"):  # a piece that can move
+                highlights[row * DIMENSION + column] = 1
+                for move in valid_moves:
+                    if move.start_row == row and move.start_column == column:
+                        highlights[move.end_row * DIMENSION + move.end_column] = 2
+        return [(gs.board[index // DIMENSION][index % DIMENSION], highlights[index])
+                for index in range(DIMENSION * DIMENSION)]
+
+    def draw(self, gs, valid_moves, square_selected, banner=None, animation=None, overlay=None):
+        """
+        Brings the screen up to date with the game, the highlights, the game over banner (text or None),
+        the frame of a MoveAnimation that is still running and the profiler overlay (list of lines or None)
+        """
+        if banner != self.drawn_banner or overlay != self.drawn_overlay:
+            self.drawn = None  # the banner and the overlay cover squares all over the board
+            self.drawn_banner = banner
+            self.drawn_overlay = overlay
+        contents = self.square_contents(gs, valid_moves, square_selected)
+        redraw = set()  # squares the animated piece covers this frame or covered last frame
+        piece_rect = None
+        if animation is not None:
+            move = animation.move
+            # the piece is still on its way, so the end square shows what was there before
+            end = move.end_row * DIMENSION + move.end_column
+            contents[end] = ("--" if move.is_enpassant_move else move.piece_captured, contents[end][1])
+            piece_rect = animation.piece_rect()
+            redraw.update(self.squares_under(piece_rect))
+        if self.drawn_piece_rect is not None:
+            redraw.update(self.squares_under(self.drawn_piece_rect))
+        changed = [index for index, content in enumerate(contents)
+                   if self.drawn is None or self.drawn[index] != content or index in redraw]
+        if changed and overlay is not None and self.overlay_rect is not None:
+            # the overlay is see-through, drawn again over squares that weren't redrawn it would get darker
+            changed = sorted(set(changed).union(self.squares_under(self.overlay_rect)))
+        dirty = [self.draw_square(index, contents[index]) for index in changed]
+        self.drawn = contents
+        if piece_rect is not None:
+            dirty.append(self.screen.blit(IMAGES[animation.move.piece_moved], piece_rect))
+        self.drawn_piece_rect = piece_rect
+        if banner is not None and dirty:
+            dirty.extend(self.draw_banner(banner))
+        if overlay is not None and dirty:
+            self.overlay_rect = self.draw_overlay(overlay)
+            dirty.append(self.overlay_rect)
+        if dirty:
+            p.display.update(dirty)
+
+    def squares_under(self, rect):
+        """
+        Indices of the squares a rect overlaps
+        """
+        rect = rect.clip(p.Rect(0, 0, WIDTH, HEIGHT))
+        return [row * DIMENSION + column for row in range(rect.top // SQ_SIZE, (rect.bottom - 1) // SQ_SIZE + 1)
+                for column in range(rect.left // SQ_SIZE, (rect.right - 1) // SQ_SIZE + 1)]
+
+    def draw_square(self, index, content):
+        piece, highlight = content
+        rect = p.Rect(index % DIMENSION * SQ_SIZE, index // DIMENSION * SQ_SIZE, SQ_SIZE, SQ_SIZE)
+        self.screen.blit(self.background, rect, rect)
+        if highlight == 1:
+            self.screen.blit(self.selected_overlay, rect)
+        elif highlight == 2:
+            self.screen.blit(self.move_overlay, rect)
+        if piece != "--":
+            self.screen.blit(IMAGES[piece], rect)
+        return rect
+
+    def draw_banner(self, text):
+        """
+        Draws the game over text in the middle of the board
+        :return: the rects drawn on
+        """
+        rects = []
+        for line, size, offset in ((text, 32, 0), ("Press R to restart", 24, 50)):
+            text_object = self.text(line, size)
+            text_location = p.Rect(0, 0, WIDTH, HEIGHT).move(WIDTH/2 - text_object.get_width()/2,
+                                                             HEIGHT/2 - text_object.get_height()/2 + offset)
+            rects.append(self.screen.blit(text_object, text_location))
+        return rects
+
+    def draw_overlay(self, lines):
+        """
+        Draws lines of text on a dark box in the top left corner (the numbers change, so they aren't kept in texts)
+        :return: the rect drawn on
+        """
+        if 14 not in self.fonts:
+            self.fonts[14] = p.font.SysFont("Helvitca", 14, True, False)
+        rendered = [self.fonts[14].render(line, 1, p.Color("white")) for line in lines]
+        width = max([text.get_width() for text in rendered] + [0]) + 8
+        height = sum(text.get_height() for text in rendered) + 8
+        box = p.Surface((width, height))
+        box.set_alpha(180)
+        box.fill(p.Color("black"))
+        rect = self.screen.blit(box, (0, 0))
+        top = 4
+        for text in rendered:
+            self.screen.blit(text, (4, top))
+            top += text.get_height()
+        return rect
 
 
 def load_images():
@@ -119,6 +230,31 @@ def load_images():
         IMAGES[piece] = p.transform.scale(p.image.load("images/" + piece + ".png"), (SQ_SIZE, SQ_SIZE))
 
 
+def find_computer_move(searcher, gs, result_queue):
+    """
+    Runs on the worker thread: searches its own copy of the game and hands the result to the main loop
+    """
+    result_queue.put(searcher.search(gs, time_limit=AI_THINK_TIME))
+    p.event.post(p.event.Event(AI_MOVE_EVENT))
+
+
+def human_to_move(gs):
+    """
+    Determine if the side to move is played by a human
+    """
+    return (gs.white_to_move and PLAYER_ONE) or (not gs.white_to_move and PLAYER_TWO)
+
+
+def stop_computer(searcher, ai_thread):
+    """
+    Stops a search that is no longer wanted (after undo/reset) and waits for the worker to finish
+    """
+    if ai_thread is not None:
+        while ai_thread.is_alive():
+            searcher.stop()  # again if the search only just started and cleared it
+            ai_thread.join(0.01)
+
+
 def main():
     """
     Main driver.
@@ -128,22 +264,47 @@ def main():
     screen = p.display.set_mode((WIDTH, HEIGHT))
     clock = p.time.Clock()
     screen.fill(p.Color("white"))
+    renderer = BoardRenderer(screen)
+    move_cache = ChessEngine.MoveCache(MOVE_CACHE_SIZE)  # kept across undo and reset
     gs = ChessEngine.GameState()
+    gs.move_cache = move_cache
     valid_moves = gs.get_valid_moves()
     move_made = False  # Flag variable for when a move is made
     animate = False  # Flag variable for when to animate
+    animation = None  # MoveAnimation still running, if any
     load_images()
     running = True
     square_selected = ()  # no square selected initially, keeps track of the last user click
     player_clicks = []  # keeps track of player clicks [(1,2),(2,2)]
     game_over = False
+    searcher = ChessSearch.Searcher()
+    profiler = ChessProfile.Profiler()  # off until P is pressed
+    profiler.watch("move cache", move_cache)
+    profiler.watch("search table", searcher.tt)
+    overlay = None  # profiler lines shown over the board
+    book = ChessBook.open_book(OPENING_BOOK)  # None without a book file
+    tablebases = ChessTablebase.open_tablebases(TABLEBASES)  # None without the directory
+    ai_thread = None  # worker thread while the computer is thinking
+    ai_results = None  # queue the worker puts its SearchResult on
     while running:
-        for e in p.event.get():
+        human_turn = human_to_move(gs)
+        computer_to_start = not game_over and not human_turn and ai_thread is None
+        if animation is None and not computer_to_start:
+            events = [p.event.wait()] + p.event.get()  # nothing to do until something happens
+        else:
+            events = p.event.get()
+        for e in events:
             if e.type == p.QUIT:
                 running = False
+                stop_computer(searcher, ai_thread)
+                ai_thread = None
+            elif e.type == p.VIDEOEXPOSE:  # the window was covered up, draw all of it again
+                renderer.invalidate()
+            elif e.type == PROFILE_EVENT:
+                overlay = profiler.summary_lines() if profiler.enabled else None
             # mouse handlers
             elif e.type == p.MOUSEBUTTONDOWN:
-                if not game_over:
+                if not game_over and human_turn:
                     location = p.mouse.get_pos()  # (x,y) location of mouse
                     column = location[0]//SQ_SIZE
                     row = location[1]//SQ_SIZE
@@ -168,38 +329,108 @@ def main():
                             player_clicks = [square_selected]
             # key handlers
             elif e.type == p.KEYDOWN:
+                if e.key == p.K_p:
+                    if profiler.enabled:
+                        profiler.disable()
+                        profiler.export(PROFILE_FILE)
+                        print("profile written to " + PROFILE_FILE)
+                        p.time.set_timer(PROFILE_EVENT, 0)
+                        overlay = None
+                    else:
+                        profiler.enable()
+                        p.time.set_timer(PROFILE_EVENT, PROFILE_REFRESH_MS)
+                        overlay = profiler.summary_lines()
                 if e.key == p.K_z:
+                    stop_computer(searcher, ai_thread)
+                    ai_thread = None
                     gs.undo_move()
+                    if PLAYER_ONE != PLAYER_TWO and not human_to_move(gs):
+                        gs.undo_move()  # the computer's reply too, or it would just play it again
                     move_made = True
                     animate = False
+                    animation = None
                     game_over = False
                 if e.key == p.K_r:
+                    stop_computer(searcher, ai_thread)
+                    ai_thread = None
                     gs = ChessEngine.GameState()
+                    gs.move_cache = move_cache
                     valid_moves = gs.get_valid_moves()
                     square_selected = ()
                     player_clicks = []
                     move_made = False
                     animate = False
+                    animation = None
                     game_over = False
+        # computer move, searched on a worker thread so the window keeps responding
+        human_turn = human_to_move(gs)  # again, a reset may have handed the move back to the human
+        if not game_over and not human_turn and not move_made:
+            book_move = book.choose_move(gs) if book is not None and ai_thread is None else None
+            tablebase_move = None
+            if book_move is None and tablebases is not None and ai_thread is None:
+                tablebase_move = tablebases.best_move(gs)
+            if book_move is not None:
+                gs.make_move(book_move)
+                print(book_move.get_chess_notation() + " (book)")
+                move_made = True
+                animate = True
+            elif tablebase_move is not None:
+                gs.make_move(tablebase_move)
+                print(tablebase_move.get_chess_notation() + " (tablebase)")
+                move_made = True
+                animate = True
+            elif ai_thread is None:
+                ai_results = queue.Queue()
+                ai_gs = gs.clone()  # comes without the move cache, the search rarely sees a position twice
+                ai_thread = threading.Thread(target=find_computer_move,
+                                             args=(searcher, ai_gs, ai_results), daemon=True)
+                ai_thread.start()
+            elif not ai_results.empty():
+                result = ai_results.get()
+                ai_thread = None
+                for valid_move in valid_moves:
+                    if valid_move == result.best_move:
+                        gs.make_move(valid_move)
+                        print(valid_move.get_chess_notation())
+                        move_made = True
+                        animate = True
+                        break
+
         if move_made:
             if animate:
-                animate_move(gs.move_log[-1], screen, gs.board, clock)
+                animation = MoveAnimation(gs.move_log[-1])
             valid_moves = gs.get_valid_moves()
             move_made = False
             animate = False
-        draw_game_state(screen, gs, valid_moves, square_selected)
-
+        banner = None
         if gs.checkmate:
             game_over = True
             if gs.white_to_move:
-                draw_text(screen, "Black wins by checkmate")
+                banner = "Black wins by checkmate"
             else:
-                draw_text(screen, "White wins by checkmate")
+                banner = "White wins by checkmate"
         elif gs.stalemate:
             game_over = True
-            draw_text(screen, "Stalemate")
-        clock.tick(MAX_FPS)
-        p.display.flip()
+            banner = "Stalemate"
+        elif gs.draw_by_repetition:
+            game_over = True
+            banner = "Draw by threefold repetition"
+        elif gs.draw_by_fifty_moves:
+            game_over = True
+            banner = "Draw by the fifty-move rule"
+        elif gs.draw_by_insufficient_material:
+            game_over = True
+            banner = "Draw by insufficient material"
+        frame_start = time.perf_counter()
+        renderer.draw(gs, valid_moves, square_selected, banner, animation, overlay)
+        if profiler.enabled:
+            profiler.record_frame(time.perf_counter() - frame_start)
+        if animation is not None:
+            if animation.progress() >= 1:
+                animation = None
+                renderer.draw(gs, valid_moves, square_selected, banner, None, overlay)  # the piece lands on its square
+            else:
+                clock.tick(MAX_FPS)
 
 
 if __name__ == "__main__":
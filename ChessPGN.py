@@ -0,0 +1,258 @@
+"""
+Reading and writing games in PGN, with moves in standard algebraic notation (SAN).
+read_games() is a generator that parses one game at a time from a file, so files of any size
+are read in constant memory; replay() plays a parsed game out on a GameState.
+
+    with open("games.pgn") as pgn_file:
+        for game in ChessPGN.read_games(pgn_file):
+            gs = ChessPGN.replay(game)
+"""
+
+import re
+
+import ChessEngine
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+SEVEN_TAG_ROSTER = ("Event", "Site", "Date", "Round", "White", "Black", "Result")
+
+SAN_PATTERN = re.compile(r"^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?$")
+HEADER_PATTERN = re.compile(r'^\[(\w+)\s+"(.*)"\]\s*$')
+# movetext tokens: comments, variations, NAGs, move numbers, results and moves
+TOKEN_PATTERN = re.compile(r"\{[^}]*\}?|;.*|\(|\)|\$\d+|\d+\.+|1-0|0-1|1/2-1/2|\*|[^\s{};()$]+")
+
+
+class PGNGame:
+    """
+    One game from a PGN file: its header tags, the moves in SAN and the result
+    """
+    def __init__(self, headers=None, moves=None, result="*"):
+        self.headers = headers if headers is not None else {}
+        self.moves = moves if moves is not None else []
+        self.result = result
+
+    def starting_fen(self):
+        if self.headers.get("SetUp") == "1" and "FEN" in self.headers:
+            return self.headers["FEN"]
+        return START_FEN
+
+
+def move_to_san(gs, move, valid_moves=None):
+    """
+    SAN of a move in the current position of gs (before the move is made), e.g. "Nbd7", "exd5", "e8=Q+", "O-O#"
+    :param valid_moves: gs.get_valid_moves(), if already at hand
+    """
+    if valid_moves is None:
+        valid_moves = gs.get_valid_moves()
+    if move.is_castle_move:
+        san = "O-O" if move.end_column > move.start_column else "O-O-O"
+    else:
+        piece_type = move.piece_moved[1]
+        destination = move.get_rank_file(move.end_row, move.end_column)
+        capture = "x" if move.piece_captured != "--" else ""
+        if piece_type == "P":
+            san = (ChessEngine.Move.columns_to_files[move.start_column] if capture else "") + capture + destination
+            if move.is_pawn_promotion:
+                san += "=" + move.promotion_piece
+        else:
+            # other pieces of the same type that can reach the same square
+            rivals = [other for other in valid_moves if other.piece_moved == move.piece_moved and
+                      other.end_row == move.end_row and other.end_column == move.end_column and
+                      (other.start_row, other.start_column) != (move.start_row, move.start_column)]
+            disambiguation = ""
+            if rivals:
+                if all(other.start_column != move.start_column for other in rivals):
+                    disambiguation = ChessEngine.Move.columns_to_files[move.start_column]
+                elif all(other.start_row != move.start_row for other in rivals):
+                    disambiguation = ChessEngine.Move.row_to_ranks[move.start_row]
+                else:
+                    disambiguation = move.get_rank_file(move.start_row, move.start_column)
+            san = piece_type + disambiguation + capture + destination
+    # check and mate
+    gs.make_move(move)
+    if gs.in_check():
+        san += "+" if gs.has_legal_move() else "#"
+    gs.undo_move()
+    return san
+
+
+def san_to_move(gs, san, valid_moves=None):
+    """
+    Finds the valid move in the current position of gs that the SAN describes
+    :raises ValueError: if the SAN doesn't match exactly one valid move
+    """
+    if valid_moves is None:
+        valid_moves = gs.get_valid_moves()
+    text = san.rstrip("+#!?")
+    if text in ("O-O", "0-0", "O-O-O", "0-0-0"):
+        king_side = len(text) == 3
+        for move in valid_moves:
+            if move.is_castle_move and (move.end_column > move.start_column) == king_side:
+                return move
+        raise ValueError("Illegal move: " + san)
+    match = SAN_PATTERN.match(text)
+    if match is None:
+        raise ValueError("Invalid SAN: " + san)
+    piece_type, from_file, from_rank, destination, promotion = match.groups()
+    piece_type = piece_type or "P"
+    end_row = ChessEngine.Move.ranks_to_rows[destination[1]]
+    end_column = ChessEngine.Move.files_to_columns[destination[0]]
+    candidates = []
+    for move in valid_moves:
+        if move.end_row != end_row or move.end_column != end_column or move.piece_moved[1] != piece_type or \
+                move.is_castle_move:
+            continue
+        if from_file is not None and move.start_column != ChessEngine.Move.files_to_columns[from_file]:
+            continue
+        if from_rank is not None and move.start_row != ChessEngine.Move.ranks_to_rows[from_rank]:
+            continue
+        if move.is_pawn_promotion and move.promotion_piece != (promotion or "Q"):
+            continue
+        candidates.append(move)
+    if len(candidates) != 1:
+        raise ValueError(("Ambiguous" if candidates else "Illegal") + " move: " + san)
+    return candidates[0]
+
+
+def read_games(pgn_file):
+    """
+    Generator over the games in a PGN file (or any iterable of lines).
+    Only the game being parsed is held in memory. Comments, variations and NAGs are skipped
+    """
+    game = None
+    in_movetext = False
+    comment_open = False  # inside a {comment} that spans lines
+    variation_depth = 0
+    for line in pgn_file:
+        line = line.strip()
+        if comment_open:
+            end = line.find("}")
+            if end < 0:
+                continue
+            line = line[end + 1:]
+            comment_open = False
+        if not line or line.startswith("%"):
+            continue
+        if line.startswith("[") and variation_depth == 0:
+            header = HEADER_PATTERN.match(line)
+            if header is not None:
+                if game is not None and in_movetext:
+                    yield game  # a new game starts
+                    game = None
+                if game is None:
+                    game = PGNGame()
+                    in_movetext = False
+                game.headers[header.group(1)] = header.group(2).replace('\\"', '"')
+                continue
+        if game is None:
+            game = PGNGame()
+        in_movetext = True
+        for token in TOKEN_PATTERN.findall(line):
+            if token.startswith("{"):
+                comment_open = not token.endswith("}")
+            elif token.startswith(";") or token.startswith("$") or token[0].isdigit() and token.endswith("."):
+                continue
+            elif token == "(":
+                variation_depth += 1
+            elif token == ")":
+                variation_depth = max(0, variation_depth - 1)
+            elif variation_depth > 0:
+                continue
+            elif token in RESULTS:
+                game.result = token
+                yield game
+                game = PGNGame()  # in case another game follows without tags
+                in_movetext = False
+            else:
+                game.moves.append(token)
+    if game is not None and (game.moves or game.headers):
+        yield game
+
+
+def replay(game, backend="list"):
+    """
+    Plays the moves of a PGNGame on a new GameState
+    :return: the GameState after the last move
+    :raises ValueError: on an illegal or ambiguous move
+    """
+    gs = ChessEngine.GameState.from_fen(game.starting_fen(), backend)
+    for san in game.moves:
+        gs.make_move(san_to_move(gs, san))
+    return gs
+
+
+def game_result(gs):
+    """
+    Result tag for the current position: a win if the side to move is checkmated, a draw on stalemate,
+    repetition, the fifty-move rule or insufficient material, else "*"
+    """
+    if not gs.has_legal_move():
+        if gs.in_check():
+            return "0-1" if gs.white_to_move else "1-0"
+        return "1/2-1/2"
+    if gs.is_draw():
+        return "1/2-1/2"
+    return "*"
+
+
+def game_to_pgn(gs, headers=None, result=None):
+    """
+    PGN text of the game played on gs so far (gs is left as it was)
+    :param headers: tags to add or override, e.g. {"White": "...", "Event": "..."}
+    :param result: result tag, worked out from the position if not given
+    """
+    moves = list(gs.move_log)
+    checkmate, stalemate = gs.checkmate, gs.stalemate  # move_to_san's get_valid_moves sets them
+    for _ in moves:
+        gs.undo_move()
+    start_fen = gs.to_fen()
+    sans = []
+    for move in moves:
+        sans.append(move_to_san(gs, move))
+        gs.make_move(move)
+    gs.checkmate, gs.stalemate = checkmate, stalemate
+    if result is None:
+        result = game_result(gs)
+
+    tags = {"Event": "?", "Site": "?", "Date": "????.??.??", "Round": "?", "White": "?", "Black": "?"}
+    if headers:
+        tags.update(headers)
+    tags["Result"] = result
+    if start_fen != START_FEN:
+        tags["SetUp"] = "1"
+        tags["FEN"] = start_fen
+    lines = []
+    for name in SEVEN_TAG_ROSTER + tuple(name for name in tags if name not in SEVEN_TAG_ROSTER):
+        lines.append('[' + name + ' "' + str(tags[name]).replace('"', '\\"') + '"]')
+    lines.append("")
+
+    # movetext, wrapped at 80 characters
+    white_first = start_fen.split()[1] == "w"
+    move_number = int(start_fen.split()[5])
+    tokens = []
+    for ply, san in enumerate(sans):
+        white_move = (ply % 2 == 0) == white_first
+        if white_move:
+            tokens.append(str(move_number) + ".")
+        elif ply == 0:
+            tokens.append(str(move_number) + "...")
+        tokens.append(san)
+        if not white_move:
+            move_number += 1
+    tokens.append(result)
+    line = ""
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > 80:
+            lines.append(line)
+            line = token
+        else:
+            line = line + " " + token if line else token
+    lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def write_game(pgn_file, gs, headers=None, result=None):
+    """
+    Appends the game played on gs to an open PGN file, followed by a blank line
+    """
+    pgn_file.write(game_to_pgn(gs, headers, result) + "\n")
@@ -0,0 +1,375 @@
+"""
+Perft (performance test) for the move generator.
+Counts every leaf of the legal move tree to a given depth and compares against known node counts,
+which catches mistakes in en passant, castling and promotion, and reports nodes per second.
+
+Command line:
+    $ python ChessPerft.py                         run the reference suite
+    $ python ChessPerft.py --depth 3 --divide      perft of the start position, split by first move
+    $ python ChessPerft.py --fen "<fen>" --depth 4 --backend bitboard --json
+    $ python ChessPerft.py --bench                 time and memory of move generation
+As a test module (perft counts, the staged generators, SAN/PGN and draw counters):
+    $ python -m unittest ChessPerft
+"""
+
+import argparse
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+import unittest
+
+import ChessEngine
+import ChessPGN
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# name -> (FEN, node counts for depth 1, 2, 3, ...)
+# positions and counts from https://www.chessprogramming.org/Perft_Results
+REFERENCE_POSITIONS = {
+    "start": (START_FEN, (20, 400, 8902, 197281, 4865609, 119060324)),
+    "kiwipete": ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+                 (48, 2039, 97862, 4085603, 193690690)),
+    "position3": ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+                  (14, 191, 2812, 43238, 674624, 11030083)),
+    "position4": ("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+                  (6, 264, 9467, 422333, 15833292)),
+    "position4_mirrored": ("r2q1rk1/pP1p2pp/Q4n2/bbp1p3/Np6/1B3NBn/pPPP1PPP/R3K2R b KQ - 0 1",
+                           (6, 264, 9467, 422333, 15833292)),
+    "position5": ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+                  (44, 1486, 62379, 2103487, 89941194)),
+    "position6": ("r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+                  (46, 2079, 89890, 3894594, 164075551)),
+}
+
+# deepest depth of each position the suite runs by default (a few seconds each)
+SUITE_DEPTHS = {"start": 4, "kiwipete": 3, "position3": 4, "position4": 3, "position4_mirrored": 3,
+                "position5": 3, "position6": 3}
+
+
+def perft(gs, depth):
+    """
+    Counts the leaf nodes of the legal move tree depth plies deep.
+    The last ply is counted from the length of the move list instead of playing each move
+    """
+    moves = gs.get_valid_moves()
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+    nodes = 0
+    for move in moves:
+        gs.make_move(move)
+        nodes += perft(gs, depth - 1)
+        gs.undo_move()
+    return nodes
+
+
+def divide(gs, depth):
+    """
+    Perft split up by the first move, for tracking down which move a wrong count comes from
+    :return: dict of move notation -> node count
+    """
+    counts = {}
+    for move in gs.get_valid_moves():
+        gs.make_move(move)
+        counts[move.get_chess_notation()] = perft(gs, depth - 1)
+        gs.undo_move()
+    return counts
+
+
+def run(fen, depth, backend="list", split=False):
+    """
+    Times one perft run
+    :return: dict with the result, ready to be dumped as JSON
+    """
+    gs = ChessEngine.GameState.from_fen(fen, backend)
+    start = time.perf_counter()
+    if split:
+        counts = divide(gs, depth)
+        nodes = sum(counts.values())
+    else:
+        counts = None
+        nodes = perft(gs, depth)
+    seconds = time.perf_counter() - start
+    result = {"fen": fen, "depth": depth, "backend": backend, "nodes": nodes,
+              "seconds": round(seconds, 4), "nps": int(nodes / seconds) if seconds > 0 else 0}
+    if counts is not None:
+        result["divide"] = counts
+    return result
+
+
+def run_suite(backend="list", depths=None):
+    """
+    Runs every reference position up to its suite depth
+    :return: list of result dicts, each with "expected" and "passed" added
+    """
+    depths = depths or SUITE_DEPTHS
+    results = []
+    for name, (fen, counts) in REFERENCE_POSITIONS.items():
+        for depth in range(1, depths[name] + 1):
+            result = run(fen, depth, backend)
+            result["position"] = name
+            result["expected"] = counts[depth - 1]
+            result["passed"] = result["nodes"] == counts[depth - 1]
+            results.append(result)
+    return results
+
+
+def bench_moves(fen, backend="list", iterations=2000):
+    """
+    Time and memory of generating the valid moves of one position over and over
+    :return: dict with microseconds per call, bytes allocated per move kept and garbage collections run
+    """
+    gs = ChessEngine.GameState.from_fen(fen, backend)
+    moves = gs.get_valid_moves()
+    collections = sum(stats["collections"] for stats in gc.get_stats())
+    start = time.perf_counter()
+    for _ in range(iterations):
+        gs.get_valid_moves()
+    seconds = time.perf_counter() - start
+    collections = sum(stats["collections"] for stats in gc.get_stats()) - collections
+    tracemalloc.start()
+    kept = gs.get_valid_moves()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {"fen": fen, "backend": backend, "moves": len(moves), "iterations": iterations,
+            "us_per_call": round(seconds / iterations * 1000000, 1),
+            "bytes_per_move": size // len(kept) if kept else 0, "gc_collections": collections}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Perft for ChessEngine")
+    parser.add_argument("--fen", help="position to run (default: the reference suite)")
+    parser.add_argument("--position", choices=sorted(REFERENCE_POSITIONS), help="reference position to run")
+    parser.add_argument("--depth", type=int, help="depth for --fen/--position")
+    parser.add_argument("--divide", action="store_true", help="print the node count of every first move")
+    parser.add_argument("--backend", choices=ChessEngine.BACKENDS, default="list")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per result")
+    parser.add_argument("--bench", action="store_true", help="time and memory of move generation instead of perft")
+    args = parser.parse_args()
+
+    if args.bench:
+        positions = [(args.position or "fen", args.fen)] if args.fen else \
+            [(name, REFERENCE_POSITIONS[name][0]) for name in ([args.position] if args.position else REFERENCE_POSITIONS)]
+        for name, fen in positions:
+            result = bench_moves(fen, args.backend)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print("{}: {} moves, {}us per call, {} bytes per move, {} gc collections".format(
+                    name, result["moves"], result["us_per_call"], result["bytes_per_move"], result["gc_collections"]))
+        return 0
+
+    if args.fen or args.position or args.depth:
+        fen = args.fen or REFERENCE_POSITIONS[args.position or "start"][0]
+        results = [run(fen, args.depth or 3, args.backend, args.divide)]
+        if args.position and not args.fen:
+            results[0]["position"] = args.position
+        if args.position and not args.fen and results[0]["depth"] <= len(REFERENCE_POSITIONS[args.position][1]):
+            results[0]["expected"] = REFERENCE_POSITIONS[args.position][1][results[0]["depth"] - 1]
+            results[0]["passed"] = results[0]["nodes"] == results[0]["expected"]
+    else:
+        results = run_suite(args.backend)
+
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+            continue
+        for move, nodes in sorted(result.get("divide", {}).items()):
+            print(move + ": " + str(nodes))
+        line = "{} depth {}: {} nodes in {}s ({} nps)".format(result.get("position", result["fen"]), result["depth"],
+                                                             result["nodes"], result["seconds"], result["nps"])
+        if "expected" in result:
+            line += " ok" if result["passed"] else " FAILED, expected " + str(result["expected"])
+        print(line)
+    return 0 if all(result.get("passed", True) for result in results) else 1
+
+
+class PerftTest(unittest.TestCase):
+    """
+    Reference counts at shallow depths for both backends, quick enough to run on every change
+    """
+    depths = {"start": 3, "kiwipete": 2, "position3": 3, "position4": 2, "position4_mirrored": 2,
+              "position5": 2, "position6": 2}
+
+    def check_backend(self, backend):
+        for result in run_suite(backend, self.depths):
+            self.assertEqual(result["nodes"], result["expected"],
+                             result["position"] + " depth " + str(result["depth"]))
+
+    def test_list_backend(self):
+        self.check_backend("list")
+
+    def test_bitboard_backend(self):
+        self.check_backend("bitboard")
+
+    def test_undo_restores_position(self):
+        for fen, _ in REFERENCE_POSITIONS.values():
+            for backend in ChessEngine.BACKENDS:
+                gs = ChessEngine.GameState.from_fen(fen, backend)
+                board = [row[:] for row in gs.board]
+                key = gs.zobrist_key
+                for move in gs.get_valid_moves():
+                    gs.make_move(move)
+                    self.assertEqual(gs.zobrist_key, gs.compute_zobrist_key(), move.get_chess_notation())
+                    gs.undo_move()
+                self.assertEqual(gs.board, board)
+                self.assertEqual(gs.zobrist_key, key)
+
+
+def walk(gs, depth):
+    """
+    Generator over every position of the legal move tree of gs down to depth plies, gs itself first.
+    gs is the position each time (moves are made and undone around the yields)
+    """
+    yield gs
+    if depth == 0:
+        return
+    for move in gs.get_valid_moves():
+        gs.make_move(move)
+        yield from walk(gs, depth - 1)
+        gs.undo_move()
+
+
+class MoveGenerationTest(unittest.TestCase):
+    """
+    The lazy generators against get_valid_moves on every position a ply or two into the reference positions
+    """
+    depths = {"start": 2, "kiwipete": 1, "position3": 2, "position4": 1, "position4_mirrored": 1,
+              "position5": 1, "position6": 1}
+    extra_fens = ("rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/PPPPP2P/RNBQKBNR w KQkq - 1 3",  # checkmate
+                  "7k/5Q2/6K1/8/8/8/8/8 b - - 0 1",  # stalemate
+                  "4k3/8/8/2pP4/8/8/8/4K3 w - c6 0 2")  # en passant
+    seen = None
+
+    def check_position(self, gs):
+        valid = gs.get_valid_moves()
+        name = gs.to_fen()
+        self.assertEqual(gs.has_legal_move(), bool(valid), name)
+        staged = list(gs.staged_moves())
+        self.assertEqual(len(staged), len(valid), name)
+        self.assertEqual(set(staged), set(valid), name)
+        if valid:
+            hash_move = valid[-1]
+            staged = list(gs.staged_moves(hash_move.move_ID))
+            self.assertEqual(staged[0], hash_move, name)
+            self.assertEqual(len(staged), len(valid), name)
+        noisy = {move for move in valid if move.piece_captured != "--" or move.is_pawn_promotion}
+        self.assertEqual(set(gs.staged_moves(quiet_moves=False)), noisy, name)
+        captures = list(gs.captures_only())
+        self.assertEqual(len(captures), len(set(captures)), name)
+        self.assertEqual(set(captures), {move for move in valid if move.piece_captured != "--"}, name)
+        self.seen["check"] |= gs.in_check()
+        self.seen["enpassant"] |= any(move.is_enpassant_move for move in valid)
+        self.seen["promotion"] |= any(move.is_pawn_promotion for move in valid)
+        self.seen["no moves"] |= not valid
+
+    def check_backend(self, backend):
+        self.seen = dict.fromkeys(("check", "enpassant", "promotion", "no moves"), False)
+        positions = [(REFERENCE_POSITIONS[name][0], depth) for name, depth in self.depths.items()]
+        for fen, depth in positions + [(fen, 1) for fen in self.extra_fens]:
+            for gs in walk(ChessEngine.GameState.from_fen(fen, backend), depth):
+                self.check_position(gs)
+        self.assertTrue(all(self.seen.values()), self.seen)
+
+    def test_list_backend(self):
+        self.check_backend("list")
+
+    def test_bitboard_backend(self):
+        self.check_backend("bitboard")
+
+
+class NotationTest(unittest.TestCase):
+    """
+    SAN of single moves and whole games written as PGN, read back and replayed
+    """
+
+    def test_san_round_trip(self):
+        for fen, _ in REFERENCE_POSITIONS.values():
+            for gs in walk(ChessEngine.GameState.from_fen(fen), 1):
+                valid = gs.get_valid_moves()
+                for move in valid:
+                    san = ChessPGN.move_to_san(gs, move, valid)
+                    self.assertEqual(ChessPGN.san_to_move(gs, san, valid), move, san)
+
+    def test_check_and_mate_suffixes(self):
+        for fen, san in (("k7/4P3/1K6/8/8/8/8/8 w - - 0 1", "e8=Q#"),
+                         ("k7/4P3/1K6/8/8/8/8/8 w - - 0 1", "e8=N"),
+                         ("4k3/8/8/8/8/8/8/R3K3 w Q - 0 1", "O-O-O"),
+                         ("4k3/8/8/8/8/8/8/R3K3 w Q - 0 1", "Ra8+")):
+            gs = ChessEngine.GameState.from_fen(fen)
+            move = ChessPGN.san_to_move(gs, san)
+            self.assertEqual(ChessPGN.move_to_san(gs, move), san)
+
+    def test_mate_game_round_trip(self):
+        gs = ChessEngine.GameState()
+        for san in ("f3", "e5", "g4", "Qh4#"):
+            gs.make_move(ChessPGN.san_to_move(gs, san))
+        self.assertEqual(gs.get_valid_moves(), [])
+        text = ChessPGN.game_to_pgn(gs)
+        self.assertTrue(gs.checkmate)
+        self.assertIn("2. g4 Qh4# 0-1", text)
+        game = next(ChessPGN.read_games(text.splitlines()))
+        self.assertEqual(game.result, "0-1")
+        self.assertEqual(ChessPGN.game_result(ChessPGN.replay(game)), "0-1")
+
+    def test_game_round_trip(self):
+        rng = random.Random(0)
+        for fen, _ in REFERENCE_POSITIONS.values():
+            for backend in ChessEngine.BACKENDS:
+                gs = ChessEngine.GameState.from_fen(fen, backend)
+                for _ in range(60):
+                    moves = gs.get_valid_moves()
+                    if not moves or gs.is_draw():
+                        break
+                    gs.make_move(rng.choice(moves))
+                game = next(ChessPGN.read_games(ChessPGN.game_to_pgn(gs).splitlines()))
+                replayed = ChessPGN.replay(game, backend)
+                self.assertEqual(replayed.move_log, gs.move_log, fen)
+                self.assertEqual(replayed.to_fen(), gs.to_fen(), fen)
+                self.assertEqual(game.result, ChessPGN.game_result(gs), fen)
+
+
+class DrawCounterTest(unittest.TestCase):
+    """
+    Repetition counts and the fifty-move clock, move by move and back again with undo_move
+    """
+
+    def play(self, gs, sans):
+        """
+        Makes the moves, then undoes them, checking the counters come back the way they were at each ply
+        :return: (repetitions, draw by repetition, halfmove clock, draw by fifty moves) after each move
+        """
+        before = []
+        for san in sans:
+            before.append((gs.repetitions(), gs.draw_by_repetition, gs.halfmove_clock(), gs.draw_by_fifty_moves))
+            gs.make_move(ChessPGN.san_to_move(gs, san))
+        after = [(gs.repetitions(), gs.draw_by_repetition, gs.halfmove_clock(), gs.draw_by_fifty_moves)]
+        for counters in reversed(before):
+            gs.undo_move()
+            self.assertEqual((gs.repetitions(), gs.draw_by_repetition, gs.halfmove_clock(),
+                              gs.draw_by_fifty_moves), counters)
+        return before[1:] + after
+
+    def test_repetition(self):
+        shuffle = ["Nf3", "Nf6", "Ng1", "Ng8"]
+        for backend in ChessEngine.BACKENDS:
+            gs = ChessEngine.GameState(backend)
+            counters = self.play(gs, shuffle * 2 + ["e4"])
+            self.assertEqual([repetitions for repetitions, _, _, _ in counters], [1, 1, 1, 2, 2, 2, 2, 3, 1])
+            self.assertEqual([draw for _, draw, _, _ in counters], [False] * 7 + [True, False])
+            self.assertEqual([clock for _, _, clock, _ in counters], list(range(1, 9)) + [0])
+            self.assertFalse(gs.is_draw())
+
+    def test_fifty_moves(self):
+        for backend in ChessEngine.BACKENDS:
+            gs = ChessEngine.GameState.from_fen("8/8/8/4k3/8/8/P3K3/R7 w - - 97 80", backend)
+            counters = self.play(gs, ["Kd2", "Kd5", "Kc2", "Kc5", "a3"])
+            self.assertEqual([clock for _, _, clock, _ in counters], [98, 99, 100, 101, 0])
+            self.assertEqual([draw for _, _, _, draw in counters], [False, False, True, True, False])
+            self.assertEqual(gs.halfmove_clock(), 97)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
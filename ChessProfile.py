@@ -0,0 +1,223 @@
+"""
+Opt-in profiling of the engine: call counts and cumulative time of the hot functions, nodes per second
+of the search, cache hit rates and the render time of ChessMain's frames.
+Nothing is measured until enable(), which swaps timing wrappers in for the functions in PROFILED;
+disable() puts the originals back, so a profiler that is off costs nothing.
+
+    profiler = ChessProfile.Profiler()
+    profiler.enable()
+    ChessSearch.find_best_move(gs, 3)
+    profiler.disable()
+    profiler.export("profile.json")
+
+In ChessMain, P shows the numbers over the board and starts counting; P again hides them and writes profile.json.
+
+Command line (profiles a search of a position):
+    $ python ChessProfile.py --depth 3 -o profile.json
+"""
+
+import argparse
+import collections
+import functools
+import importlib
+import json
+import sys
+import threading
+import time
+
+import ChessEngine
+import ChessPGN
+
+# (module, class or None for module functions, function names)
+PROFILED = (
+    ("ChessEngine", "GameState", ("get_valid_moves", "generate_valid_moves", "get_all_possible_moves",
+                                  "legal_move_test", "has_legal_move", "check_for_pins_and_checks",
+                                  "square_under_attack", "find_attackers", "make_move", "undo_move")),
+    ("ChessEngine", "Move", ("__init__",)),
+    ("ChessBitboard", "BitboardGameState", ("generate_valid_moves", "square_under_attack", "find_attackers",
+                                            "make_move", "undo_move")),
+    ("ChessSearch", "Searcher", ("search", "negamax", "quiescence")),
+    ("ChessSearch", None, ("evaluate",)),
+)
+NODE_FUNCTIONS = ("Searcher.negamax", "Searcher.quiescence")  # a call of either is a node
+FRAME_HISTORY = 120  # frames the frame time statistics are taken over
+
+
+class Profiler:
+    """
+    Counts and times the PROFILED functions while enabled. Only one profiler can be enabled at a time
+    """
+    active = None  # the enabled Profiler
+
+    def __init__(self):
+        self.counters = {}  # name -> [calls, seconds]
+        self.originals = []  # (owner, attribute, original function) while enabled
+        self.caches = {}  # name -> object with hits and misses
+        self.frame_times = collections.deque(maxlen=FRAME_HISTORY)
+        self.frames = 0
+        self.enabled_seconds = 0.0
+        self.enabled_at = None
+        self.nesting = threading.local()  # name -> calls of it in progress on this thread
+
+    @property
+    def enabled(self):
+        return self.enabled_at is not None
+
+    def enable(self):
+        """
+        Wraps the PROFILED functions, counting carries on from where the last disable() left it
+        :raises RuntimeError: if another profiler is enabled
+        """
+        if self.enabled:
+            return
+        if Profiler.active is not None:
+            raise RuntimeError("Another profiler is enabled")
+        for module_name, class_name, function_names in PROFILED:
+            module = importlib.import_module(module_name)
+            owner = module if class_name is None else getattr(module, class_name)
+            for function_name in function_names:
+                if function_name not in vars(owner):
+                    continue  # inherited, the base class' wrapper counts it
+                name = function_name if class_name is None else class_name + "." + function_name
+                original = vars(owner)[function_name]
+                self.originals.append((owner, function_name, original))
+                setattr(owner, function_name, self.wrap(name, original))
+        Profiler.active = self
+        self.enabled_at = time.perf_counter()
+
+    def disable(self):
+        """
+        Puts the original functions back
+        """
+        if not self.enabled:
+            return
+        for owner, function_name, original in reversed(self.originals):
+            setattr(owner, function_name, original)
+        self.originals = []
+        Profiler.active = None
+        self.enabled_seconds += time.perf_counter() - self.enabled_at
+        self.enabled_at = None
+
+    def reset(self):
+        """
+        Zeroes every count (the watched caches keep their own)
+        """
+        for counter in self.counters.values():
+            counter[0] = 0
+            counter[1] = 0.0
+        self.frame_times.clear()
+        self.frames = 0
+        self.enabled_seconds = 0.0
+        if self.enabled:
+            self.enabled_at = time.perf_counter()
+
+    def wrap(self, name, function):
+        """
+        Timing wrapper of a function. A call made while the same function is already running on the
+        thread (recursion, a subclass calling its base) is counted but not timed again
+        """
+        counter = self.counters.setdefault(name, [0, 0.0])
+        nesting = self.nesting
+        perf_counter = time.perf_counter
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            counter[0] += 1
+            if getattr(nesting, name, False):
+                return function(*args, **kwargs)
+            setattr(nesting, name, True)
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                counter[1] += perf_counter() - start
+                setattr(nesting, name, False)
+        return wrapper
+
+    def watch(self, name, cache):
+        """
+        Reports the hit rate of a cache (anything with hits and misses, e.g. a MoveCache or TranspositionTable)
+        """
+        self.caches[name] = cache
+
+    def record_frame(self, seconds):
+        self.frames += 1
+        self.frame_times.append(seconds)
+
+    def stats(self):
+        """
+        Everything measured so far
+        :return: dict, as written by export()
+        """
+        seconds = self.enabled_seconds
+        if self.enabled:
+            seconds += time.perf_counter() - self.enabled_at
+        generations = self.counters.get("GameState.get_valid_moves", [0])[0]
+        functions = {}
+        for name, (calls, total) in sorted(self.counters.items(), key=lambda item: -item[1][1]):
+            if calls:
+                functions[name] = {"calls": calls, "seconds": round(total, 6),
+                                   "microseconds_per_call": round(total / calls * 1e6, 3),
+                                   "calls_per_get_valid_moves": round(calls / generations, 3) if generations else None}
+        nodes = sum(self.counters.get(name, [0])[0] for name in NODE_FUNCTIONS)
+        search_seconds = self.counters.get("Searcher.search", [0, 0.0])[1]
+        caches = {}
+        for name, cache in self.caches.items():
+            lookups = cache.hits + cache.misses
+            caches[name] = {"hits": cache.hits, "misses": cache.misses,
+                            "hit_rate": round(cache.hits / lookups, 4) if lookups else 0.0}
+        frame_times = list(self.frame_times)
+        frames = {"count": self.frames,
+                  "average_ms": round(sum(frame_times) / len(frame_times) * 1000, 3) if frame_times else 0.0,
+                  "max_ms": round(max(frame_times) * 1000, 3) if frame_times else 0.0}
+        return {"seconds": round(seconds, 3), "functions": functions, "nodes": nodes,
+                "nodes_per_second": round(nodes / search_seconds, 1) if search_seconds else 0.0,
+                "caches": caches, "frames": frames}
+
+    def export(self, path):
+        """
+        Writes stats() to a JSON file
+        """
+        with open(path, "w") as profile_file:
+            json.dump(self.stats(), profile_file, indent=2)
+
+    def summary_lines(self, functions=8):
+        """
+        Short text of the stats, for the overlay in ChessMain: the totals, then the functions that took longest
+        """
+        stats = self.stats()
+        lines = ["nodes/s {:.0f}".format(stats["nodes_per_second"]),
+                 "frame {:.2f} ms (max {:.2f})".format(stats["frames"]["average_ms"], stats["frames"]["max_ms"])]
+        for name, cache in stats["caches"].items():
+            lines.append("{} {:.0%} hits".format(name, cache["hit_rate"]))
+        for name, function in list(stats["functions"].items())[:functions]:
+            lines.append("{} {}x {:.1f} ms".format(name.split(".")[-1], function["calls"], function["seconds"] * 1000))
+        return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile a search of a position")
+    parser.add_argument("--fen", default=ChessPGN.START_FEN)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--backend", choices=ChessEngine.BACKENDS, default="list")
+    parser.add_argument("-o", "--output", help="write the numbers to this JSON file")
+    args = parser.parse_args()
+
+    import ChessSearch
+    gs = ChessEngine.GameState.from_fen(args.fen, args.backend)
+    searcher = ChessSearch.Searcher()
+    profiler = Profiler()
+    profiler.watch("transposition table", searcher.tt)
+    profiler.enable()
+    try:
+        searcher.search(gs, args.depth)
+    finally:
+        profiler.disable()
+    if args.output:
+        profiler.export(args.output)
+    print(json.dumps(profiler.stats(), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,324 @@
+"""
+Computer player.
+Negamax alpha-beta search on a GameState with iterative deepening, a quiescence search over captures,
+a transposition table and move ordering (hash move, MVV-LVA captures, killer moves, history heuristic).
+Stops on a time or node limit and returns the best move with its principal variation.
+"""
+
+import threading
+import time
+
+import ChessHash
+
+PIECE_VALUES = {"P": 100, "N": 320, "B": 330, "R": 500, "Q": 900, "K": 0}
+MATE_SCORE = 100000
+MAX_PLY = 128
+CHECK_EVERY = 256  # nodes between looking at the clock (a few milliseconds)
+
+# piece-square tables from white's side (row 0 is the 8th rank), black uses them mirrored
+PIECE_SQUARE_TABLES = {
+    "P": [[0, 0, 0, 0, 0, 0, 0, 0],
+          [50, 50, 50, 50, 50, 50, 50, 50],
+          [10, 10, 20, 30, 30, 20, 10, 10],
+          [5, 5, 10, 25, 25, 10, 5, 5],
+          [0, 0, 0, 20, 20, 0, 0, 0],
+          [5, -5, -10, 0, 0, -10, -5, 5],
+          [5, 10, 10, -20, -20, 10, 10, 5],
+          [0, 0, 0, 0, 0, 0, 0, 0]],
+    "N": [[-50, -40, -30, -30, -30, -30, -40, -50],
+          [-40, -20, 0, 0, 0, 0, -20, -40],
+          [-30, 0, 10, 15, 15, 10, 0, -30],
+          [-30, 5, 15, 20, 20, 15, 5, -30],
+          [-30, 0, 15, 20, 20, 15, 0, -30],
+          [-30, 5, 10, 15, 15, 10, 5, -30],
+          [-40, -20, 0, 5, 5, 0, -20, -40],
+          [-50, -40, -30, -30, -30, -30, -40, -50]],
+    "B": [[-20, -10, -10, -10, -10, -10, -10, -20],
+          [-10, 0, 0, 0, 0, 0, 0, -10],
+          [-10, 0, 5, 10, 10, 5, 0, -10],
+          [-10, 5, 5, 10, 10, 5, 5, -10],
+          [-10, 0, 10, 10, 10, 10, 0, -10],
+          [-10, 10, 10, 10, 10, 10, 10, -10],
+          [-10, 5, 0, 0, 0, 0, 5, -10],
+          [-20, -10, -10, -10, -10, -10, -10, -20]],
+    "R": [[0, 0, 0, 0, 0, 0, 0, 0],
+          [5, 10, 10, 10, 10, 10, 10, 5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [0, 0, 0, 5, 5, 0, 0, 0]],
+    "Q": [[-20, -10, -10, -5, -5, -10, -10, -20],
+          [-10, 0, 0, 0, 0, 0, 0, -10],
+          [-10, 0, 5, 5, 5, 5, 0, -10],
+          [-5, 0, 5, 5, 5, 5, 0, -5],
+          [0, 0, 5, 5, 5, 5, 0, -5],
+          [-10, 5, 5, 5, 5, 5, 0, -10],
+          [-10, 0, 5, 0, 0, 0, 0, -10],
+          [-20, -10, -10, -5, -5, -10, -10, -20]],
+    "K": [[-30, -40, -40, -50, -50, -40, -40, -30],
+          [-30, -40, -40, -50, -50, -40, -40, -30],
+          [-30, -40, -40, -50, -50, -40, -40, -30],
+          [-30, -40, -40, -50, -50, -40, -40, -30],
+          [-20, -30, -30, -40, -40, -30, -30, -20],
+          [-10, -20, -20, -20, -20, -20, -20, -10],
+          [20, 20, 0, 0, 0, 0, 20, 20],
+          [20, 30, 10, 0, 0, 10, 30, 20]],
+}
+
+# piece -> [row][column] -> material plus position score, positive for white
+PIECE_SCORES = {}
+for _piece_type, _table in PIECE_SQUARE_TABLES.items():
+    PIECE_SCORES["w" + _piece_type] = [[PIECE_VALUES[_piece_type] + _table[row][column] for column in range(8)]
+                                       for row in range(8)]
+    PIECE_SCORES["b" + _piece_type] = [[-PIECE_VALUES[_piece_type] - _table[7 - row][column] for column in range(8)]
+                                       for row in range(8)]
+# piece -> square (row * 8 + column) -> the same scores
+SQUARE_SCORES = {piece: [score for row in scores for score in row] for piece, scores in PIECE_SCORES.items()}
+
+
+def evaluate(gs):
+    """
+    Material and piece-square score of the position
+    :return: score in centipawns from the side to move's point of view
+    """
+    score = 0
+    for piece, squares in gs.piece_squares.items():
+        scores = SQUARE_SCORES[piece]
+        for square in squares:
+            score += scores[square]
+    return score if gs.white_to_move else -score
+
+
+class SearchTimeout(Exception):
+    """
+    Raised inside the search when a limit is hit, to unwind back to the root
+    """
+
+
+class SearchResult:
+    """
+    Outcome of a search: best move, its score (centipawns for the side to move), the principal variation,
+    the deepest iteration that finished, and how much work it took
+    """
+    def __init__(self, best_move, score, pv, depth, nodes, seconds):
+        self.best_move = best_move
+        self.score = score
+        self.pv = pv
+        self.depth = depth
+        self.nodes = nodes
+        self.seconds = seconds
+
+    def is_mate_score(self):
+        return abs(self.score) >= MATE_SCORE - MAX_PLY
+
+
+class Searcher:
+    """
+    Alpha-beta searcher. Keeps its transposition table between searches;
+    killer moves and the history table are reset for every search
+    """
+    def __init__(self, tt_size_mb=16):
+        self.tt = ChessHash.TranspositionTable(tt_size_mb)
+        self.stop_event = threading.Event()  # set from another thread to stop the search
+        self.nodes = 0
+        self.killers = []
+        self.history = {}
+        self.deadline = None
+        self.node_limit = None
+        self.next_check = 0  # node count at which the limits are checked next
+        self.on_iteration = None
+
+    def stop(self):
+        self.stop_event.set()
+        self.next_check = 0  # look at it on the next node rather than up to CHECK_EVERY nodes later
+
+    def search(self, gs, max_depth=64, time_limit=None, node_limit=None, on_iteration=None):
+        """
+        Searches gs with iterative deepening until max_depth, time_limit (seconds) or node_limit is reached,
+        or stop() is called. gs is searched in place and left as it was
+
+        :param on_iteration: called with a SearchResult after every finished depth
+        :return: SearchResult of the deepest finished iteration
+        """
+        start = time.perf_counter()
+        self.stop_event.clear()
+        self.deadline = start + time_limit if time_limit is not None else None
+        self.node_limit = node_limit
+        self.on_iteration = on_iteration
+        self.nodes = 0
+        self.next_check = 0
+        self.killers = [[None, None] for _ in range(MAX_PLY)]
+        self.history = {}
+        self.tt.new_search()
+        checkmate, stalemate = gs.checkmate, gs.stalemate
+
+        moves = gs.get_valid_moves()
+        result = SearchResult(moves[0] if moves else None, 0, moves[:1], 0, 0, 0.0)
+        if len(moves) > 1:
+            log_length = len(gs.move_log)
+            for depth in range(1, max_depth + 1):
+                pv = []
+                try:
+                    score = self.negamax(gs, depth, -MATE_SCORE - 1, MATE_SCORE + 1, 0, pv)
+                except SearchTimeout:
+                    while len(gs.move_log) > log_length:  # unwind the moves made when the search stopped
+                        gs.undo_move()
+                    break
+                result = SearchResult(pv[0], score, pv, depth, self.nodes, time.perf_counter() - start)
+                if self.on_iteration is not None:
+                    self.on_iteration(result)
+                if result.is_mate_score():
+                    break  # a shorter mate won't be found by searching deeper
+        result.nodes = self.nodes
+        result.seconds = time.perf_counter() - start
+        gs.checkmate, gs.stalemate = checkmate, stalemate
+        return result
+
+    def check_limits(self):
+        """
+        Raises SearchTimeout when a limit is hit, otherwise decides when to look again
+        """
+        self.next_check = self.nodes + CHECK_EVERY
+        if self.node_limit is not None:
+            self.next_check = min(self.next_check, self.node_limit)
+        if self.stop_event.is_set():
+            raise SearchTimeout()
+        if self.node_limit is not None and self.nodes >= self.node_limit:
+            raise SearchTimeout()
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            raise SearchTimeout()
+
+    def negamax(self, gs, depth, alpha, beta, ply, pv):
+        """
+        Alpha-beta search of depth plies, fills pv with the best line found
+        :return: score from the side to move's point of view
+        """
+        self.nodes += 1
+        if self.nodes >= self.next_check:
+            self.check_limits()
+        key = gs.zobrist_key
+        # a repetition inside the search is scored as the draw it can be forced into
+        if ply > 0 and (gs.draw_by_fifty_moves or gs.draw_by_insufficient_material or gs.repetitions() >= 2):
+            return 0
+        hash_move_id = 0
+        entry = self.tt.probe(key)
+        if entry is not None:
+            entry_depth, bound, score, hash_move_id = entry
+            if ply > 0 and entry_depth >= depth:
+                score = score_from_tt(score, ply)
+                if bound == ChessHash.EXACT or (bound == ChessHash.LOWER_BOUND and score >= beta) or \
+                        (bound == ChessHash.UPPER_BOUND and score <= alpha):
+                    return score
+
+        if depth <= 0 or ply >= MAX_PLY - 1:
+            return self.quiescence(gs, alpha, beta, ply)
+        original_alpha = alpha
+        best_score = -MATE_SCORE - 1
+        best_move = None
+        # moves are generated stage by stage, a cutoff on the hash move or a capture skips generating the rest
+        for move in gs.staged_moves(hash_move_id, quiet_key=self.quiet_order(ply)):
+            child_pv = []
+            gs.make_move(move)
+            score = -self.negamax(gs, depth - 1, -beta, -alpha, ply + 1, child_pv)
+            gs.undo_move()
+            if score > best_score:
+                best_score = score
+                best_move = move
+                if score > alpha:
+                    alpha = score
+                    pv[:] = [move] + child_pv
+                    if alpha >= beta:
+                        if move.piece_captured == "--":
+                            self.remember_quiet_cutoff(move, depth, ply)
+                        break
+        if best_move is None:  # no valid moves
+            return -MATE_SCORE + ply if gs.in_check() else 0
+        if best_score <= original_alpha:
+            bound = ChessHash.UPPER_BOUND
+        elif best_score >= beta:
+            bound = ChessHash.LOWER_BOUND
+        else:
+            bound = ChessHash.EXACT
+        self.tt.store(key, depth, bound, score_to_tt(best_score, ply), best_move.move_ID)
+        return best_score
+
+    def quiescence(self, gs, alpha, beta, ply):
+        """
+        Searches captures (and promotions) only, until the position is quiet,
+        so the static evaluation is never taken in the middle of an exchange
+        """
+        self.nodes += 1
+        if self.nodes >= self.next_check:
+            self.check_limits()
+        stand_pat = evaluate(gs)
+        if stand_pat >= beta:
+            return stand_pat
+        if stand_pat > alpha:
+            alpha = stand_pat
+        if ply >= MAX_PLY - 1:
+            return stand_pat
+        for move in gs.staged_moves(quiet_moves=False):  # captures by MVV-LVA, then promotions
+            gs.make_move(move)
+            score = -self.quiescence(gs, -beta, -alpha, ply + 1)
+            gs.undo_move()
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        return alpha
+
+    def quiet_order(self, ply):
+        """
+        Sort key of the quiet moves at ply: killer moves first, then by history score
+        (the hash move and captures come before them from GameState.staged_moves)
+        """
+        killers = self.killers[ply]
+        history = self.history
+
+        def order(move):
+            if move == killers[0]:
+                return 900000
+            if move == killers[1]:
+                return 800000
+            return history.get((move.piece_moved, move.end_square), 0)
+        return order
+
+    def remember_quiet_cutoff(self, move, depth, ply):
+        """
+        A quiet move that caused a beta cutoff becomes a killer for this ply and gains history
+        """
+        killers = self.killers[ply]
+        if move != killers[0]:
+            killers[1] = killers[0]
+            killers[0] = move
+        key = (move.piece_moved, move.end_square)
+        self.history[key] = min(self.history.get(key, 0) + depth * depth, 700000)
+
+
+def score_to_tt(score, ply):
+    """
+    Mate scores are stored relative to the stored position instead of the root
+    """
+    if score >= MATE_SCORE - MAX_PLY:
+        return score + ply
+    if score <= -MATE_SCORE + MAX_PLY:
+        return score - ply
+    return score
+
+
+def score_from_tt(score, ply):
+    if score >= MATE_SCORE - MAX_PLY:
+        return score - ply
+    if score <= -MATE_SCORE + MAX_PLY:
+        return score + ply
+    return score
+
+
+def find_best_move(gs, max_depth=64, time_limit=None, node_limit=None):
+    """
+    One-off search with a fresh searcher
+    :return: SearchResult
+    """
+    return Searcher().search(gs, max_depth, time_limit, node_limit)
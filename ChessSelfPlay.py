@@ -0,0 +1,252 @@
+"""
+Headless self-play: games between move policies on ChessEngine.GameState, with no window (nothing from pygame).
+For regression runs (same seeds, same games) and load tests (thousands of games on a process pool).
+
+Policies are given as text:
+    random                 a random valid move
+    search:<depth>         ChessSearch to a fixed depth (search:<depth>:<seconds> adds a time limit)
+    script:e4,e5,Nf3       these moves (SAN or e2e4 style) while they last, then random moves
+
+Command line:
+    $ python ChessSelfPlay.py --games 1000 --processes 4
+    $ python ChessSelfPlay.py --games 20 --white search:2 --black random --seed 7 --pgn games.pgn
+"""
+
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import time
+
+import ChessEngine
+import ChessPGN
+import ChessSearch
+
+
+class RandomPolicy:
+    """
+    Plays a random valid move
+    """
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+
+    def choose_move(self, gs, valid_moves):
+        return valid_moves[self.rng.randrange(len(valid_moves))]
+
+
+class ScriptedPolicy:
+    """
+    Plays the given moves in order (one per turn of this side), then hands over to another policy
+    """
+    def __init__(self, moves, fallback=None):
+        self.moves = list(moves)
+        self.fallback = fallback if fallback is not None else RandomPolicy()
+
+    def choose_move(self, gs, valid_moves):
+        while self.moves:
+            text = self.moves.pop(0)
+            for move in valid_moves:
+                if move.get_chess_notation() == text:
+                    return move
+            try:
+                return ChessPGN.san_to_move(gs, text, valid_moves)
+            except ValueError:
+                break  # off script, the game went somewhere else
+        self.moves = []
+        return self.fallback.choose_move(gs, valid_moves)
+
+
+class SearchPolicy:
+    """
+    Plays the best move of a ChessSearch search to a fixed depth (and/or time limit)
+    """
+    def __init__(self, depth=2, time_limit=None, tt_size_mb=4):
+        self.depth = depth
+        self.time_limit = time_limit
+        self.searcher = ChessSearch.Searcher(tt_size_mb)
+
+    def choose_move(self, gs, valid_moves):
+        result = self.searcher.search(gs, self.depth, self.time_limit)
+        for move in valid_moves:
+            if move == result.best_move:
+                return move
+        return valid_moves[0]
+
+
+def make_policy(spec, seed=None):
+    """
+    Policy from its text form, see the module docstring
+    :raises ValueError: for an unknown policy
+    """
+    name, _, arguments = spec.partition(":")
+    if name == "random":
+        return RandomPolicy(seed)
+    if name == "search":
+        parts = arguments.split(":") if arguments else []
+        depth = int(parts[0]) if parts else 2
+        time_limit = float(parts[1]) if len(parts) > 1 else None
+        return SearchPolicy(depth, time_limit)
+    if name == "script":
+        return ScriptedPolicy([move for move in arguments.split(",") if move], RandomPolicy(seed))
+    raise ValueError("Unknown policy: " + spec)
+
+
+def play_game(white, black, max_plies=300, start_fen=None, backend="list", opening_plies=0, seed=None,
+              pgn_headers=None):
+    """
+    Plays one game between two policies (objects with choose_move(gs, valid_moves))
+    :param opening_plies: random moves played first (from seed), so games between fixed policies differ
+    :param pgn_headers: if given, the game is kept as PGN text with these tags under "pgn"
+    :return: dict with result ("*" for a game stopped at max_plies), termination ("checkmate", "stalemate",
+             "repetition", "fifty_moves", "insufficient_material" or "max_plies"), plies and seconds
+    """
+    start = time.perf_counter()
+    if start_fen is None:
+        gs = ChessEngine.GameState(backend)
+    else:
+        gs = ChessEngine.GameState.from_fen(start_fen, backend)
+    opening = RandomPolicy(seed)
+    valid_moves = gs.get_valid_moves()
+    while valid_moves and not gs.is_draw() and len(gs.move_log) < max_plies:
+        if len(gs.move_log) < opening_plies:
+            move = opening.choose_move(gs, valid_moves)
+        elif gs.white_to_move:
+            move = white.choose_move(gs, valid_moves)
+        else:
+            move = black.choose_move(gs, valid_moves)
+        gs.make_move(move)
+        valid_moves = gs.get_valid_moves()
+
+    if gs.checkmate:
+        termination = "checkmate"
+        result = "0-1" if gs.white_to_move else "1-0"
+    elif gs.stalemate:
+        termination = "stalemate"
+        result = "1/2-1/2"
+    elif gs.draw_by_repetition:
+        termination = "repetition"
+        result = "1/2-1/2"
+    elif gs.draw_by_fifty_moves:
+        termination = "fifty_moves"
+        result = "1/2-1/2"
+    elif gs.draw_by_insufficient_material:
+        termination = "insufficient_material"
+        result = "1/2-1/2"
+    else:
+        termination = "max_plies"
+        result = "*"  # cut off, not a draw
+    game = {"result": result, "termination": termination, "plies": len(gs.move_log),
+            "seconds": time.perf_counter() - start}
+    if pgn_headers is not None:
+        game["pgn"] = ChessPGN.game_to_pgn(gs, pgn_headers, result)
+    return game
+
+
+def play_task(task):
+    """
+    Runs in a worker: one game from its settings
+    :param task: (index, settings dict)
+    """
+    index, settings = task
+    seed = settings["seed"] + index
+    pgn_headers = None
+    if settings["keep_pgn"]:
+        pgn_headers = {"Event": "Self-play", "Round": str(index + 1), "White": settings["white"],
+                       "Black": settings["black"]}
+    game = play_game(make_policy(settings["white"], seed), make_policy(settings["black"], seed + 1000003),
+                     settings["max_plies"], settings["start_fen"], settings["backend"], settings["opening_plies"],
+                     seed, pgn_headers)
+    game["index"] = index
+    return game
+
+
+def play_games(games, white="random", black="random", seed=0, max_plies=300, start_fen=None, backend="list",
+               opening_plies=0, processes=1, chunksize=8, keep_pgn=False):
+    """
+    Plays a batch of games, game i with seed + i. Runs in this process for processes=1, else on a process pool
+    (results then come in the order they finish, each has an "index")
+    :return: generator of game dicts (see play_game)
+    """
+    settings = {"white": white, "black": black, "seed": seed, "max_plies": max_plies, "start_fen": start_fen,
+                "backend": backend, "opening_plies": opening_plies, "keep_pgn": keep_pgn}
+    make_policy(white)  # fail here on a bad policy instead of in every worker
+    make_policy(black)
+    tasks = ((index, settings) for index in range(games))
+    if processes == 1:
+        for task in tasks:
+            yield play_task(task)
+        return
+    with multiprocessing.Pool(processes) as pool:
+        for game in pool.imap_unordered(play_task, tasks, chunksize):
+            yield game
+
+
+def summarize(games, seconds):
+    """
+    Outcome statistics and speed of a batch of games
+    """
+    count = len(games)
+    plies = sum(game["plies"] for game in games)
+    summary = {"games": count, "seconds": round(seconds, 3),
+               "games_per_second": round(count / seconds, 2) if seconds > 0 else 0,
+               "moves_per_second": round(plies / seconds, 1) if seconds > 0 else 0,
+               "average_plies": round(plies / count, 1) if count else 0,
+               "results": {}, "terminations": {}}
+    for game in games:
+        summary["results"][game["result"]] = summary["results"].get(game["result"], 0) + 1
+        summary["terminations"][game["termination"]] = summary["terminations"].get(game["termination"], 0) + 1
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play games between move policies without a window")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--white", default="random", help="policy for white (random, search:<depth>, script:...)")
+    parser.add_argument("--black", default="random", help="policy for black")
+    parser.add_argument("--seed", type=int, default=0, help="game i is played with seed + i")
+    parser.add_argument("--max-plies", type=int, default=300, help="games this long are stopped unfinished (\"*\")")
+    parser.add_argument("--opening-plies", type=int, default=0, help="random plies to start every game with")
+    parser.add_argument("--fen", help="starting position (default: the normal start)")
+    parser.add_argument("--backend", choices=ChessEngine.BACKENDS, default="list")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes (0 for all cores)")
+    parser.add_argument("--chunksize", type=int, default=8, help="games sent to a worker at a time")
+    parser.add_argument("--pgn", help="also write the games to this PGN file")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per game and the summary")
+    args = parser.parse_args()
+
+    try:
+        make_policy(args.white)
+        make_policy(args.black)
+    except ValueError as error:
+        parser.error(str(error))
+    processes = args.processes or multiprocessing.cpu_count()
+    pgn_file = open(args.pgn, "w") if args.pgn else None
+    games = []
+    start = time.perf_counter()
+    try:
+        for game in play_games(args.games, args.white, args.black, args.seed, args.max_plies, args.fen, args.backend,
+                               args.opening_plies, processes, args.chunksize, pgn_file is not None):
+            if pgn_file is not None:
+                pgn_file.write(game.pop("pgn") + "\n")
+            if args.json:
+                print(json.dumps(game))
+            games.append(game)
+    finally:
+        if pgn_file is not None:
+            pgn_file.close()
+    summary = summarize(games, time.perf_counter() - start)
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        print("{} games in {}s ({} games/s, {} moves/s, {} plies on average)".format(
+            summary["games"], summary["seconds"], summary["games_per_second"], summary["moves_per_second"],
+            summary["average_plies"]))
+        print("results: " + ", ".join(result + " " + str(count) for result, count in sorted(summary["results"].items())))
+        print("terminations: " + ", ".join(name + " " + str(count)
+                                           for name, count in sorted(summary["terminations"].items())))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
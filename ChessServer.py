@@ -0,0 +1,543 @@
+"""
+Game server: many games at once over a local TCP socket, driven by a JSON object per line each way.
+Every connection can open any number of games (sessions); they are closed with it.
+The event loop only does the quick work (parsing, moves, a game's valid moves, which all the sessions
+look up in one shared MoveCache); the computer's searches run on a pool of worker processes with
+a cap on how many are queued, so a busy engine never holds up the other games.
+
+Requests (id is optional and sent back with the response):
+    {"id": 1, "cmd": "new", "fen": "...", "computer": "b", "depth": 2}  -> {"id": 1, "ok": true, "game": 7, ...}
+    {"id": 2, "cmd": "move", "game": 7, "move": "e2e4"}
+    {"id": 3, "cmd": "undo", "game": 7, "plies": 2}
+    {"id": 4, "cmd": "moves", "game": 7}  -> {"id": 4, "ok": true, "moves": ["a7a6", ...]}
+    {"id": 5, "cmd": "status", "game": 7}
+    {"id": 6, "cmd": "close", "game": 7}
+    {"id": 7, "cmd": "stats"}  -> sessions, latency percentiles per command, event loop lag, ...
+Responses to game commands carry the game's status (fen, turn, result, check, plies, last move);
+errors come back as {"ok": false, "error": "..."}. When a game has a computer side
+("computer": "w" or "b"), its moves are pushed once found: {"event": "computer_move", "game": 7, "move": ...},
+or {"event": "error", "game": 7, "error": "..."} if the search failed (the game waits for the client again)
+
+Command line:
+    $ python ChessServer.py serve --port 8765 --workers 4
+    $ python ChessServer.py load --port 8765 --clients 200 --games 5 --computer
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import time
+
+import ChessEngine
+import ChessPGN
+import ChessSearch
+import ChessUCI
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+MAX_SESSIONS = 100000
+MAX_LINE = 64 * 1024  # longest request line in bytes
+MOVE_CACHE_SIZE = 65536  # positions in the valid move cache shared by all the sessions
+LATENCY_HISTORY = 10000  # latest requests of a command its percentiles are taken over
+PERCENTILES = (50, 90, 99)
+LAG_INTERVAL = 0.01  # seconds between the event loop lag probes
+MAX_DEPTH = 6  # deepest search a game may ask its computer for
+
+# per process state of a search worker, set up once by init_worker
+worker_searcher = None
+
+
+def init_worker(tt_size_mb):
+    global worker_searcher
+    worker_searcher = ChessSearch.Searcher(tt_size_mb)
+
+
+def search_move(snapshot, backend, depth, time_limit):
+    """
+    Runs in a worker: the computer's move in the game of a GameState.snapshot(with_history=True)
+    :return: the move in long algebraic notation, None if there is no move
+    """
+    gs = ChessEngine.GameState.from_snapshot(snapshot, backend)
+    result = worker_searcher.search(gs, depth, time_limit)
+    return None if result.best_move is None else result.best_move.get_chess_notation()
+
+
+def percentiles(samples):
+    """
+    :param samples: durations in seconds
+    :return: dict of count, p50/p90/p99 and max in milliseconds (nearest rank)
+    """
+    ordered = sorted(samples)
+    report = {"count": len(ordered)}
+    for percentile in PERCENTILES:
+        if ordered:
+            rank = max((len(ordered) * percentile + 99) // 100 - 1, 0)
+            report["p" + str(percentile) + "_ms"] = round(ordered[rank] * 1000, 3)
+        else:
+            report["p" + str(percentile) + "_ms"] = 0.0
+    report["max_ms"] = round(ordered[-1] * 1000, 3) if ordered else 0.0
+    return report
+
+
+class LatencyStats:
+    """
+    Durations of the latest LATENCY_HISTORY requests of every command, and how many there were in all
+    """
+    def __init__(self):
+        self.samples = {}
+        self.counts = collections.Counter()
+
+    def record(self, command, seconds):
+        samples = self.samples.get(command)
+        if samples is None:
+            samples = self.samples[command] = collections.deque(maxlen=LATENCY_HISTORY)
+        samples.append(seconds)
+        self.counts[command] += 1
+
+    def report(self):
+        """
+        :return: dict of command -> percentiles() of its latest requests, with count the total
+        """
+        report = {}
+        for command, samples in sorted(self.samples.items()):
+            report[command] = percentiles(samples)
+            report[command]["count"] = self.counts[command]
+        return report
+
+
+def game_status(gs):
+    """
+    Status of a game as sent to the clients
+    """
+    return {"fen": gs.to_fen(), "turn": "w" if gs.white_to_move else "b", "result": ChessPGN.game_result(gs),
+            "check": gs.in_check(), "plies": len(gs.move_log),
+            "last_move": gs.move_log[-1].get_chess_notation() if gs.move_log else None}
+
+
+class Session:
+    """
+    One game on the server, with the side the computer plays (None if it doesn't)
+    """
+    def __init__(self, game_id, gs, computer, depth, time_limit):
+        self.game_id = game_id
+        self.gs = gs
+        self.computer = computer
+        self.depth = depth
+        self.time_limit = time_limit
+        self.thinking = None  # asyncio task looking for the computer's move
+
+
+class Connection:
+    """
+    A client connection and the sessions it opened
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.sessions = {}
+        self.closed = False
+
+    def send(self, message):
+        if not self.closed:
+            self.writer.write((json.dumps(message) + "\n").encode())
+
+
+class GameServer:
+    """
+    Sessions, search workers and statistics of a running server
+    :param workers: search processes (default: all cores)
+    :param max_pending: most searches submitted to the workers at once, the rest wait (default: 4 per worker)
+    """
+    def __init__(self, workers=None, max_pending=None, depth=2, time_limit=None, max_sessions=MAX_SESSIONS,
+                 tt_size_mb=16, backend="list"):
+        workers = workers or os.cpu_count() or 1
+        self.workers = workers
+        self.tt_size_mb = tt_size_mb
+        self.executor = self.start_workers()
+        self.search_slots = asyncio.Semaphore(max_pending or workers * 4)
+        self.depth = depth
+        self.time_limit = time_limit
+        self.max_sessions = max_sessions
+        self.backend = backend
+        self.sessions = 0
+        self.connections = 0
+        self.searches_waiting = 0
+        self.game_ids = itertools.count(1)
+        self.move_cache = ChessEngine.MoveCache(MOVE_CACHE_SIZE)
+        self.latency = LatencyStats()
+        self.loop_lag = collections.deque(maxlen=LATENCY_HISTORY)
+        self.commands = {"new": self.new_game, "move": self.move, "undo": self.undo, "moves": self.valid_moves,
+                         "status": self.status, "close": self.close_game, "stats": self.stats}
+
+    def start_workers(self):
+        """
+        :return: a new pool of search processes
+        """
+        # spawned rather than forked, so the workers don't inherit the listening socket (or the event loop)
+        return concurrent.futures.ProcessPoolExecutor(self.workers, multiprocessing.get_context("spawn"),
+                                                      init_worker, (self.tt_size_mb,))
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT, report_every=None):
+        """
+        Accepts connections until cancelled or sent SIGTERM, then stops the search workers
+        :param report_every: print stats() to stderr every so many seconds
+        """
+        stopping = asyncio.Event()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+        except (NotImplementedError, AttributeError):  # no signal handlers on Windows
+            pass
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_LINE, backlog=4096)
+        lag_probe = asyncio.ensure_future(self.watch_loop_lag())
+        print("serving on {}:{}".format(host, port), file=sys.stderr, flush=True)
+        try:
+            async with server:
+                while not stopping.is_set():
+                    try:
+                        await asyncio.wait_for(stopping.wait(), report_every)
+                    except asyncio.TimeoutError:
+                        print(json.dumps(self.stats(None, {})), file=sys.stderr, flush=True)
+        finally:
+            lag_probe.cancel()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def watch_loop_lag(self):
+        """
+        Measures how late the event loop wakes up from a short sleep, which is how long a request can be held up
+        """
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.loop_lag.append(max(time.perf_counter() - start - LAG_INTERVAL, 0.0))
+
+    async def handle_connection(self, reader, writer):
+        connection = Connection(writer)
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:  # longer than MAX_LINE
+                    connection.send({"ok": False, "error": "Request line too long"})
+                    break
+                if not line:
+                    break
+                start = time.perf_counter()
+                command, response = self.handle_line(connection, line)
+                connection.send(response)
+                self.latency.record(command, time.perf_counter() - start)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            connection.closed = True
+            for session in connection.sessions.values():
+                if session.thinking is not None:
+                    session.thinking.cancel()
+            self.sessions -= len(connection.sessions)
+            self.connections -= 1
+            writer.close()
+
+    def handle_line(self, connection, line):
+        """
+        Runs one request
+        :return: (command name for the statistics, response dict)
+        """
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return "invalid", {"ok": False, "error": "Invalid JSON"}
+        if not isinstance(request, dict):
+            return "invalid", {"ok": False, "error": "Request must be an object"}
+        command = request.get("cmd")
+        handler = self.commands.get(command) if isinstance(command, str) else None
+        if handler is None:
+            response = {"ok": False, "error": "Unknown command: " + str(command)}
+            command = "invalid"
+        else:
+            try:
+                response = handler(connection, request)
+                response["ok"] = True
+            except KeyError as error:
+                response = {"ok": False, "error": "Missing field: " + str(error.args[0])}
+            except (ValueError, TypeError) as error:
+                response = {"ok": False, "error": str(error)}
+            except Exception as error:  # a bad request must not take the connection down with it
+                print("error in {}: {!r}".format(command, error), file=sys.stderr, flush=True)
+                response = {"ok": False, "error": "Internal error: " + repr(error)}
+        if "id" in request:
+            response["id"] = request["id"]
+        return command, response
+
+    def session_of(self, connection, request):
+        """
+        :raises ValueError: if the connection has no such game
+        """
+        session = connection.sessions.get(request.get("game"))
+        if session is None:
+            raise ValueError("Unknown game: " + str(request.get("game")))
+        return session
+
+    def new_game(self, connection, request):
+        if self.sessions >= self.max_sessions:
+            raise ValueError("Too many games")
+        computer = request.get("computer")
+        if computer not in (None, "w", "b"):
+            raise ValueError("computer must be w, b or null")
+        depth = min(max(int(request.get("depth", self.depth)), 1), MAX_DEPTH)
+        fen = request.get("fen", ChessPGN.START_FEN)
+        if not isinstance(fen, str):
+            raise ValueError("fen must be a string")
+        gs = ChessEngine.GameState.from_fen(fen, self.backend)
+        gs.move_cache = self.move_cache
+        session = Session(next(self.game_ids), gs, computer, depth, self.time_limit)
+        connection.sessions[session.game_id] = session
+        self.sessions += 1
+        self.start_computer(connection, session)
+        return {"game": session.game_id, "status": game_status(gs)}
+
+    def move(self, connection, request):
+        session = self.session_of(connection, request)
+        gs = session.gs
+        if session.thinking is not None:
+            raise ValueError("Not your move, the computer is thinking")
+        gs.make_move(ChessUCI.uci_to_move(gs, str(request["move"])))
+        self.start_computer(connection, session)
+        return {"game": session.game_id, "status": game_status(gs)}
+
+    def undo(self, connection, request):
+        """
+        Takes back plies (default 1); a search for the computer's move is dropped.
+        If that leaves the computer to move, it moves again
+        """
+        session = self.session_of(connection, request)
+        if session.thinking is not None:
+            session.thinking.cancel()
+            session.thinking = None
+        plies = int(request.get("plies", 1))
+        if plies < 0 or plies > len(session.gs.move_log):
+            raise ValueError("Can't undo {} plies".format(plies))
+        for _ in range(plies):
+            session.gs.undo_move()
+        self.start_computer(connection, session)
+        return {"game": session.game_id, "status": game_status(session.gs)}
+
+    def valid_moves(self, connection, request):
+        session = self.session_of(connection, request)
+        return {"game": session.game_id, "moves": [move.get_chess_notation() for move in session.gs.get_valid_moves()]}
+
+    def status(self, connection, request):
+        session = self.session_of(connection, request)
+        return {"game": session.game_id, "status": game_status(session.gs)}
+
+    def close_game(self, connection, request):
+        session = self.session_of(connection, request)
+        if session.thinking is not None:
+            session.thinking.cancel()
+        del connection.sessions[session.game_id]
+        self.sessions -= 1
+        return {"game": session.game_id}
+
+    def stats(self, connection, request):
+        return {"sessions": self.sessions, "connections": self.connections,
+                "searches_waiting": self.searches_waiting, "latency": self.latency.report(),
+                "loop_lag": percentiles(self.loop_lag), "move_cache": self.move_cache.info()}
+
+    def start_computer(self, connection, session):
+        """
+        Starts the search for the computer's move if it is the computer's turn in a game still going on
+        """
+        gs = session.gs
+        if session.computer != ("w" if gs.white_to_move else "b") or ChessPGN.game_result(gs) != "*":
+            return
+        session.thinking = asyncio.ensure_future(self.computer_move(connection, session))
+
+    async def computer_move(self, connection, session):
+        """
+        Finds the computer's move on a worker, plays it and pushes it to the client.
+        If the search fails, an error event is pushed instead and the game waits for the client
+        """
+        gs = session.gs
+        start = time.perf_counter()
+        self.searches_waiting += 1
+        waiting = True
+        executor = self.executor
+        try:
+            async with self.search_slots:
+                self.searches_waiting -= 1
+                waiting = False
+                notation = await asyncio.get_running_loop().run_in_executor(
+                    executor, search_move, gs.snapshot(True), self.backend, session.depth, session.time_limit)
+            if notation is not None:
+                gs.make_move(ChessUCI.uci_to_move(gs, notation))
+        except Exception as error:  # raised by the search, or a worker died and broke the pool
+            if isinstance(error, concurrent.futures.process.BrokenProcessPool) and self.executor is executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self.start_workers()
+            connection.send({"event": "error", "game": session.game_id,
+                             "error": "Computer move failed: " + repr(error)})
+            return
+        finally:
+            if waiting:  # cancelled before a worker was free
+                self.searches_waiting -= 1
+            if session.thinking is asyncio.current_task():  # an undo may have started another search already
+                session.thinking = None
+        self.latency.record("computer_move", time.perf_counter() - start)
+        connection.send({"event": "computer_move", "game": session.game_id, "move": notation,
+                         "status": game_status(gs)})
+
+
+class Client:
+    """
+    Client side of the protocol, for the load generator: one request at a time, pushed events kept aside
+    """
+    def __init__(self, reader, writer, latency):
+        self.reader = reader
+        self.writer = writer
+        self.latency = latency
+        self.request_ids = itertools.count(1)
+        self.events = collections.deque()
+
+    @classmethod
+    async def connect(cls, host, port, latency):
+        reader, writer = await asyncio.open_connection(host, port, limit=MAX_LINE)
+        return cls(reader, writer, latency)
+
+    async def read_message(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Server closed the connection")
+        return json.loads(line)
+
+    async def request(self, command, **fields):
+        """
+        Sends a request and waits for its response
+        :raises ValueError: if the server answers with an error
+        """
+        request_id = next(self.request_ids)
+        fields.update(id=request_id, cmd=command)
+        start = time.perf_counter()
+        self.writer.write((json.dumps(fields) + "\n").encode())
+        while True:
+            message = await self.read_message()
+            if message.get("id") == request_id:
+                break
+            self.events.append(message)
+        self.latency.record(command, time.perf_counter() - start)
+        if not message["ok"]:
+            raise ValueError(message["error"])
+        return message
+
+    async def next_event(self):
+        if self.events:
+            return self.events.popleft()
+        return await self.read_message()
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def play_games(host, port, games, max_plies, computer, depth, rng, latency):
+    """
+    One load generator client: plays games of random moves (against the computer if computer is set)
+    :return: plies played
+    """
+    client = await Client.connect(host, port, latency)
+    plies = 0
+    try:
+        for _ in range(games):
+            response = await client.request("new", computer="b" if computer else None, depth=depth)
+            game, status = response["game"], response["status"]
+            while status["result"] == "*" and status["plies"] < max_plies:
+                moves = (await client.request("moves", game=game))["moves"]
+                status = (await client.request("move", game=game, move=rng.choice(moves)))["status"]
+                plies += 1
+                if computer and status["result"] == "*":
+                    event = await client.next_event()
+                    if event["event"] == "error":
+                        raise ValueError(event["error"])
+                    status = event["status"]
+                    plies += 1
+            await client.request("status", game=game)
+            await client.request("close", game=game)
+    finally:
+        await client.close()
+    return plies
+
+
+async def run_load(host, port, clients, games, max_plies, computer=False, depth=1, seed=0):
+    """
+    Runs clients load generator clients at once
+    :return: dict of the totals, the client side latency percentiles and the server's stats
+    """
+    latency = LatencyStats()
+    start = time.perf_counter()
+    plies = await asyncio.gather(*(play_games(host, port, games, max_plies, computer, depth,
+                                              random.Random(seed + index), latency) for index in range(clients)))
+    seconds = time.perf_counter() - start
+    requests = sum(latency.counts.values())
+    stats_client = await Client.connect(host, port, LatencyStats())
+    try:
+        server_stats = await stats_client.request("stats")
+    finally:
+        await stats_client.close()
+    del server_stats["ok"], server_stats["id"]
+    return {"clients": clients, "games": clients * games, "plies": sum(plies), "requests": requests,
+            "seconds": round(seconds, 3), "requests_per_second": round(requests / seconds, 1),
+            "client_latency": latency.report(), "server": server_stats}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve many games over TCP, or put load on a server")
+    commands = parser.add_subparsers(dest="command")
+    serve = commands.add_parser("serve", help="run the server")
+    serve.add_argument("--host", default=DEFAULT_HOST)
+    serve.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve.add_argument("--workers", type=int, default=None, help="search processes (default: all cores)")
+    serve.add_argument("--max-pending", type=int, default=None,
+                       help="most searches handed to the workers at once (default: 4 per worker)")
+    serve.add_argument("--depth", type=int, default=2, help="default search depth of the computer")
+    serve.add_argument("--time-limit", type=float, default=None, help="seconds per computer move")
+    serve.add_argument("--max-sessions", type=int, default=MAX_SESSIONS)
+    serve.add_argument("--hash", type=int, default=16, help="transposition table size per worker in MB")
+    serve.add_argument("--backend", choices=ChessEngine.BACKENDS, default="list")
+    serve.add_argument("--report-every", type=float, default=None, help="print the stats every so many seconds")
+    load = commands.add_parser("load", help="play random games on a running server and report the latencies")
+    load.add_argument("--host", default=DEFAULT_HOST)
+    load.add_argument("--port", type=int, default=DEFAULT_PORT)
+    load.add_argument("--clients", type=int, default=100, help="connections playing at the same time")
+    load.add_argument("--games", type=int, default=1, help="games each client plays one after the other")
+    load.add_argument("--max-plies", type=int, default=40, help="plies each game is cut off at")
+    load.add_argument("--computer", action="store_true", help="play against the server's computer")
+    load.add_argument("--depth", type=int, default=1, help="search depth of the computer")
+    load.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        server = GameServer(args.workers, args.max_pending, args.depth, args.time_limit, args.max_sessions,
+                            args.hash, args.backend)
+        try:
+            asyncio.run(server.serve(args.host, args.port, args.report_every))
+        except KeyboardInterrupt:
+            pass
+        print(json.dumps(server.stats(None, {})), file=sys.stderr)
+    elif args.command == "load":
+        report = asyncio.run(run_load(args.host, args.port, args.clients, args.games, args.max_plies,
+                                      args.computer, args.depth, args.seed))
+        print(json.dumps(report, indent=2))
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,576 @@
+"""
+Endgame tablebases: the exact result of every position of a small material set (3 or 4 pieces, kings
+included) with the side to move, and the distance to mate in plies, worked out by retrograde analysis
+with ChessEngine's own move generator. A probe is an index computation and one byte read, so a covered
+position gets its perfect move without any search.
+
+Tables are named by their material, white's pieces then black's, each starting with the king:
+KQK, KRK, KPK, KBNK, KRKN, KQKR ... A table also answers for the same material with the colors swapped.
+Each table is one file, <signature>.tb in the tablebase directory, of one byte per position:
+    0          draw
+    1 .. 127   the side to move mates in 2 * value - 1 plies
+    128 .. 254 the side to move is mated in 2 * (value - 128) plies
+    255        not a legal position
+Positions are reduced by symmetry: with no pawns the white king is kept in the a1-d1-d4 triangle,
+with pawns on the a-d files. Positions with castle rights or an en passant square aren't covered,
+and a double step is treated as giving no en passant capture (only matters with pawns on both sides).
+
+Generating 3 piece tables takes seconds, 4 piece tables are an offline job (several million positions).
+A table that captures or promotions lead into is built first if it isn't there yet.
+
+Command line:
+    $ python ChessTablebase.py build KQK KRK KPK -d tablebases
+    $ python ChessTablebase.py probe -d tablebases --fen "8/8/8/4k3/8/8/8/4K2R w - - 0 1"
+"""
+
+import argparse
+import mmap
+import os
+import sys
+from array import array
+
+import ChessEngine
+
+TABLE_MAGIC = b"CHSTB001"  # file header, then the signature padded to 8 bytes, then the values
+SIGNATURE_SIZE = 8
+DRAW = 0
+INVALID = 255
+MAX_PIECES = 4
+PIECE_ORDER = "QRBNP"  # order of the pieces after the king in a signature
+PIECE_VALUES = {"K": 0, "Q": 9, "R": 5, "B": 3, "N": 3, "P": 1}
+
+UNKNOWN, WIN, LOSS, DRAWN, ILLEGAL = 0, 1, 2, 3, 4  # position status while a table is generated
+
+
+def transform(square, symmetry):
+    """
+    Square (row * 8 + column) mirrored left-right (symmetry bit 1), top-bottom (bit 2), then across the
+    a8-h1 diagonal (bit 4)
+    """
+    row, column = square >> 3, square & 7
+    if symmetry & 1:
+        column = 7 - column
+    if symmetry & 2:
+        row = 7 - row
+    if symmetry & 4:
+        row, column = column, row
+    return row * 8 + column
+
+
+# squares the white king is brought to, and the symmetry that brings it there from each square
+PAWNLESS_KING_SQUARES = [square for square in range(64)
+                         if square >> 3 >= 4 and square & 7 <= 3 and square & 7 >= 7 - (square >> 3)]
+PAWNLESS_SYMMETRIES = [next(symmetry for symmetry in range(8) if transform(square, symmetry) in PAWNLESS_KING_SQUARES)
+                       for square in range(64)]
+PAWN_KING_SQUARES = [square for square in range(64) if square & 7 <= 3]
+PAWN_SYMMETRIES = [0 if square & 7 <= 3 else 1 for square in range(64)]
+
+
+def encode_value(status, plies):
+    if status == WIN and plies <= 253:
+        return (plies + 1) // 2
+    if status == LOSS and plies <= 252:
+        return 128 + plies // 2
+    if status in (WIN, LOSS):
+        raise ValueError("Distance to mate too long to store: " + str(plies))
+    return DRAW
+
+
+def decode_value(value):
+    """
+    :return: ("win" / "loss" / "draw" for the side to move, plies to mate), None for an invalid position
+    """
+    if value == INVALID:
+        return None
+    if value == DRAW:
+        return "draw", 0
+    if value < 128:
+        return "win", 2 * value - 1
+    return "loss", 2 * (value - 128)
+
+
+def side_signature(pieces):
+    """
+    One side of a signature in its usual order, e.g. "KRN" from "NRK"
+    """
+    return "K" + "".join(sorted((piece for piece in pieces if piece != "K"), key=PIECE_ORDER.index))
+
+
+def split_signature(signature):
+    """
+    :return: (white side, black side) of a signature like "KRKN"
+    :raises ValueError: if it isn't a signature of 3 or 4 pieces
+    """
+    signature = signature.upper()
+    second_king = signature.find("K", 1)
+    white, black = signature[:second_king], signature[second_king:]
+    if not signature.startswith("K") or second_king < 0 or any(piece not in PIECE_ORDER for piece in
+                                                               white[1:] + black[1:]):
+        raise ValueError("Invalid material signature: " + signature)
+    if not 3 <= len(signature) <= MAX_PIECES:
+        raise ValueError("Tablebases cover 3 or 4 pieces: " + signature)
+    return side_signature(white), side_signature(black)
+
+
+def canonical_signature(white, black):
+    """
+    Name of the table that covers this material: the stronger side is white
+    """
+    if (sum(PIECE_VALUES[piece] for piece in black), black) > (sum(PIECE_VALUES[piece] for piece in white), white):
+        white, black = black, white
+    return white + black
+
+
+def material(gs):
+    """
+    :return: (white side, black side) of the pieces on the board of gs
+    """
+    pieces = {"w": "", "b": ""}
+    for piece, squares in gs.piece_squares.items():
+        pieces[piece[0]] += piece[1] * len(squares)
+    return side_signature(pieces["w"]), side_signature(pieces["b"])
+
+
+class Table:
+    """
+    Index layout of one material signature, and its values once generated or loaded
+    """
+    def __init__(self, signature):
+        self.white, self.black = split_signature(signature)
+        self.signature = self.white + self.black
+        # piece of every square in an index, white king first
+        self.pieces = ["w" + piece for piece in self.white] + ["b" + piece for piece in self.black]
+        self.has_pawns = "P" in self.signature
+        self.king_squares = PAWN_KING_SQUARES if self.has_pawns else PAWNLESS_KING_SQUARES
+        self.king_index = {square: index for index, square in enumerate(self.king_squares)}
+        self.symmetries = PAWN_SYMMETRIES if self.has_pawns else PAWNLESS_SYMMETRIES
+        self.size = len(self.king_squares) * 64 ** (len(self.pieces) - 1) * 2
+        self.values = None  # bytes-like of size values
+        self.file = None
+        self.data = None
+
+    def close(self):
+        if isinstance(self.values, memoryview):
+            self.values.release()
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.values = None
+
+    def position_index(self, squares, white_to_move):
+        """
+        :param squares: square of each piece of self.pieces, in that order
+        """
+        symmetry = self.symmetries[squares[0]]
+        index = self.king_index[transform(squares[0], symmetry)]
+        for square in squares[1:]:
+            index = index * 64 + transform(square, symmetry)
+        return index * 2 + (0 if white_to_move else 1)
+
+    def index_position(self, index):
+        """
+        Inverse of position_index
+        :return: (squares, white_to_move)
+        """
+        white_to_move = index % 2 == 0
+        index //= 2
+        squares = []
+        for _ in self.pieces[1:]:
+            squares.append(index % 64)
+            index //= 64
+        squares.append(self.king_squares[index])
+        squares.reverse()
+        return squares, white_to_move
+
+    def index_of(self, gs, flipped=False):
+        """
+        Index of the position on gs, which must have this table's material
+        (with the colors swapped if flipped: the board is then mirrored top-bottom)
+        """
+        squares = []
+        previous = None
+        for piece in self.pieces:
+            if piece == previous:
+                continue  # both squares of a pair were taken with the first one
+            previous = piece
+            if flipped:
+                squares.extend(transform(square, 2) for square in sorted(gs.piece_squares[
+                    ("b" if piece[0] == "w" else "w") + piece[1]]))
+            else:
+                squares.extend(sorted(gs.piece_squares[piece]))
+        return self.position_index(squares, gs.white_to_move != flipped)
+
+
+def open_table(path, signature):
+    """
+    Maps a table file into memory
+    :raises ValueError: if it isn't the table of signature
+    """
+    table = Table(signature)
+    table.file = open(path, "rb")
+    size = os.fstat(table.file.fileno()).st_size
+    if size != len(TABLE_MAGIC) + SIGNATURE_SIZE + table.size:
+        table.close()
+        raise ValueError("Not a " + table.signature + " table: " + path)
+    table.data = mmap.mmap(table.file.fileno(), 0, access=mmap.ACCESS_READ)
+    header = table.data[:len(TABLE_MAGIC) + SIGNATURE_SIZE]
+    if header != TABLE_MAGIC + table.signature.encode("ascii").ljust(SIGNATURE_SIZE, b"\0"):
+        table.close()
+        raise ValueError("Not a " + table.signature + " table: " + path)
+    table.values = memoryview(table.data)[len(TABLE_MAGIC) + SIGNATURE_SIZE:]
+    return table
+
+
+def write_table(path, table, values):
+    """
+    Writes a table file (through a temporary file, so readers never see half a table)
+    """
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as table_file:
+        table_file.write(TABLE_MAGIC + table.signature.encode("ascii").ljust(SIGNATURE_SIZE, b"\0"))
+        table_file.write(values)
+    os.replace(temporary_path, path)
+
+
+class Tablebases:
+    """
+    The tables of a directory, opened as they are needed
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.tables = {}  # signature -> Table, None if there is no file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for table in self.tables.values():
+            if table is not None:
+                table.close()
+        self.tables = {}
+
+    def path(self, signature):
+        return os.path.join(self.directory, signature + ".tb")
+
+    def table(self, signature):
+        """
+        :return: Table of a canonical signature, None if the directory doesn't have it
+        """
+        if signature not in self.tables:
+            path = self.path(signature)
+            self.tables[signature] = open_table(path, signature) if os.path.exists(path) else None
+        return self.tables[signature]
+
+    def lookup(self, gs):
+        """
+        Value byte of the position on gs, whatever its castle rights and en passant square
+        :return: the value, None if no table covers the material
+        """
+        white, black = material(gs)
+        if white == "K" and black == "K":
+            return DRAW
+        if len(white) + len(black) > MAX_PIECES:
+            return None
+        signature = canonical_signature(white, black)
+        table = self.table(signature)
+        if table is None or table.values is None:
+            return None
+        return table.values[table.index_of(gs, signature != white + black)]
+
+    def covers(self, gs):
+        """
+        Whether a probe of gs can be answered: a table for its material, no castle rights, no en passant
+        """
+        rights = gs.current_castling_rights
+        if rights.wKs or rights.wQs or rights.bKs or rights.bQs or enpassant_capture_possible(gs):
+            return False
+        return self.lookup(gs) is not None
+
+    def probe(self, gs):
+        """
+        Result of the current position of gs for the side to move
+        :return: ("win" / "loss" / "draw", plies to mate), None if it isn't covered
+        """
+        if not self.covers(gs):
+            return None
+        return decode_value(self.lookup(gs))
+
+    def rank_moves(self, gs):
+        """
+        Every valid move of gs with the result it leads to for the side to move, best first:
+        the fastest win, then draws, then the slowest loss
+        :return: list of (move, result, plies to mate), None if the position isn't covered
+        """
+        if not self.covers(gs):
+            return None
+        checkmate, stalemate = gs.checkmate, gs.stalemate
+        ranked = []
+        for move in gs.get_valid_moves():
+            gs.make_move(move)
+            value = self.lookup(gs)
+            if not enpassant_capture_possible(gs) and value is not None and value != INVALID:
+                result, plies = decode_value(value)
+            else:
+                # the move leaves the tables (en passant square, or a promotion into more material)
+                result, plies = "unknown", 0
+            gs.undo_move()
+            # the opponent's result, turned around
+            if result == "loss":
+                ranked.append((move, "win", plies + 1, (0, plies)))
+            elif result == "win":
+                ranked.append((move, "loss", plies + 1, (3, -plies)))
+            else:
+                ranked.append((move, result, 0, (1 if result == "draw" else 2, 0)))
+        gs.checkmate, gs.stalemate = checkmate, stalemate
+        ranked.sort(key=lambda entry: entry[3])
+        return [entry[:3] for entry in ranked]
+
+    def best_move(self, gs):
+        """
+        A perfect move for gs: mates fastest when winning, holds the draw, resists longest when losing
+        :return: a valid Move, None if the position isn't covered or there are no moves
+        """
+        ranked = self.rank_moves(gs)
+        if not ranked:
+            return None
+        return ranked[0][0]
+
+    def build(self, signature, progress=None):
+        """
+        Generates a table and the tables it depends on that the directory doesn't have yet, and writes them
+        :param progress: called with a line of text about each table written
+        :return: the Table, opened from its new file
+        """
+        table = Table(signature)
+        signature = table.signature
+        if canonical_signature(table.white, table.black) != signature:
+            raise ValueError(signature + " is covered by the " + canonical_signature(table.white, table.black) +
+                             " table")
+        for dependency in dependencies(table):
+            if self.table(dependency) is None:
+                self.build(dependency, progress)
+        values, statistics = generate(self, table)
+        os.makedirs(self.directory, exist_ok=True)
+        write_table(self.path(signature), table, values)
+        self.tables.pop(signature, None)
+        if progress is not None:
+            progress("{}: {} positions, {} wins, {} losses, {} draws, longest mate {} plies".format(
+                signature, statistics["positions"], statistics["wins"], statistics["losses"], statistics["draws"],
+                statistics["longest"]))
+        return self.table(signature)
+
+
+def enpassant_capture_possible(gs):
+    """
+    Whether the side to move has a pawn next to the pawn that just made a double step
+    """
+    if gs.enpassant_possible == ():
+        return False
+    color = "w" if gs.white_to_move else "b"
+    square = gs.enpassant_possible[0] * 8 + gs.enpassant_possible[1]
+    return bool(gs.piece_squares[color + "P"] & ChessEngine.PAWN_ATTACK_SQUARES[color][square])
+
+
+def open_tablebases(directory):
+    """
+    :return: Tablebases, or None if there is no such directory
+    """
+    if directory is None or not os.path.isdir(directory):
+        return None
+    return Tablebases(directory)
+
+
+def dependencies(table):
+    """
+    Signatures a move can lead into from table: a capture of one piece, a promotion of one pawn
+    """
+    signatures = set()
+    for own, other, white in ((table.white, table.black, True), (table.black, table.white, False)):
+        for index, piece in enumerate(own):
+            if piece == "K":
+                continue
+            rest = own[:index] + own[index + 1:]
+            if piece == "P":
+                for promotion in ChessEngine.PROMOTION_PIECES:
+                    side = side_signature(rest + promotion)
+                    signatures.add(canonical_signature(side, other) if white else canonical_signature(other, side))
+            # this piece captured
+            if white:
+                signatures.add(canonical_signature(side_signature(rest), other))
+            else:
+                signatures.add(canonical_signature(other, side_signature(rest)))
+    signatures.discard("KK")
+    return sorted(signatures, key=len)
+
+
+def set_position(gs, pieces, squares, white_to_move):
+    """
+    Puts only these pieces on the board of gs, with no castle rights and no en passant square
+    """
+    for piece_squares in gs.piece_squares.values():
+        for square in piece_squares:
+            gs.board[square >> 3][square & 7] = "--"
+        piece_squares.clear()
+    for piece, square in zip(pieces, squares):
+        gs.board[square >> 3][square & 7] = piece
+        gs.piece_squares[piece].add(square)
+        if piece == "wK":
+            gs.white_king_location = (square >> 3, square & 7)
+        elif piece == "bK":
+            gs.black_king_location = (square >> 3, square & 7)
+    gs.white_to_move = white_to_move
+    gs.current_castling_rights = ChessEngine.CastleRights(False, False, False, False)
+    gs.castle_rights_log = [ChessEngine.CastleRights(False, False, False, False)]
+    gs.enpassant_possible = ()
+    gs.enpassant_possible_log = [()]
+    gs.move_log = []
+
+
+def generate(tablebases, table):
+    """
+    Retrograde analysis of one table. Every legal position's moves are generated once, with the
+    positions they lead to inside the table kept as indices and the ones outside (captures, promotions)
+    looked up in the smaller tables. Then, ply by ply, a position is won in n plies if a move leads to a
+    position lost in n - 1, and lost in n plies if every move leads to a position won in at most n - 1
+    (and one in exactly n - 1). Whatever is left when nothing changes is a draw
+    :return: (bytearray of values, statistics dict)
+    """
+    size = table.size
+    status = bytearray(size)
+    plies = array("H", bytes(2 * size))
+    offsets = array("i", [0])
+    successors = array("i")
+    external_wins = {}  # index -> plies of the fastest win by a move out of the table
+    external_losses = {}  # index -> plies of the slowest loss by a move out of the table
+    held = set()  # indices with a move out of the table that doesn't lose
+    unresolved = array("i")
+
+    gs = ChessEngine.GameState()
+    set_position(gs, [], [], True)
+    pieces = table.pieces
+    for index in range(size):
+        squares, white_to_move = table.index_position(index)
+        if len(set(squares)) != len(squares) or any(piece[1] == "P" and square >> 3 in (0, 7)
+                                                    for piece, square in zip(pieces, squares)):
+            status[index] = ILLEGAL
+            offsets.append(len(successors))
+            continue
+        set_position(gs, pieces, squares, white_to_move)
+        king_row, king_column = gs.black_king_location if white_to_move else gs.white_king_location
+        if gs.find_attackers(king_row, king_column, "w" if white_to_move else "b", True):
+            status[index] = ILLEGAL  # the side that just moved is in check
+            offsets.append(len(successors))
+            continue
+        moves = gs.get_valid_moves()
+        if not moves:
+            status[index] = LOSS if gs.checkmate else DRAWN
+            offsets.append(len(successors))
+            continue
+        for move in moves:
+            gs.make_move(move)
+            if move.piece_captured != "--" or move.is_pawn_promotion:
+                value = tablebases.lookup(gs)
+                if value is None:
+                    raise ValueError("Missing table for " + "".join(material(gs)))
+                result, distance = decode_value(value)
+                if result == "loss":
+                    external_wins[index] = min(external_wins.get(index, distance + 1), distance + 1)
+                elif result == "win":
+                    external_losses[index] = max(external_losses.get(index, 0), distance + 1)
+                else:
+                    held.add(index)
+            else:
+                successors.append(table.index_of(gs))
+            gs.undo_move()
+        offsets.append(len(successors))
+        unresolved.append(index)
+
+    last_external = max(list(external_wins.values()) + list(external_losses.values()) + [0])
+    n = 0
+    changed = True
+    while unresolved and (changed or n <= last_external):
+        n += 1
+        wins = []
+        losses = []
+        remaining = array("i")
+        for index in unresolved:
+            targets = successors[offsets[index]:offsets[index + 1]]
+            if external_wins.get(index) == n or any(status[target] == LOSS and plies[target] == n - 1
+                                                    for target in targets):
+                wins.append(index)
+            elif index not in held and index not in external_wins and \
+                    all(status[target] == WIN for target in targets) and \
+                    max([plies[target] + 1 for target in targets] + [external_losses.get(index, 0)]) == n:
+                losses.append(index)
+            else:
+                remaining.append(index)
+        for index in wins:
+            status[index] = WIN
+            plies[index] = n
+        for index in losses:
+            status[index] = LOSS
+            plies[index] = n
+        changed = bool(wins or losses)
+        unresolved = remaining
+
+    values = bytearray(size)
+    statistics = {"positions": 0, "wins": 0, "losses": 0, "draws": 0, "longest": 0}
+    for index in range(size):
+        if status[index] == ILLEGAL:
+            values[index] = INVALID
+            continue
+        statistics["positions"] += 1
+        if status[index] == WIN:
+            statistics["wins"] += 1
+        elif status[index] == LOSS:
+            statistics["losses"] += 1
+        else:
+            statistics["draws"] += 1
+            continue
+        values[index] = encode_value(status[index], plies[index])
+        statistics["longest"] = max(statistics["longest"], plies[index])
+    return values, statistics
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate or probe endgame tablebases")
+    commands = parser.add_subparsers(dest="command")
+    build = commands.add_parser("build", help="generate tables (and the smaller ones they lead into)")
+    build.add_argument("signature", nargs="+", help="material signatures, e.g. KQK KRK KPK KBNK")
+    build.add_argument("-d", "--directory", default="tablebases", help="directory of the table files")
+    probe = commands.add_parser("probe", help="print the result of a position and of each of its moves")
+    probe.add_argument("-d", "--directory", default="tablebases", help="directory of the table files")
+    probe.add_argument("--fen", required=True)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        with Tablebases(args.directory) as tablebases:
+            for signature in args.signature:
+                try:
+                    tablebases.build(signature, print)
+                except ValueError as error:
+                    parser.error(str(error))
+    elif args.command == "probe":
+        gs = ChessEngine.GameState.from_fen(args.fen)
+        with Tablebases(args.directory) as tablebases:
+            result = tablebases.probe(gs)
+            if result is None:
+                print("not covered")
+                return 1
+            print("{} in {} plies".format(*result) if result[0] != "draw" else "draw")
+            for move, move_result, distance in tablebases.rank_moves(gs):
+                print(move.get_chess_notation() + " " + move_result + (" " + str(distance) if distance else ""))
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
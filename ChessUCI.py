@@ -0,0 +1,259 @@
+"""
+UCI (Universal Chess Interface) mode: the engine driven over stdin/stdout by a chess GUI or a testing tool.
+Commands are read on the main thread and the search runs on a worker thread, so stop, isready and
+the rest are answered while it thinks; stop makes it report its best move within a few nodes.
+
+Supported: uci, debug, isready, setoption (Hash in MB, Threads), ucinewgame,
+position startpos/fen ... [moves ...], go (depth, nodes, movetime, wtime/btime/winc/binc/movestogo,
+infinite, ponder), stop, ponderhit, quit. The search is single-threaded, Threads is accepted but doesn't change it;
+searchmoves is accepted but the whole position is searched, other go tokens are skipped.
+
+    $ python ChessUCI.py
+"""
+
+import sys
+import threading
+
+import ChessEngine
+import ChessPGN
+import ChessSearch
+
+ENGINE_NAME = "Chess"
+ENGINE_AUTHOR = "bradleygreene"
+DEFAULT_HASH_MB = 16
+MAX_HASH_MB = 1024
+MAX_THREADS = 64
+MOVES_TO_GO = 30  # moves the remaining time is shared between when the GUI doesn't say
+MOVE_OVERHEAD = 0.05  # seconds kept back per move for the GUI and the pipe
+SWITCH_INTERVAL = 0.001  # seconds the search thread holds the interpreter before the reader gets a turn
+GO_LIMITS = ("depth", "nodes", "movetime", "wtime", "btime", "winc", "binc", "movestogo")  # go tokens taking an int
+GO_KEYWORDS = GO_LIMITS + ("infinite", "ponder", "searchmoves", "mate")  # where a searchmoves list ends
+
+
+def uci_to_move(gs, text, valid_moves=None):
+    """
+    Valid move of gs in long algebraic notation, e.g. "e2e4", "e1g1" (castling), "e7e8q" (promotion)
+    :raises ValueError: if it isn't a valid move
+    """
+    if valid_moves is None:
+        valid_moves = gs.get_valid_moves()
+    text = text.lower()
+    if len(text) == 4:
+        text_queen = text + "q"  # a promotion without its piece is a queen
+    else:
+        text_queen = text
+    for move in valid_moves:
+        notation = move.get_chess_notation()
+        if notation == text or notation == text_queen:
+            return move
+    raise ValueError("Illegal move: " + text)
+
+
+def format_score(score):
+    """
+    "cp <centipawns>" or "mate <moves>" (negative when the engine gets mated)
+    """
+    if abs(score) >= ChessSearch.MATE_SCORE - ChessSearch.MAX_PLY:
+        plies = ChessSearch.MATE_SCORE - abs(score)
+        moves = (plies + 1) // 2
+        return "mate " + str(moves if score > 0 else -moves)
+    return "cp " + str(score)
+
+
+class UCIEngine:
+    """
+    State of a UCI session: the position, the options and the search running in the background
+    """
+    def __init__(self, output=None):
+        self.output = output if output is not None else sys.stdout
+        self.output_lock = threading.Lock()  # the search thread writes info and bestmove lines too
+        self.hash_mb = DEFAULT_HASH_MB
+        self.threads = 1
+        self.debug = False
+        self.searcher = ChessSearch.Searcher(self.hash_mb)
+        self.gs = ChessEngine.GameState()
+        self.search_thread = None
+        self.infinite = False  # hold bestmove until stop (or ponderhit)
+        self.commands = {"uci": self.uci, "debug": self.set_debug, "isready": self.isready,
+                         "setoption": self.setoption, "ucinewgame": self.ucinewgame, "position": self.position,
+                         "go": self.go, "stop": self.stop, "ponderhit": self.stop}
+
+    def send(self, line):
+        with self.output_lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+
+    def handle(self, line):
+        """
+        Runs one command line
+        :return: False after quit, True otherwise
+        """
+        tokens = line.split()
+        if not tokens:
+            return True
+        if tokens[0] == "quit":
+            self.stop([])
+            return False
+        command = self.commands.get(tokens[0])
+        if command is None:
+            if self.debug:
+                self.send("info string unknown command " + tokens[0])
+            return True  # the protocol says to ignore what isn't understood
+        try:
+            command(tokens[1:])
+        except ValueError as error:
+            self.send("info string " + str(error))
+        return True
+
+    def uci(self, arguments):
+        self.send("id name " + ENGINE_NAME)
+        self.send("id author " + ENGINE_AUTHOR)
+        self.send("option name Hash type spin default {} min 1 max {}".format(DEFAULT_HASH_MB, MAX_HASH_MB))
+        self.send("option name Threads type spin default 1 min 1 max {}".format(MAX_THREADS))
+        self.send("uciok")
+
+    def set_debug(self, arguments):
+        self.debug = arguments[:1] == ["on"]
+
+    def isready(self, arguments):
+        self.send("readyok")
+
+    def setoption(self, arguments):
+        """
+        setoption name <name> value <value>
+        """
+        if "name" not in arguments:
+            raise ValueError("setoption without a name")
+        if "value" in arguments:
+            name = " ".join(arguments[arguments.index("name") + 1:arguments.index("value")]).lower()
+            value = " ".join(arguments[arguments.index("value") + 1:])
+        else:
+            name = " ".join(arguments[arguments.index("name") + 1:]).lower()
+            value = ""
+        if name == "hash":
+            hash_mb = min(max(int(value), 1), MAX_HASH_MB)
+            if hash_mb != self.hash_mb:
+                self.wait_for_search()
+                self.hash_mb = hash_mb
+                self.searcher = ChessSearch.Searcher(hash_mb)
+        elif name == "threads":
+            self.threads = min(max(int(value), 1), MAX_THREADS)
+        else:
+            raise ValueError("Unknown option: " + name)
+
+    def ucinewgame(self, arguments):
+        self.wait_for_search()
+        self.searcher.tt.clear()
+        self.gs = ChessEngine.GameState()
+
+    def position(self, arguments):
+        """
+        position startpos [moves <move> ...] / position fen <fen> [moves <move> ...]
+        """
+        if "moves" in arguments:
+            moves = arguments[arguments.index("moves") + 1:]
+            arguments = arguments[:arguments.index("moves")]
+        else:
+            moves = []
+        if arguments[:1] == ["startpos"]:
+            fen = ChessPGN.START_FEN
+        elif arguments[:1] == ["fen"]:
+            fen = " ".join(arguments[1:])
+        else:
+            raise ValueError("position needs startpos or fen")
+        self.wait_for_search()
+        gs = ChessEngine.GameState.from_fen(fen)
+        for text in moves:
+            gs.make_move(uci_to_move(gs, text))
+        self.gs = gs
+
+    def go(self, arguments):
+        """
+        go [depth <plies>] [nodes <n>] [movetime <ms>] [wtime <ms>] [btime <ms>] [winc <ms>] [binc <ms>]
+           [movestogo <n>] [infinite] [ponder] [searchmoves <move> ...]
+        A pondering search keeps to the clock but holds bestmove until stop or ponderhit.
+        Unknown tokens and values that aren't numbers are skipped, so a search always starts
+        """
+        limits = {}
+        index = 0
+        while index < len(arguments):
+            token = arguments[index]
+            index += 1
+            if token in ("infinite", "ponder"):
+                limits[token] = True
+            elif token == "searchmoves":
+                while index < len(arguments) and arguments[index] not in GO_KEYWORDS:
+                    index += 1
+            elif token in GO_LIMITS and index < len(arguments) and arguments[index].lstrip("-").isdigit():
+                limits[token] = int(arguments[index])
+                index += 1
+        self.wait_for_search()
+        max_depth = limits.get("depth", ChessSearch.MAX_PLY - 1)
+        time_limit = None
+        if "movetime" in limits:
+            time_limit = max(limits["movetime"] / 1000 - MOVE_OVERHEAD, 0.01)
+        elif ("wtime" if self.gs.white_to_move else "btime") in limits:
+            remaining = limits["wtime" if self.gs.white_to_move else "btime"] / 1000
+            increment = limits.get("winc" if self.gs.white_to_move else "binc", 0) / 1000
+            share = remaining / limits.get("movestogo", MOVES_TO_GO) + increment * 0.8
+            time_limit = max(min(share, remaining / 2) - MOVE_OVERHEAD, 0.01)
+        self.infinite = limits.get("infinite", False) or limits.get("ponder", False)
+        if limits.get("infinite", False):
+            time_limit = None
+        self.search_thread = threading.Thread(target=self.search, args=(self.gs.clone(), max_depth, time_limit,
+                                                                         limits.get("nodes")), daemon=True)
+        self.search_thread.start()
+
+    def search(self, gs, max_depth, time_limit, node_limit):
+        """
+        Runs on the search thread: info lines for every finished depth, then bestmove
+        """
+        result = self.searcher.search(gs, max_depth, time_limit, node_limit, self.send_info)
+        if self.infinite:
+            self.searcher.stop_event.wait()  # bestmove only after stop, even if the search ran out of depth
+        if result.best_move is None:
+            self.send("bestmove 0000")
+        else:
+            self.send("bestmove " + result.best_move.get_chess_notation())
+
+    def send_info(self, result):
+        milliseconds = max(int(result.seconds * 1000), 1)
+        self.send("info depth {} score {} nodes {} nps {} time {} hashfull {} pv {}".format(
+            result.depth, format_score(result.score), result.nodes, result.nodes * 1000 // milliseconds,
+            milliseconds, self.searcher.tt.hashfull(), " ".join(move.get_chess_notation() for move in result.pv)))
+
+    def stop(self, arguments):
+        """
+        Ends the search; it sends its bestmove before this returns.
+        Also ponderhit: the move the search has so far is played rather than searching on
+        """
+        if self.search_thread is not None:
+            while self.search_thread.is_alive():
+                self.searcher.stop()  # again if the search thread only just started and cleared it
+                self.search_thread.join(0.01)
+            self.search_thread = None
+
+    def wait_for_search(self):
+        """
+        Lets a running search finish before the position or options change under it
+        (a GUI sends stop first; an infinite search is stopped here)
+        """
+        if self.search_thread is not None:
+            if self.infinite:
+                self.stop([])
+            self.search_thread.join()
+            self.search_thread = None
+
+
+def main():
+    sys.setswitchinterval(SWITCH_INTERVAL)
+    engine = UCIEngine()
+    for line in sys.stdin:
+        if not engine.handle(line):
+            break
+    engine.stop([])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())